@@ -0,0 +1,29 @@
+"""decoded fingerprints table
+
+Revision ID: 5a3e1d7c9b20
+Revises: c41cf2cd9ac6
+Create Date: 2026-10-18 10:12:41.518306
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a3e1d7c9b20'
+down_revision = 'c41cf2cd9ac6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('decoded_fingerprints',
+    sa.Column('song_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('fingerprint', sa.LargeBinary(), nullable=False),
+    sa.ForeignKeyConstraint(['song_id'], ['songs.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('song_id')
+    )
+
+
+def downgrade():
+    op.drop_table('decoded_fingerprints')
@@ -0,0 +1,32 @@
+"""duplicate clusters table
+
+Revision ID: 8d2f6b4a1c37
+Revises: 5a3e1d7c9b20
+Create Date: 2026-10-18 12:31:07.204917
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2f6b4a1c37'
+down_revision = '5a3e1d7c9b20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('duplicate_clusters',
+    sa.Column('song_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('cluster_id', sa.Integer(), nullable=False),
+    sa.Column('is_best', sa.Boolean(), nullable=False),
+    sa.ForeignKeyConstraint(['song_id'], ['songs.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('song_id')
+    )
+    op.create_index('duplicate_clusters_cluster_id_idx', 'duplicate_clusters', ['cluster_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('duplicate_clusters_cluster_id_idx', table_name='duplicate_clusters')
+    op.drop_table('duplicate_clusters')
@@ -0,0 +1,26 @@
+"""audio stream checksums
+
+Revision ID: 3b7e9f2d5a61
+Revises: 8d2f6b4a1c37
+Create Date: 2026-10-18 15:47:22.861934
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b7e9f2d5a61'
+down_revision = '8d2f6b4a1c37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('checksums', sa.Column('audio_stream_sha256sum', sa.Text(),
+                                         nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('checksums') as batch_op:
+        batch_op.drop_column('audio_stream_sha256sum')
@@ -0,0 +1,26 @@
+"""embedded audio checksums
+
+Revision ID: 5c1a8e4f7b92
+Revises: 3b7e9f2d5a61
+Create Date: 2026-10-18 18:52:10.418327
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1a8e4f7b92'
+down_revision = '3b7e9f2d5a61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('checksums', sa.Column('embedded_audio_md5sum', sa.Text(),
+                                         nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('checksums') as batch_op:
+        batch_op.drop_column('embedded_audio_md5sum')
@@ -0,0 +1,30 @@
+"""directory scans table
+
+Revision ID: 7d4b2a9c1e53
+Revises: 5c1a8e4f7b92
+Create Date: 2026-10-18 19:04:36.592871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d4b2a9c1e53'
+down_revision = '5c1a8e4f7b92'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('directory_scans',
+    sa.Column('path', sa.Text(), nullable=False),
+    sa.Column('mtime_ns', sa.BigInteger(), nullable=False),
+    sa.Column('entry_count', sa.Integer(), nullable=False),
+    sa.Column('scan_time', sa.Numeric(precision=20, scale=8), nullable=False),
+    sa.PrimaryKeyConstraint('path')
+    )
+
+
+def downgrade():
+    op.drop_table('directory_scans')
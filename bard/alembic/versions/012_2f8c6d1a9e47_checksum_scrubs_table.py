@@ -0,0 +1,33 @@
+"""checksum scrubs table
+
+Revision ID: 2f8c6d1a9e47
+Revises: 7d4b2a9c1e53
+Create Date: 2026-10-18 19:21:08.374125
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2f8c6d1a9e47'
+down_revision = '7d4b2a9c1e53'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('checksum_scrubs',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('command', sa.Text(), nullable=False),
+    sa.Column('start_time', sa.TIMESTAMP(), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=True),
+    sa.Column('root', sa.Text(), nullable=False),
+    sa.Column('files', sa.Integer(), nullable=False),
+    sa.Column('bytes', sa.BigInteger(), nullable=False),
+    sa.Column('seconds', sa.Numeric(precision=20, scale=8), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('checksum_scrubs')
@@ -26,6 +26,7 @@ extern "C" {
 #include <libavcodec/avcodec.h>
 #include <libswresample/swresample.h>
 #include <libavutil/opt.h>
+#include <libavutil/hash.h>
 
 #ifdef __cplusplus
 }
@@ -298,7 +299,7 @@ void AudioFile::avlog_callback(void *avcl, int level, const char *fmt, va_list v
     }
 }
 
-AudioFile *AudioFile::s_self = nullptr;
+thread_local AudioFile *AudioFile::s_self = nullptr;
 
 double AudioFile::currentDecodingPosition() const
 {
@@ -573,12 +574,14 @@ void AudioFile::writeOutFrame(const AVFrame *frame)
 
 void AudioFile::handleOutFrame(const AVFrame *frame)
 {
-    static int samples_written = 0;
+    static thread_local int samples_written = 0;
     samples_written += frame->nb_samples;
     logDebug(TraceSamples) << "samples written " << frame->nb_samples << " . Total written: " << samples_written << std::endl;
+    if (m_fingerprinter)
+        m_fingerprinter->feed(frame);
     if (m_encoder)
         m_encoder->pushFrame(frame);
-    else
+    else if (m_output)
         writeOutFrame(frame);
 }
 
@@ -610,7 +613,7 @@ int AudioFile::receiveFramesAndHandle() {
 #ifdef TRACE
     std::cout << "receiveFramesAndHandle" << std::endl;
 #endif
-    static int samples_read = 0;
+    static thread_local int samples_read = 0;
     while((err = avcodec_receive_frame(m_inCodecCtx, m_inFrame)) == 0) {
 
         m_lastDecodedPTS = m_inFrame->pts;
@@ -685,6 +688,11 @@ void AudioFile::setOutput(DecodeOutput *output)
     m_output = output;
 }
 
+void AudioFile::setFingerprinter(Fingerprinter *fingerprinter)
+{
+    m_fingerprinter = fingerprinter;
+}
+
 int AudioFile::initResampler()
 {
     int err;
@@ -770,6 +778,15 @@ int AudioFile::decode()
         }
     }
 
+    if (m_fingerprinter)
+    {
+#if LIBAVCODEC_VERSION_INT < AV_VERSION_INT(61,19,100)
+        m_fingerprinter->start(m_outSampleRate, m_outChannelNumber);
+#else
+        m_fingerprinter->start(m_outSampleRate, m_outChannelLayout.nb_channels);
+#endif
+    }
+
     m_inFrame = av_frame_alloc();
     if (m_inFrame == NULL) {
         return -1;
@@ -792,6 +809,18 @@ int AudioFile::decode()
             logError("Read frame error", err);
             break;
         }
+        if (m_output && m_output->isCancelled())
+        {
+            logDebug(TraceDecode) << "decoding cancelled by the output" << std::endl;
+            av_packet_unref(packet);
+            break;
+        }
+        if (!m_output && m_fingerprinter && m_fingerprinter->isComplete())
+        {
+            logDebug(TraceDecode) << "fingerprint completed" << std::endl;
+            av_packet_unref(packet);
+            break;
+        }
         if(packet->stream_index != m_audioStreamIndex)
         {
             logDebug(TraceDecode) << "packet not from audio stream" << std::endl;
@@ -821,6 +850,9 @@ int AudioFile::decode()
 
     drainDecoder();
 
+    if (m_fingerprinter)
+        m_fingerprinter->finish();
+
     if (m_output)
         m_output->terminate();
 
@@ -829,6 +861,59 @@ int AudioFile::decode()
     return 0;
 }
 
+/*
+ * Calculates the sha256 of the audio packets of the selected stream without
+ * decoding them. Together with the codec, sample rate, channels and the
+ * timestamps of the packets, they contain all the information used to
+ * decode the audio, so the checksum only changes if the audio changes and
+ * not when the metadata of the file (tags, covers, etc.) is modified.
+ */
+int AudioFile::audioStreamChecksum(std::string &checksum)
+{
+    AVHashContext *hashCtx = nullptr;
+    int err;
+    if ((err = av_hash_alloc(&hashCtx, "SHA256")) < 0)
+        return logError("Error allocating hash context", err);
+    av_hash_init(hashCtx);
+
+    int64_t streamInfo[] = {m_inCodecCtx->codec_id, m_inCodecCtx->sample_rate,
+#if LIBAVCODEC_VERSION_INT < AV_VERSION_INT(61,19,100)
+                            m_inCodecCtx->channels};
+#else
+                            m_inCodecCtx->ch_layout.nb_channels};
+#endif
+    av_hash_update(hashCtx, reinterpret_cast<const uint8_t *>(streamInfo), sizeof(streamInfo));
+
+    AVPacket* packet = av_packet_alloc();
+    while ((err = av_read_frame(m_inFormatCtx, packet)) != AVERROR_EOF)
+    {
+        if (err != 0)
+        {
+            logError("Read frame error", err);
+            break;
+        }
+        if (packet->stream_index == m_audioStreamIndex)
+        {
+            int64_t packetInfo[] = {packet->pts, packet->duration, packet->size};
+            av_hash_update(hashCtx, reinterpret_cast<const uint8_t *>(packetInfo), sizeof(packetInfo));
+            av_hash_update(hashCtx, packet->data, packet->size);
+        }
+        av_packet_unref(packet);
+    }
+    av_packet_free(&packet);
+
+    if (err == AVERROR_EOF)
+    {
+        uint8_t hex[AV_HASH_MAX_SIZE * 2 + 1];
+        av_hash_final_hex(hashCtx, hex, sizeof(hex));
+        checksum = reinterpret_cast<const char *>(hex);
+        err = 0;
+    }
+    av_hash_freep(&hashCtx);
+
+    return err;
+}
+
 int AudioFile::recode(const string &outFilename, const string &encoder, int bitrate)
 {
     m_encoder = new Encoder();
@@ -24,6 +24,7 @@
 #include "bufferaviocontext.h"
 #include "decodeoutput.h"
 #include "encoder.h"
+#include "fingerprinter.h"
 
 #ifdef __cplusplus
 extern "C" {
@@ -84,8 +85,10 @@ public:
     std::string outSampleFormat() const;
 
     void setOutput(DecodeOutput *output);
+    void setFingerprinter(Fingerprinter *fingerprinter);
 
     int decode();
+    int audioStreamChecksum(std::string &checksum);
     int recode(const string &outFilename, const string &encoder, int bitrate=0);
 
     std::vector<std::string> errors() const;
@@ -154,6 +157,7 @@ protected:
 
     BufferAVIOContext *m_avioContext = nullptr;
     DecodeOutput *m_output = nullptr;
+    Fingerprinter *m_fingerprinter = nullptr;
 
     std::vector<LogRecord> m_loggedMessages;
 
@@ -164,6 +168,6 @@ protected:
     int m_frames_received_total = 0;
 #endif
 
-    static AudioFile *s_self;
+    static thread_local AudioFile *s_self;
 };
 
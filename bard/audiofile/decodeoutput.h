@@ -32,6 +32,7 @@ public:
     virtual uint8_t **getBuffer(int samples) = 0;
     virtual void written(int samples) = 0;
     virtual void terminate();
+    virtual bool isCancelled() const { return false; };
 
     std::string sampleFormatName() const;
     int channelCount() const { return m_channelCount; };
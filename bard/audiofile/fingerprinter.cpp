@@ -0,0 +1,115 @@
+/*
+    This file is part of Bard (https://github.com/antlarr/bard)
+    Copyright (C) 2017-2019 Antonio Larrosa <antonio.larrosa@gmail.com>
+
+    Bard is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, version 3.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+*/
+
+#include "fingerprinter.h"
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+#include <libavutil/frame.h>
+#include <libavutil/samplefmt.h>
+
+#ifdef __cplusplus
+}
+#endif
+
+#include <algorithm>
+#include <iostream>
+
+Fingerprinter::Fingerprinter(double maxLength)
+    : m_maxLength(maxLength)
+{
+    m_ctx = chromaprint_new(CHROMAPRINT_ALGORITHM_DEFAULT);
+}
+
+Fingerprinter::~Fingerprinter()
+{
+    if (m_ctx)
+        chromaprint_free(m_ctx);
+}
+
+bool Fingerprinter::start(int sampleRate, int channels)
+{
+    m_isValid = m_ctx && chromaprint_start(m_ctx, sampleRate, channels) == 1;
+    m_isLimited = m_maxLength > 0;
+    // Like acoustid.fingerprint, the limit is counted in 16 bit samples
+    if (m_isLimited)
+        m_remainingSamples = static_cast<uint64_t>(sampleRate * channels * m_maxLength);
+    return m_isValid;
+}
+
+void Fingerprinter::feed(const AVFrame *frame)
+{
+    if (!m_isValid || isComplete() || frame->nb_samples <= 0)
+        return;
+
+    AVSampleFormat format = static_cast<AVSampleFormat>(frame->format);
+    if (av_sample_fmt_is_planar(format))
+    {
+        std::cerr << "Error: planar audio can't be fingerprinted" << std::endl;
+        m_isValid = false;
+        return;
+    }
+
+    uint64_t samples = static_cast<uint64_t>(frame->nb_samples) * frame->ch_layout.nb_channels *
+                       av_get_bytes_per_sample(format) / sizeof(int16_t);
+    if (m_isLimited)
+    {
+        samples = std::min(samples, m_remainingSamples);
+        m_remainingSamples -= samples;
+    }
+
+    if (chromaprint_feed(m_ctx, reinterpret_cast<const int16_t *>(frame->data[0]), static_cast<int>(samples)) != 1)
+    {
+        std::cerr << "Error feeding audio to chromaprint" << std::endl;
+        m_isValid = false;
+    }
+}
+
+bool Fingerprinter::finish()
+{
+    if (!m_isValid)
+        return false;
+
+    if (chromaprint_finish(m_ctx) != 1)
+    {
+        m_isValid = false;
+        return false;
+    }
+
+    char *fingerprint = nullptr;
+    if (chromaprint_get_fingerprint(m_ctx, &fingerprint) == 1)
+    {
+        m_fingerprint = fingerprint;
+        chromaprint_dealloc(fingerprint);
+    }
+    else
+        m_isValid = false;
+
+    uint32_t *rawFingerprint = nullptr;
+    int size = 0;
+    if (chromaprint_get_raw_fingerprint(m_ctx, &rawFingerprint, &size) == 1)
+    {
+        m_rawFingerprint.assign(rawFingerprint, rawFingerprint + size);
+        chromaprint_dealloc(rawFingerprint);
+    }
+    else
+        m_isValid = false;
+
+    return m_isValid;
+}
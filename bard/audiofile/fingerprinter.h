@@ -0,0 +1,67 @@
+/*
+    This file is part of Bard (https://github.com/antlarr/bard)
+    Copyright (C) 2017-2019 Antonio Larrosa <antonio.larrosa@gmail.com>
+
+    Bard is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, version 3.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+*/
+
+#ifndef __FINGERPRINTER_H
+#define __FINGERPRINTER_H
+
+#include <string>
+#include <vector>
+#include "common.h"
+
+#include <chromaprint.h>
+
+struct AVFrame;
+
+/*
+ * Fingerprinter calculates the chromaprint fingerprint of the audio while
+ * it's being decoded. Like acoustid.fingerprint, the decoded data is passed
+ * to chromaprint as 16 bit samples, so fingerprints are the same as the
+ * ones calculated in python from the decoded data. Only the first
+ * maxLength seconds are used (all the audio if maxLength is 0).
+ */
+class Fingerprinter
+{
+public:
+    explicit Fingerprinter(double maxLength=0);
+    ~Fingerprinter();
+
+    Fingerprinter(const Fingerprinter &) = delete;
+    Fingerprinter &operator=(const Fingerprinter &) = delete;
+
+    bool start(int sampleRate, int channels);
+    void feed(const AVFrame *frame);
+    bool finish();
+
+    bool isValid() const { return m_isValid; };
+    // Returns true when the maximum length was already fed
+    bool isComplete() const { return m_isLimited && m_remainingSamples == 0; };
+
+    const std::string &fingerprint() const { return m_fingerprint; };
+    const std::vector<uint32_t> &rawFingerprint() const { return m_rawFingerprint; };
+
+protected:
+    ChromaprintContext *m_ctx = nullptr;
+    double m_maxLength = 0;
+    bool m_isLimited = false;
+    uint64_t m_remainingSamples = 0;
+    bool m_isValid = false;
+
+    std::string m_fingerprint;
+    std::vector<uint32_t> m_rawFingerprint;
+};
+
+#endif
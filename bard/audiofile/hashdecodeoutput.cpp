@@ -0,0 +1,143 @@
+/*
+    This file is part of Bard (https://github.com/antlarr/bard)
+    Copyright (C) 2017-2019 Antonio Larrosa <antonio.larrosa@gmail.com>
+
+    Bard is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, version 3.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+*/
+
+#include "hashdecodeoutput.h"
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+#include <libavutil/hash.h>
+#include <libavutil/samplefmt.h>
+
+#ifdef __cplusplus
+}
+#endif
+
+#include <iostream>
+
+static std::string finalHex(AVHashContext *ctx)
+{
+    uint8_t hex[AV_HASH_MAX_SIZE * 2 + 1];
+    av_hash_final_hex(ctx, hex, sizeof(hex));
+    return reinterpret_cast<const char *>(hex);
+}
+
+HashDecodeOutput::HashDecodeOutput(int md5BitsPerSample)
+    : m_md5BitsPerSample(md5BitsPerSample)
+{
+}
+
+HashDecodeOutput::~HashDecodeOutput()
+{
+    av_hash_freep(&m_sha256Ctx);
+    av_hash_freep(&m_md5Ctx);
+}
+
+void HashDecodeOutput::init(int channels, enum AVSampleFormat sampleFmt, int64_t estimatedSamples, int sampleRate)
+{
+    DecodeOutput::init(channels, sampleFmt, estimatedSamples, sampleRate);
+    if (m_isPlanar)
+    {
+        std::cerr << "Error: planar sample formats can't be hashed" << std::endl;
+        m_isValid = false;
+        return;
+    }
+    m_frameSize = channels * m_bytesPerSample;
+
+    if (av_hash_alloc(&m_sha256Ctx, "SHA256") < 0)
+    {
+        m_isValid = false;
+        return;
+    }
+    av_hash_init(m_sha256Ctx);
+
+    if (m_md5BitsPerSample > 0)
+    {
+        // Only integer samples have a FLAC-like MD5 signature
+        bool isInteger = (sampleFmt == AV_SAMPLE_FMT_U8 || sampleFmt == AV_SAMPLE_FMT_S16 ||
+                          sampleFmt == AV_SAMPLE_FMT_S32);
+        if (!isInteger || m_md5BitsPerSample > m_bytesPerSample * 8 ||
+            av_hash_alloc(&m_md5Ctx, "MD5") < 0)
+        {
+            m_md5BitsPerSample = 0;
+            return;
+        }
+        av_hash_init(m_md5Ctx);
+    }
+}
+
+void HashDecodeOutput::prepare(int samples)
+{
+    size_t size = static_cast<size_t>(samples) * m_frameSize;
+    if (size > m_buffer.size())
+        m_buffer.resize(size);
+}
+
+uint8_t **HashDecodeOutput::getBuffer(int samples)
+{
+    m_data[0] = m_buffer.data();
+    return m_data;
+}
+
+void HashDecodeOutput::written(int samples)
+{
+    m_samplesCount += samples;
+    size_t size = static_cast<size_t>(samples) * m_frameSize;
+    av_hash_update(m_sha256Ctx, m_buffer.data(), size);
+    if (m_md5Ctx)
+        updateMD5(m_buffer.data(), samples);
+}
+
+void HashDecodeOutput::updateMD5(const uint8_t *data, int samples)
+{
+    // The decoder returns samples shifted to the most significant bits of
+    // the sample format, so they're shifted back before writing them
+    int outBytes = (m_md5BitsPerSample + 7) / 8;
+    int shift = m_bytesPerSample * 8 - m_md5BitsPerSample;
+    size_t count = static_cast<size_t>(samples) * m_channelCount;
+    m_md5Buffer.resize(count * outBytes);
+    uint8_t *out = m_md5Buffer.data();
+    for (size_t i = 0; i < count; ++i)
+    {
+        int32_t value;
+        switch (m_sampleFmt)
+        {
+            case AV_SAMPLE_FMT_U8:
+                value = static_cast<int32_t>(data[i]) - 0x80;
+                break;
+            case AV_SAMPLE_FMT_S16:
+                value = reinterpret_cast<const int16_t *>(data)[i];
+                break;
+            default:
+                value = reinterpret_cast<const int32_t *>(data)[i];
+                break;
+        }
+        value >>= shift;
+        for (int b = 0; b < outBytes; ++b)
+            *out++ = static_cast<uint8_t>(value >> (8 * b));
+    }
+    av_hash_update(m_md5Ctx, m_md5Buffer.data(), m_md5Buffer.size());
+}
+
+void HashDecodeOutput::terminate()
+{
+    if (m_sha256Ctx)
+        m_sha256 = finalHex(m_sha256Ctx);
+    if (m_md5Ctx)
+        m_md5 = finalHex(m_md5Ctx);
+}
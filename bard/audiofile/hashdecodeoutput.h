@@ -0,0 +1,71 @@
+/*
+    This file is part of Bard (https://github.com/antlarr/bard)
+    Copyright (C) 2017-2019 Antonio Larrosa <antonio.larrosa@gmail.com>
+
+    Bard is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, version 3.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+*/
+
+#ifndef __HASHDECODEOUTPUT_H
+#define __HASHDECODEOUTPUT_H
+
+#include <string>
+#include <vector>
+#include "decodeoutput.h"
+
+struct AVHashContext;
+
+/*
+ * HashDecodeOutput calculates checksums of the decoded audio without
+ * keeping it in memory:
+ *
+ * - The sha256 of the decoded data as returned by decode (so it's the
+ *   same as the audio sha256sum stored in the database).
+ * - Optionally, the md5 of the samples written as little endian integers
+ *   of (md5BitsPerSample + 7) / 8 bytes, which is how FLAC calculates the
+ *   MD5 signature stored in its STREAMINFO block.
+ */
+class HashDecodeOutput : public DecodeOutput
+{
+public:
+    explicit HashDecodeOutput(int md5BitsPerSample=0);
+    ~HashDecodeOutput();
+
+    HashDecodeOutput(const HashDecodeOutput &) = delete;
+    HashDecodeOutput &operator=(const HashDecodeOutput &) = delete;
+
+    virtual void init(int channels, enum AVSampleFormat sampleFmt, int64_t estimatedSamples, int sampleRate);
+    virtual void prepare(int samples);
+    virtual uint8_t **getBuffer(int samples);
+    virtual void written(int samples);
+    virtual void terminate();
+
+    const std::string &sha256() const { return m_sha256; };
+    const std::string &md5() const { return m_md5; };
+
+protected:
+    void updateMD5(const uint8_t *data, int samples);
+
+    int m_md5BitsPerSample = 0;
+    AVHashContext *m_sha256Ctx = nullptr;
+    AVHashContext *m_md5Ctx = nullptr;
+
+    std::vector<uint8_t> m_buffer;
+    std::vector<uint8_t> m_md5Buffer;
+    uint8_t *m_data[1] = {nullptr};
+    int m_frameSize = 0;
+
+    std::string m_sha256;
+    std::string m_md5;
+};
+
+#endif
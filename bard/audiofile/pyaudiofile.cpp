@@ -28,9 +28,13 @@
 
 #include <string>
 #include <iostream>
+#include <vector>
+#include <cstring>
+#include <memory>
 
 #include "audiofile.h"
 #include "bufferdecodeoutput.h"
+#include "hashdecodeoutput.h"
 #include "version.h"
 
 using namespace boost;
@@ -47,7 +51,159 @@ python::dict versions()
     return v;
 }
 
-python::dict extractInfoDict(const AudioFile &audiofile, const BufferDecodeOutput &output)
+/* Decode output which passes the decoded audio to a python object in chunks
+   of chunkSize bytes instead of keeping all of it in memory.
+
+   consumer.start(sample_format, bytes_per_sample, sample_rate, channels) is
+   called before the first chunk and consumer.feed(chunk) with each chunk of
+   interleaved samples. If any of them raises an exception, decoding is
+   cancelled and the exception is raised again by raiseError(). */
+class ChunkDecodeOutput : public DecodeOutput
+{
+public:
+    ChunkDecodeOutput(const python::object &consumer, uint64_t chunkSize)
+        : m_consumer(consumer), m_chunkSize(chunkSize)
+    {
+    }
+
+    ~ChunkDecodeOutput()
+    {
+        Py_XDECREF(m_errorType);
+        Py_XDECREF(m_errorValue);
+        Py_XDECREF(m_errorTraceback);
+    }
+
+    virtual void init(int channels, enum AVSampleFormat sampleFmt, int64_t estimatedSamples, int sampleRate)
+    {
+        DecodeOutput::init(channels, sampleFmt, estimatedSamples, sampleRate);
+        if (m_isPlanar)
+        {
+            PyErr_SetString(PyExc_ValueError, "planar sample formats can't be decoded in chunks");
+            saveError();
+            m_isValid = false;
+            return;
+        }
+        m_frameSize = channels * m_bytesPerSample;
+        m_chunkSize = std::max<uint64_t>(m_chunkSize - m_chunkSize % m_frameSize, m_frameSize);
+
+        try
+        {
+            m_consumer.attr("start")(sampleFormatName(), m_bytesPerSample, sampleRate, channels);
+        }
+        catch (const python::error_already_set &)
+        {
+            saveError();
+            m_isValid = false;
+        }
+    }
+
+    virtual void prepare(int samples)
+    {
+        uint64_t size = m_used + static_cast<uint64_t>(samples) * m_frameSize;
+        if (size > m_buffer.size())
+            m_buffer.resize(size);
+    }
+
+    virtual uint8_t **getBuffer(int samples)
+    {
+        m_data[0] = m_buffer.data() + m_used;
+        return m_data;
+    }
+
+    virtual void written(int samples)
+    {
+        m_samplesCount += samples;
+        if (m_error)
+            return;
+
+        m_used += static_cast<uint64_t>(samples) * m_frameSize;
+        uint64_t offset = 0;
+        while (m_used - offset >= m_chunkSize && !m_error)
+        {
+            feed(m_buffer.data() + offset, m_chunkSize);
+            offset += m_chunkSize;
+        }
+        if (m_error)
+            m_used = 0;
+        else if (offset)
+        {
+            memmove(m_buffer.data(), m_buffer.data() + offset, m_used - offset);
+            m_used -= offset;
+        }
+    }
+
+    virtual void terminate()
+    {
+        if (m_used && !m_error)
+            feed(m_buffer.data(), m_used);
+        m_used = 0;
+    }
+
+    virtual bool isCancelled() const { return m_error; };
+
+    void raiseError()
+    {
+        if (!m_error)
+            return;
+        PyErr_Restore(m_errorType, m_errorValue, m_errorTraceback);
+        m_errorType = m_errorValue = m_errorTraceback = nullptr;
+        m_error = false;
+        python::throw_error_already_set();
+    }
+
+protected:
+    void feed(const uint8_t *data, uint64_t size)
+    {
+        try
+        {
+            python::object chunk(python::handle<>(PyBytes_FromStringAndSize(reinterpret_cast<const char *>(data), size)));
+            m_consumer.attr("feed")(chunk);
+        }
+        catch (const python::error_already_set &)
+        {
+            saveError();
+        }
+    }
+
+    void saveError()
+    {
+        PyErr_Fetch(&m_errorType, &m_errorValue, &m_errorTraceback);
+        m_error = true;
+    }
+
+    python::object m_consumer;
+    uint64_t m_chunkSize;
+    uint64_t m_frameSize = 1;
+    std::vector<uint8_t> m_buffer;
+    uint64_t m_used = 0;
+    uint8_t *m_data[1] = { nullptr };
+
+    bool m_error = false;
+    PyObject *m_errorType = nullptr;
+    PyObject *m_errorValue = nullptr;
+    PyObject *m_errorTraceback = nullptr;
+};
+
+uint64_t decodedSamples(const AudioFile &audiofile, const BufferDecodeOutput &output)
+{
+    if (output.samplesCount() != 0)
+        return output.samplesCount();
+
+    Py_ssize_t size;
+    if (output.isPlanar())
+        size = output.channelCount() * output.lineSize();
+    else
+        size = output.size();
+    return size / (output.bytesPerSample() * audiofile.channels());
+}
+
+uint64_t decodedSamples(const AudioFile &audiofile, const ChunkDecodeOutput &output)
+{
+    return output.samplesCount();
+}
+
+template <class Output>
+python::dict extractInfoDict(const AudioFile &audiofile, const Output &output)
 {
     python::dict info;
     info["library_versions"] = versions();
@@ -69,19 +225,7 @@ python::dict extractInfoDict(const AudioFile &audiofile, const BufferDecodeOutpu
         info["decoded_duration"] = output.duration();
         info["decoded_sample_rate"] = output.sampleRate();
         info["decoded_channels"] = output.channelCount();
-        if (output.samplesCount() != 0)
-        {
-            info["samples"] = output.samplesCount();
-        }
-        else
-        {
-            Py_ssize_t size;
-            if (output.isPlanar())
-                size = output.channelCount() * output.lineSize();
-            else
-                size = output.size();
-            info["samples"] = size / (output.bytesPerSample() * audiofile.channels());
-        }
+        info["samples"] = decodedSamples(audiofile, output);
         info["is_planar"] = output.isPlanar();
     }
 
@@ -91,6 +235,31 @@ python::dict extractInfoDict(const AudioFile &audiofile, const BufferDecodeOutpu
     return info;
 }
 
+void addFingerprintToInfoDict(python::dict &info, const Fingerprinter &fingerprinter)
+{
+    if (!fingerprinter.isValid())
+    {
+        info["fingerprint"] = python::object();
+        info["raw_fingerprint"] = python::object();
+        return;
+    }
+
+    const std::string &fingerprint = fingerprinter.fingerprint();
+    info["fingerprint"] = python::object(python::handle<>(
+        PyBytes_FromStringAndSize(fingerprint.c_str(), fingerprint.size())));
+
+    // The raw fingerprint is returned as little endian 32 bit values, like
+    // they're stored in the database
+    std::vector<uint32_t> raw = fingerprinter.rawFingerprint();
+#if __BYTE_ORDER__ == __ORDER_BIG_ENDIAN__
+    for (auto &value: raw)
+        value = __builtin_bswap32(value);
+#endif
+    info["raw_fingerprint"] = python::object(python::handle<>(
+        PyBytes_FromStringAndSize(reinterpret_cast<const char *>(raw.data()),
+                                  raw.size() * sizeof(uint32_t))));
+}
+
 python::object convertToPythonBytes(const BufferDecodeOutput &output)
 {
     Py_ssize_t size;
@@ -104,16 +273,90 @@ python::object convertToPythonBytes(const BufferDecodeOutput &output)
     return bytes;
 }
 
+/*
+ * DecodedAudio objects own the BufferDecodeOutput with the decoded audio
+ * and export the same bytes that convertToPythonBytes copies through the
+ * (read-only) buffer protocol, so they can be used with hashlib,
+ * numpy.frombuffer, memoryview, etc. without copying the audio.
+ */
+struct DecodedAudioObject
+{
+    PyObject_HEAD
+    BufferDecodeOutput *output;
+    char *data;
+    Py_ssize_t size;
+};
+
+static void DecodedAudio_dealloc(PyObject *self)
+{
+    delete reinterpret_cast<DecodedAudioObject *>(self)->output;
+    Py_TYPE(self)->tp_free(self);
+}
+
+static int DecodedAudio_getbuffer(PyObject *self, Py_buffer *view, int flags)
+{
+    DecodedAudioObject *audio = reinterpret_cast<DecodedAudioObject *>(self);
+    return PyBuffer_FillInfo(view, self, audio->data, audio->size, 1, flags);
+}
+
+static Py_ssize_t DecodedAudio_length(PyObject *self)
+{
+    return reinterpret_cast<DecodedAudioObject *>(self)->size;
+}
+
+static PyBufferProcs DecodedAudio_as_buffer = {DecodedAudio_getbuffer, nullptr};
+static PySequenceMethods DecodedAudio_as_sequence = {DecodedAudio_length};
+static PyTypeObject DecodedAudioType = {PyVarObject_HEAD_INIT(nullptr, 0)};
+
+static bool initDecodedAudioType()
+{
+    DecodedAudioType.tp_name = "bard_audiofile.DecodedAudio";
+    DecodedAudioType.tp_doc = "Decoded audio data supporting the buffer protocol";
+    DecodedAudioType.tp_basicsize = sizeof(DecodedAudioObject);
+    DecodedAudioType.tp_flags = Py_TPFLAGS_DEFAULT;
+    DecodedAudioType.tp_dealloc = DecodedAudio_dealloc;
+    DecodedAudioType.tp_as_buffer = &DecodedAudio_as_buffer;
+    DecodedAudioType.tp_as_sequence = &DecodedAudio_as_sequence;
+    return PyType_Ready(&DecodedAudioType) == 0;
+}
+
+python::object convertToDecodedAudio(std::unique_ptr<BufferDecodeOutput> output)
+{
+    DecodedAudioObject *audio = PyObject_New(DecodedAudioObject, &DecodedAudioType);
+    if (!audio)
+        python::throw_error_already_set();
+
+    if (output->isPlanar())
+        audio->size = output->channelCount() * output->lineSize();
+    else
+        audio->size = output->size();
+    audio->data = reinterpret_cast<char *>(output->data());
+    audio->output = output.release();
+
+    return python::object(python::handle<>(reinterpret_cast<PyObject *>(audio)));
+}
+
+python::object decodedData(std::unique_ptr<BufferDecodeOutput> output, bool as_buffer)
+{
+    if (as_buffer)
+        return convertToDecodedAudio(std::move(output));
+
+    return convertToPythonBytes(*output);
+}
+
 python::tuple decode_from_data(const char *buffer, Py_ssize_t length, long sample_rate=0,
                                const std::string &sample_fmt=std::string(),
-                               long channel_number=0, const std::string &channel_layout=std::string())
+                               long channel_number=0, const std::string &channel_layout=std::string(),
+                               bool as_buffer=false)
 {
 #ifdef DEBUG
     std::cout << "decode_from_data" << std::endl;
 #endif
     AudioFile audiofile;
-    BufferDecodeOutput output;
+    std::unique_ptr<BufferDecodeOutput> output(new BufferDecodeOutput);
 
+    // Decode without the GIL so python threads can decode files in parallel
+    Py_BEGIN_ALLOW_THREADS
     audiofile.open(buffer, length, "");
     if (sample_rate)
         audiofile.setOutSampleRate(sample_rate);
@@ -123,24 +366,28 @@ python::tuple decode_from_data(const char *buffer, Py_ssize_t length, long sampl
         audiofile.setOutChannelLayout(channel_layout);
     else if (channel_number > 0)
         audiofile.setOutChannels(channel_number);
-    audiofile.setOutput(&output);
+    audiofile.setOutput(output.get());
     audiofile.decode();
+    Py_END_ALLOW_THREADS
 
-    python::dict info = extractInfoDict(audiofile, output);
+    python::dict info = extractInfoDict(audiofile, *output);
 
-    return python::make_tuple(convertToPythonBytes(output), info);
+    return python::make_tuple(decodedData(std::move(output), as_buffer), info);
 }
 
 python::tuple decode_from_file(const std::string &path, long sample_rate=0,
                                const std::string &sample_fmt=std::string(),
-                               long channel_number=0, const std::string &channel_layout=std::string())
+                               long channel_number=0, const std::string &channel_layout=std::string(),
+                               bool as_buffer=false)
 {
 #ifdef DEBUG
     std::cout << "decode_from_file" << std::endl;
 #endif
     AudioFile audiofile;
-    BufferDecodeOutput output;
+    std::unique_ptr<BufferDecodeOutput> output(new BufferDecodeOutput);
 
+    // Decode without the GIL so python threads can decode files in parallel
+    Py_BEGIN_ALLOW_THREADS
     audiofile.open(path);
     if (sample_rate)
         audiofile.setOutSampleRate(sample_rate);
@@ -151,12 +398,13 @@ python::tuple decode_from_file(const std::string &path, long sample_rate=0,
     else if (channel_number > 0)
         audiofile.setOutChannels(channel_number);
 
-    audiofile.setOutput(&output);
+    audiofile.setOutput(output.get());
     audiofile.decode();
+    Py_END_ALLOW_THREADS
 
-    python::dict info = extractInfoDict(audiofile, output);
+    python::dict info = extractInfoDict(audiofile, *output);
 
-    return boost::python::make_tuple(convertToPythonBytes(output), info);
+    return boost::python::make_tuple(decodedData(std::move(output), as_buffer), info);
 }
 
 boost::python::object decode(const boost::python::object &path,
@@ -165,7 +413,8 @@ boost::python::object decode(const boost::python::object &path,
                              const boost::python::object &sample_fmt,
                              const boost::python::object &channel_number,
                              const boost::python::object &channel_layout,
-                             const boost::python::object &use_tmp_file)
+                             const boost::python::object &use_tmp_file,
+                             const boost::python::object &as_buffer)
 {
 #ifdef DEBUG
     std::cout << "decode" << std::endl;
@@ -176,6 +425,7 @@ boost::python::object decode(const boost::python::object &path,
         throw std::invalid_argument("invalid arguments");
     }
     bool use_temporary_file = PyObject_IsTrue(use_tmp_file.ptr());
+    bool cas_buffer = PyObject_IsTrue(as_buffer.ptr());
     long csample_rate = 0;
     std::string csample_fmt;
     long cchannel_number = 0;
@@ -204,7 +454,7 @@ boost::python::object decode(const boost::python::object &path,
         if (r < 0)
             return boost::python::object();
 
-        return decode_from_data(buffer, length, csample_rate, csample_fmt, cchannel_number, cchannel_layout);
+        return decode_from_data(buffer, length, csample_rate, csample_fmt, cchannel_number, cchannel_layout, cas_buffer);
     }
     else if (path && !path.is_none())
     {
@@ -218,7 +468,7 @@ boost::python::object decode(const boost::python::object &path,
         }
         std::string str_path = boost::python::extract<std::string>(path);
 
-        return decode_from_file(str_path, csample_rate, csample_fmt, cchannel_number, cchannel_layout);
+        return decode_from_file(str_path, csample_rate, csample_fmt, cchannel_number, cchannel_layout, cas_buffer);
     }
 
     throw std::invalid_argument("invalid arguments. Must set path or data");
@@ -226,6 +476,82 @@ boost::python::object decode(const boost::python::object &path,
 
 }
 
+boost::python::object decode_chunks(const boost::python::object &consumer,
+                                    const boost::python::object &path,
+                                    const boost::python::object &data,
+                                    const boost::python::object &sample_rate,
+                                    const boost::python::object &sample_fmt,
+                                    const boost::python::object &channel_number,
+                                    const boost::python::object &channel_layout,
+                                    const boost::python::object &chunk_size,
+                                    const boost::python::object &fingerprint_length)
+{
+#ifdef DEBUG
+    std::cout << "decode_chunks" << std::endl;
+#endif
+    if ((path.is_none() && data.is_none()) ||
+        (!path.is_none() && !data.is_none()))
+    {
+        throw std::invalid_argument("invalid arguments");
+    }
+    uint64_t cchunk_size = 1 << 20;
+    if (!chunk_size.is_none() && PyLong_Check(chunk_size.ptr()))
+        cchunk_size = std::max(PyLong_AsLong(chunk_size.ptr()), 1L);
+
+    double cfingerprint_length = -1;
+    if (!fingerprint_length.is_none())
+        cfingerprint_length = boost::python::extract<double>(fingerprint_length);
+
+    AudioFile audiofile;
+    ChunkDecodeOutput output(consumer, cchunk_size);
+    std::unique_ptr<Fingerprinter> fingerprinter;
+    if (cfingerprint_length >= 0)
+        fingerprinter.reset(new Fingerprinter(cfingerprint_length));
+
+    if (!data.is_none())
+    {
+        if (!PyBytes_Check(data.ptr()))
+        {
+            throw std::invalid_argument("data must be of bytes type");
+        }
+
+        char *buffer;
+        Py_ssize_t length;
+        int r = PyBytes_AsStringAndSize(data.ptr(), &buffer, &length);
+        if (r < 0)
+            return boost::python::object();
+
+        audiofile.open(buffer, length, "");
+    }
+    else
+    {
+        if (!PyUnicode_Check(path.ptr()))
+        {
+            throw std::invalid_argument("path must be of str type");
+        }
+        audiofile.open(boost::python::extract<std::string>(path));
+    }
+
+    if (!sample_rate.is_none() && PyLong_Check(sample_rate.ptr()))
+        audiofile.setOutSampleRate(PyLong_AsLong(sample_rate.ptr()));
+    if (!sample_fmt.is_none() && PyUnicode_Check(sample_fmt.ptr()))
+        audiofile.setOutSampleFormat(boost::python::extract<std::string>(sample_fmt));
+    if (!channel_layout.is_none() && PyUnicode_Check(channel_layout.ptr()))
+        audiofile.setOutChannelLayout(boost::python::extract<std::string>(channel_layout));
+    else if (!channel_number.is_none() && PyLong_Check(channel_number.ptr()))
+        audiofile.setOutChannels(PyLong_AsLong(channel_number.ptr()));
+
+    audiofile.setOutput(&output);
+    audiofile.setFingerprinter(fingerprinter.get());
+    audiofile.decode();
+    output.raiseError();
+
+    python::dict info = extractInfoDict(audiofile, output);
+    if (fingerprinter)
+        addFingerprintToInfoDict(info, *fingerprinter);
+    return info;
+}
+
 struct LogRecordList_to_python_list
 {
     static PyObject *convert(std::vector<AudioFile::LogRecord> const &x)
@@ -315,18 +641,156 @@ boost::python::object get_properties(const boost::python::object &path,
     return python::object();
 }
 
-BOOST_PYTHON_FUNCTION_OVERLOADS(decode_overloads, decode, 7, 7);
+boost::python::object audio_stream_checksum(const boost::python::object &path,
+                                            const boost::python::object &data)
+{
+#ifdef DEBUG
+    std::cout << "audio_stream_checksum" << std::endl;
+#endif
+    if ((path.is_none() && data.is_none()) ||
+        (!path.is_none() && !data.is_none()))
+    {
+        throw std::invalid_argument("invalid arguments");
+    }
+
+    char *buffer = nullptr;
+    Py_ssize_t length = 0;
+    std::string str_path;
+    if (!data.is_none())
+    {
+        if (!PyBytes_Check(data.ptr()))
+        {
+            throw std::invalid_argument("data must be of bytes type");
+        }
+
+        int r = PyBytes_AsStringAndSize(data.ptr(), &buffer, &length);
+        if (r < 0)
+            return boost::python::object();
+    }
+    else
+    {
+        if (!PyUnicode_Check(path.ptr()))
+        {
+            throw std::invalid_argument("path must be of str type");
+        }
+        str_path = boost::python::extract<std::string>(path);
+    }
+
+    AudioFile audiofile;
+    std::string checksum;
+    int err;
+
+    // Read the packets without the GIL, like audio_checksums
+    Py_BEGIN_ALLOW_THREADS
+    if (buffer)
+        err = audiofile.open(buffer, length, "");
+    else
+        err = audiofile.open(str_path);
+    if (err == 0)
+        err = audiofile.audioStreamChecksum(checksum);
+    Py_END_ALLOW_THREADS
+
+    if (err != 0)
+        return boost::python::object();
+
+    return boost::python::object(checksum);
+}
+
+boost::python::object audio_checksums(const boost::python::object &path,
+                                      const boost::python::object &data,
+                                      int md5_bits_per_sample)
+{
+#ifdef DEBUG
+    std::cout << "audio_checksums" << std::endl;
+#endif
+    if ((path.is_none() && data.is_none()) ||
+        (!path.is_none() && !data.is_none()))
+    {
+        throw std::invalid_argument("invalid arguments");
+    }
+
+    char *buffer = nullptr;
+    Py_ssize_t length = 0;
+    std::string str_path;
+    if (!data.is_none())
+    {
+        if (!PyBytes_Check(data.ptr()))
+        {
+            throw std::invalid_argument("data must be of bytes type");
+        }
+
+        int r = PyBytes_AsStringAndSize(data.ptr(), &buffer, &length);
+        if (r < 0)
+            return boost::python::object();
+    }
+    else
+    {
+        if (!PyUnicode_Check(path.ptr()))
+        {
+            throw std::invalid_argument("path must be of str type");
+        }
+        str_path = boost::python::extract<std::string>(path);
+    }
+
+    AudioFile audiofile;
+    HashDecodeOutput output(md5_bits_per_sample);
+    int err;
+
+    // The file is decoded without the GIL so several files can be checked
+    // in parallel from python threads
+    Py_BEGIN_ALLOW_THREADS
+    if (buffer)
+        err = audiofile.open(buffer, length, "");
+    else
+        err = audiofile.open(str_path);
+    if (err == 0)
+    {
+        audiofile.setOutput(&output);
+        err = audiofile.decode();
+    }
+    Py_END_ALLOW_THREADS
+
+    if (err != 0 || !output.isValid())
+        return boost::python::object();
+
+    python::dict checksums;
+    checksums["sha256"] = output.sha256();
+    if (output.md5().empty())
+        checksums["md5"] = python::object();
+    else
+        checksums["md5"] = output.md5();
+    checksums["samples"] = output.samplesCount();
+    return checksums;
+}
+
+BOOST_PYTHON_FUNCTION_OVERLOADS(decode_overloads, decode, 8, 8);
+BOOST_PYTHON_FUNCTION_OVERLOADS(decode_chunks_overloads, decode_chunks, 9, 9);
 BOOST_PYTHON_FUNCTION_OVERLOADS(get_properties_overloads, get_properties, 2, 2);
+BOOST_PYTHON_FUNCTION_OVERLOADS(audio_stream_checksum_overloads, audio_stream_checksum, 2, 2);
+BOOST_PYTHON_FUNCTION_OVERLOADS(audio_checksums_overloads, audio_checksums, 3, 3);
 
 BOOST_PYTHON_MODULE(bard_audiofile)
 {
 
     using namespace python;
+    if (!initDecodedAudioType())
+        throw_error_already_set();
+    Py_INCREF(&DecodedAudioType);
+    scope().attr("DecodedAudio") = object(handle<>(reinterpret_cast<PyObject *>(&DecodedAudioType)));
+
     def("decode", decode, decode_overloads((python::arg("path")=object(), python::arg("data")=object(),
                                             python::arg("sample_rate")=object(), python::arg("sample_fmt")=object(),
                                             python::arg("channel_number")=object(), python::arg("channel_layout")=object(),
-                                            python::arg("use_tmp_file")=object())));
+                                            python::arg("use_tmp_file")=object(), python::arg("as_buffer")=false)));
+    def("decode_chunks", decode_chunks, decode_chunks_overloads((python::arg("consumer"), python::arg("path")=object(),
+                                                                 python::arg("data")=object(), python::arg("sample_rate")=object(),
+                                                                 python::arg("sample_fmt")=object(), python::arg("channel_number")=object(),
+                                                                 python::arg("channel_layout")=object(), python::arg("chunk_size")=object(),
+                                                                 python::arg("fingerprint_length")=object())));
     def("get_properties", get_properties, get_properties_overloads((python::arg("path")=object(), python::arg("data")=object())));
+    def("audio_stream_checksum", audio_stream_checksum, audio_stream_checksum_overloads((python::arg("path")=object(), python::arg("data")=object())));
+    def("audio_checksums", audio_checksums, audio_checksums_overloads((python::arg("path")=object(), python::arg("data")=object(),
+                                                                       python::arg("md5_bits_per_sample")=0)));
     def("versions", versions);
 
     to_python_converter< std::vector<AudioFile::LogRecord>, LogRecordList_to_python_list>();
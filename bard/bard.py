@@ -1,16 +1,26 @@
 from bard.utils import fixTags, calculateFileSHA256, printSongsInfo, \
-    fingerprint_AudioSegment, alignColumns, decodeAudio, \
-    calculateSHA256_data, formatLength, colorizeTime, colorizeAll
+    fingerprint_AudioSegment, alignColumns, formatLength, colorizeTime, \
+    colorizeAll, calculateAudioStreamSHA256
 from bard.song import Song, Ratings, DifferentLengthException, \
     CantCompareSongsException
 from bard.song_utils import print_song_info
 from bard.musicdatabase import MusicDatabase
-from bard.musicdatabase_songs import getMusic, getSongs, getSongsAtPath, \
-    getSongsFromIDorPath
+from bard.musicdatabase_songs import getMusic, iterMusic, getSongs, \
+    getSongsAtPath, getSongsFromIDorPath, iterMusicByIDs
 from bard.terminalcolors import TerminalColors
 from bard.terminalkeyboard import ask_user_to_choose_one_option
 from bard.comparesongs import compareSongSets
 from bard.backup import backupMusic
+from bard.similaritywriter import SimilarityWriter
+from bard.songwriter import SongWriter
+from bard.scrubscheduler import ScrubScheduler
+from bard.similarityshards import runSimilarityShard, \
+    mergeSimilarityShards, parseShard
+from bard.similarityservice import SimilarityServiceClient, \
+    runSimilarityService
+from bard.importworkers import analyzeSongFiles, calculateDRFiles, \
+    checkAudioFiles, calculateFileChecksums
+from bard.watcher import LibraryWatcher
 from bard import __version__
 import chromaprint
 from collections import namedtuple
@@ -166,6 +176,50 @@ def compare_AudioSegments(audio1, audio2, showAudioOffsets=True):
     return (offset, similarity)
 
 
+def configureOffsetSearch(fpm, mode=None):
+    """Set the offset search mode of a FingerprintManager.
+
+    If mode is None, the offset_search_mode config value is used.
+    """
+    from bard.bard_ext import OffsetSearchMode
+    modes = {'exhaustive': OffsetSearchMode.Exhaustive,
+             'coarse': OffsetSearchMode.Coarse}
+    if mode is None:
+        mode = config.config['offset_search_mode']
+    try:
+        fpm.setOffsetSearchMode(modes[mode])
+    except KeyError:
+        raise ValueError(f'Unknown offset search mode: {mode} (it should be '
+                         'one of: ' + ', '.join(modes) + ')')
+    fpm.setCoarseStep(config.config['coarse_offset_step'])
+    fpm.setCoarseCandidates(config.config['coarse_offset_candidates'])
+
+
+def importJobs(jobs=None):
+    """Return the number of processes to use to analyze files."""
+    if jobs is None:
+        jobs = config.config['import_jobs']
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
+    return jobs
+
+
+def createLookupFingerprintManager():
+    """Return a FingerprintManager to find songs similar to a file."""
+    from bard.bard_ext import FingerprintManager
+    fpm = FingerprintManager()
+    fpm.setMaxOffset(100)
+    fpm.setCancelThreshold(config.config['match_threshold'])
+    fpm.setShortSongCancelThreshold(
+        config.config['short_song_store_threshold'])
+    fpm.setShortSongLength(config.config['short_song_length'])
+    fpm.setThreadCount(config.config['fingerprint_threads'])
+    fpm.setDurationTolerance(config.config['duration_tolerance'])
+    fpm.setUseIndex(True)
+    configureOffsetSearch(fpm)
+    return fpm
+
+
 def normalizeDate(date):
     if type(date) == int:
         return date
@@ -214,6 +268,7 @@ class Bard:
         self.excludeDirectories = []
         self.playlist_manager = None
         self.songMTimeCache = {}
+        self.directoryScans = ({}, [])
 
         config.load_configuration()
         if config.config is None:
@@ -280,24 +335,41 @@ class Bard:
         return []
 
     def addSong(self, path, rootDir=None, removedSongsAudioSHA256={},
-                mtime=None, commit=True, verbose=False):
+                mtime=None, commit=True, verbose=False, analysis=None,
+                interactive=True, writer=None, isSongInDatabase=None,
+                tryMetadataUpdate=True):
+        """Add or update the song at path in the database.
+
+        isSongInDatabase can be the result of MusicDatabase.isSongInDatabase
+        for path if the caller already got it. If tryMetadataUpdate is
+        False, a song in the database is analyzed again without checking
+        first if only its metadata changed (because the caller already did).
+        """
         if config.config['immutable_database']:
             print("Error: Can't add song %s : "
                   "The database is configured as immutable" % path)
             return None, None
-        isSongInDatabase = MusicDatabase.isSongInDatabase(path, file_mtime=mtime)
+        if isSongInDatabase is None:
+            isSongInDatabase = MusicDatabase.isSongInDatabase(path,
+                                                              file_mtime=mtime)
         if isSongInDatabase == 1:
             #if verbose:
             #    print('Already in db: %s' % path)
             return None, None
         elif isSongInDatabase == -1:
+            songID = (self.updateSongMetadata(path, rootDir)
+                      if tryMetadataUpdate else None)
+            if songID:
+                if commit:
+                    MusicDatabase.commit()
+                return songID, 'updated'
             print(f'Updating song {path}')
             songStatus = 'updated'
         else:
             print(f'Adding song {path}')
             songStatus = 'new'
 
-        song = Song(path, rootDir=rootDir)
+        song = Song(path, rootDir=rootDir, analysis=analysis)
         if not song.isValid:
             msg = f'Song {path} is not valid'
             raise Exception(msg)
@@ -308,7 +380,12 @@ class Bard:
             pass
         else:
             if not MusicDatabase.songExistsInDatabase(path=song.path()):
-                if len(removedSongs) > 1:
+                sameName = [x for x in removedSongs
+                            if os.path.basename(x.path()) ==
+                            os.path.basename(path)]
+                if len(removedSongs) > 1 and len(sameName) == 1:
+                    removedSong = sameName[0]
+                elif len(removedSongs) > 1 and interactive:
                     msg = f'Choose the removed song that was moved to {path}:'
                     options = [song.path() for song in removedSongs]
                     selected = ask_user_to_choose_one_option(options, msg)
@@ -316,7 +393,9 @@ class Bard:
                 else:
                     removedSong = removedSongs[0]
 
-                song.moveFrom(removedSong)
+                if song.moveFrom(removedSong):
+                    # It can't be moved again to another file
+                    removedSongs.remove(removedSong)
                 songStatus = 'renamed'
             else:
                 removedPaths = '\n'.join([x.path() for x in removedSongs])
@@ -324,6 +403,11 @@ class Bard:
                       'being updated but was already in database, so the '
                       'removed song(s) won\'t be moved to it.')
                 removedSong = None
+        if writer:
+            # The song is added to the database when the writer is flushed
+            writer.add(song, songStatus)
+            return None, songStatus
+
         MusicDatabase.addSong(song)
 
         if commit:
@@ -332,8 +416,29 @@ class Bard:
         return song.id, songStatus
 
 
+    def updateSongMetadata(self, path, rootDir=None):
+        """Update a song in the database without decoding it if possible.
+
+        If the audio stream checksum of the file is the one stored in the
+        database, only its metadata changed (for example, it was retagged),
+        so only the tags, cover, mtime and file checksum are updated.
+        Returns the song ID if it was updated or None if the song has to be
+        analyzed again.
+        """
+        songID, audioStreamSha256sum = \
+            MusicDatabase.getAudioStreamSha256sum(path)
+        if not audioStreamSha256sum or \
+                calculateAudioStreamSHA256(path) != audioStreamSha256sum:
+            return None
+
+        print(f'Updating metadata of song {path}')
+        song = Song(path, rootDir=rootDir, metadata_only=True)
+        song.id = songID
+        MusicDatabase.updateSongMetadata(song)
+        return songID
+
     def addDirectoryRecursively(self, directory, verbose=False,
-                                removedSongsSHA256={}):
+                                removedSongsSHA256={}, jobs=1):
         if config.config['immutable_database']:
             print("Error: Can't add directory %s : "
                   "The database is configured as immutable" % directory)
@@ -341,6 +446,17 @@ class Bard:
         songsIDs = {'new': [], 'updated': [], 'renamed': []}
         if not directory.endswith('/'):
             directory += '/'
+        if jobs > 1:
+            files = [(os.path.join(dirpath, filename), mtime)
+                     for dirpath in sorted(self.songMTimeCache.keys())
+                     if dirpath.startswith(directory)
+                     for filename, mtime
+                     in sorted(self.songMTimeCache[dirpath].items())]
+            return self.addFilesInParallel(files, directory, jobs,
+                                           removedSongsSHA256, verbose)
+        # Analyzed songs are written and committed in batches by the
+        # writer. Songs whose metadata is updated are returned by addSong
+        writer = SongWriter()
         for dirpath in sorted(self.songMTimeCache.keys()):
             if not dirpath.startswith(directory):
                 continue
@@ -354,15 +470,63 @@ class Bard:
                 path = os.path.join(dirpath, filename)
                 id_, songStatus = self.addSong(path, rootDir=directory,
                                    removedSongsAudioSHA256=removedSongsSHA256,
-                                   mtime=mtime, commit=True, verbose=verbose)
+                                   mtime=mtime, commit=False, verbose=verbose,
+                                   writer=writer)
                 if id_:
                     songsIDs[songStatus].append(id_)
-            MusicDatabase.commit()
+                    if len(songsIDs[songStatus]) % writer.max_size == 0:
+                        MusicDatabase.commit()
+        writer.flush()
+        MusicDatabase.commit()
+        for songStatus, ids in writer.songIDs.items():
+            songsIDs[songStatus].extend(ids)
 
         return songsIDs
 
+    def addFilesInParallel(self, files, rootDir, jobs,
+                           removedSongsAudioSHA256={}, verbose=False):
+        """Add files (a list of (path, mtime) tuples) using jobs processes.
 
-    def add(self, args, verbose=False, removedSongsAudioSHA256={}):
+        The files are decoded and analyzed in worker processes while songs
+        are added to the database in the same order as files from this
+        process, which writes and commits them in batches.
+        """
+        songsIDs = {'new': [], 'updated': [], 'renamed': []}
+        batch_size = 100
+        pending = []
+        for path, mtime in files:
+            isSongInDatabase = MusicDatabase.isSongInDatabase(path,
+                                                              file_mtime=mtime)
+            if isSongInDatabase == 1:
+                continue
+            if isSongInDatabase == -1:
+                # Songs whose audio didn't change are updated here and
+                # don't need to be analyzed
+                id_ = self.updateSongMetadata(path, rootDir)
+                if id_:
+                    songsIDs['updated'].append(id_)
+                    if len(songsIDs['updated']) % batch_size == 0:
+                        MusicDatabase.commit()
+                    continue
+            pending.append((path, isSongInDatabase))
+        status = dict(pending)
+        writer = SongWriter(batch_size)
+        for path, analysis in analyzeSongFiles([path for path, _ in pending],
+                                               jobs):
+            self.addSong(path, rootDir=rootDir,
+                         removedSongsAudioSHA256=removedSongsAudioSHA256,
+                         verbose=verbose, analysis=analysis, writer=writer,
+                         isSongInDatabase=status[path],
+                         tryMetadataUpdate=False)
+        writer.flush()
+        MusicDatabase.commit()
+        for songStatus, ids in writer.songIDs.items():
+            songsIDs[songStatus].extend(ids)
+
+        return songsIDs
+
+
+    def add(self, args, verbose=False, removedSongsAudioSHA256={}, jobs=1):
         songsIDs = {'new': [], 'updated': [], 'renamed': []}
         for arg in args:
             if os.path.isfile(arg):
@@ -376,42 +540,95 @@ class Bard:
                     print('Adding directory recursively:', arg)
                 r = self.addDirectoryRecursively(os.path.normpath(arg),
                                                  verbose,
-                                                 removedSongsAudioSHA256)
+                                                 removedSongsAudioSHA256,
+                                                 jobs=jobs)
                 if r:
                     songsIDs['new'].extend(r['new'])
                     songsIDs['updated'].extend(r['updated'])
                     songsIDs['renamed'].extend(r['renamed'])
         return songsIDs
 
-    def cacheFiles(self, paths, verbose=False):
-        cache_by_dir = {}
+    def cacheFiles(self, paths, verbose=False, trustDirMtime=False):
+        """Return the mtime of the files in paths by directory.
+
+        The state of each directory (its mtime, number of files and the
+        time its files were last stat'ed) is stored in the database. With
+        trustDirMtime, the files of directories whose state didn't change
+        are not stat'ed and the mtimes stored in the database are used
+        instead. Modifying a file in place doesn't change the mtime of its
+        directory, so directories whose files were stat'ed more than
+        full_rescan_interval_days ago are always scanned again.
+
+        The new state of the scanned directories is kept in
+        self.directoryScans and only stored by update after the songs in
+        them are added, so new files aren't skipped if it fails.
+        """
         mtime_cache = {}
+        dirScans = MusicDatabase.getDirectoryScans()
+        newScans = {}
+        seen = set()
+        maxAge = config.config['full_rescan_interval_days'] * 86400
+        now = time.time()
+        trusted = 0
 
         for directory in paths:
+            # Directories are stat'ed before listing them, so changes done
+            # while they're scanned are detected in the next update
+            dirMtimes = {directory: os.stat(directory).st_mtime_ns}
             for dirpath, direntries, fileentries in walktree(directory):
                 for entry in direntries[:]:
                     if entry.name in self.excludeDirectories:
                         direntries.remove(entry)
-
-                files_mtime = {}
-                for entry in fileentries:
-                    if any(fnmatch.fnmatch(entry.name.lower(), pattern)
-                           for pattern in self.ignore_files):
-                        continue
-
-                    files_mtime[entry.name] = entry.stat().st_mtime
+                    else:
+                        dirMtimes[entry.path] = entry.stat().st_mtime_ns
+
+                names = [entry.name for entry in fileentries
+                         if not any(fnmatch.fnmatch(entry.name.lower(),
+                                                    pattern)
+                                    for pattern in self.ignore_files)]
+                dirMtime = dirMtimes.pop(dirpath)
+                key = os.path.normpath(dirpath)
+                seen.add(key)
+                scan = dirScans.get(key)
+                # A directory modified in the same second it was scanned
+                # may have changed again without changing its mtime
+                if (trustDirMtime and scan and
+                        scan[:2] == (dirMtime, len(names)) and
+                        scan[2] - dirMtime / 1e9 > 1 and
+                        now - scan[2] < maxAge):
+                    files_mtime = {}
+                    for name in names:
+                        mtime = MusicDatabase.getSongMtime(
+                            os.path.join(dirpath, name))
+                        if mtime is not None:
+                            files_mtime[name] = mtime
+                    trusted += 1
+                else:
+                    files_mtime = {entry.name: entry.stat().st_mtime
+                                   for entry in fileentries
+                                   if entry.name in names}
+                    newScans[key] = (dirMtime, len(names), now)
 
                 mtime_cache[dirpath] = files_mtime
 
+        roots = [os.path.normpath(directory) for directory in paths]
+        removed = [path for path in dirScans if path not in seen and
+                   any(path == root or path.startswith(root + '/')
+                       for root in roots)]
+        self.directoryScans = (newScans, removed)
+        if verbose:
+            print('Scanned %d directories, trusted the mtime of %d' %
+                  (len(newScans), trusted))
+
         return mtime_cache
 
 
-    def update(self, paths, verbose=False):
+    def update(self, paths, verbose=False, jobs=1, trustDirMtime=False):
         if verbose:
             t_init = time.time()
             print("pre cacheFiles...")
 
-        self.songMTimeCache = self.cacheFiles(paths, verbose)
+        self.songMTimeCache = self.cacheFiles(paths, verbose, trustDirMtime)
 
         removedSongIDs = set()
         removedSongs = []
@@ -444,17 +661,15 @@ class Bard:
             print("adding...", paths)
 
         songIDs = self.add(paths, verbose=verbose,
-                       removedSongsAudioSHA256=removedSongsAudioSHA256)
+                       removedSongsAudioSHA256=removedSongsAudioSHA256,
+                       jobs=jobs)
         if verbose:
             t_4 = time.time()
             print("added", t_4 - t_3, t_4 - t_init)
 
-        for song in removedSongs:
-            if not song.fileExists():
-                print('Removing song', song.path())
-                self.db.removeSong(song)
-
-        MusicDatabase.removeOrphanAlbums()
+        deletedSongIDs = self.removeMissingSongs(removedSongs)
+        MusicDatabase.updateDirectoryScans(*self.directoryScans)
+        MusicDatabase.commit()
         if verbose:
             t_5 = time.time()
             print("removed things", t_5 - t_4, t_5 - t_init)
@@ -474,6 +689,131 @@ class Bard:
         print(f'Total songs renamed: {len(songIDs["renamed"])}')
         print(f'Total songs removed: {len(removedSongs) - len(songIDs["renamed"])}')
 
+        if ids or deletedSongIDs:
+            self.notifySimilarityService(ids, deletedSongIDs)
+
+    def removeMissingSongs(self, removedSongs):
+        """Remove the songs whose files don't exist and their albums.
+
+        Songs that were renamed to a new path are kept. Returns the IDs
+        of the removed songs.
+        """
+        deletedSongIDs = []
+        for song in removedSongs:
+            if not song.fileExists():
+                print('Removing song', song.path())
+                self.db.removeSong(song)
+                deletedSongIDs.append(song.id)
+
+        MusicDatabase.removeOrphanAlbums()
+        return deletedSongIDs
+
+    def updateDirectories(self, directories, roots, verbose=False):
+        """Update the songs in directories (not recursively).
+
+        Songs below the directories that don't exist anymore are removed
+        unless they were moved to one of the other directories.
+        """
+        roots = [os.path.normpath(root) for root in roots]
+        files = []
+        removedSongs = []
+        for directory in directories:
+            if os.path.isdir(directory):
+                songs = [song for song in getSongsAtPath(directory + '/')
+                         if os.path.dirname(song.path()) == directory]
+                for entry in sorted(os.scandir(directory),
+                                    key=lambda x: x.name):
+                    if not entry.is_file() or \
+                            any(fnmatch.fnmatch(entry.name.lower(), pattern)
+                                for pattern in self.ignore_files):
+                        continue
+                    files.append((entry.path, entry.stat().st_mtime))
+            else:
+                songs = [song for song in getSongsAtPath(directory + '/')
+                         if song.path().startswith(directory + '/')]
+            removedSongs.extend(song for song in songs
+                                if not song.fileExists())
+        if verbose:
+            print(f'Updating {len(files)} files in {directories}')
+
+        removedSongsAudioSHA256 = {}
+        for song in removedSongs:
+            removedSongsAudioSHA256.setdefault(song.audioSha256sum(),
+                                               []).append(song)
+        # The paths of moved songs are changed when they're added
+        changedPaths = ([path for path, _ in files] +
+                        [song.path() for song in removedSongs])
+
+        songIDs = {'new': [], 'updated': [], 'renamed': []}
+        for path, mtime in files:
+            root = next((root for root in roots
+                         if path.startswith(root + '/')), None)
+            if root is None:
+                continue
+            try:
+                id_, songStatus = self.addSong(
+                    path, rootDir=root + '/',
+                    removedSongsAudioSHA256=removedSongsAudioSHA256,
+                    mtime=mtime, verbose=verbose, interactive=False)
+            except Exception as e:
+                # Keep watching if a file can't be added
+                print(f'Error adding {path}: {e}')
+                MusicDatabase.getConnection().rollback()
+                continue
+            if id_:
+                songIDs[songStatus].append(id_)
+
+        deletedSongIDs = self.removeMissingSongs(removedSongs)
+        MusicDatabase.commit()
+        MusicDatabase.updateMtimeCache(changedPaths)
+
+        ids = songIDs['new'] + songIDs['updated'] + songIDs['renamed']
+        if ids or deletedSongIDs:
+            MusicBrainzDatabase.updateMusicBrainzIDs(ids)
+            MusicDatabase.refresh_album_tables()
+            print(f'Songs added: {len(songIDs["new"])}, '
+                  f'updated: {len(songIDs["updated"])}, '
+                  f'renamed: {len(songIDs["renamed"])}, '
+                  f'removed: {len(deletedSongIDs)}')
+            self.notifySimilarityService(ids, deletedSongIDs)
+
+    def watch(self, verbose=False, trustDirMtime=False):
+        """Update the database when files change in the music paths."""
+        roots = config.config['music_paths']
+        watcher = LibraryWatcher(roots, self.excludeDirectories,
+                                 config.config['watch_debounce_seconds'])
+        try:
+            # Catch up with the changes done while bard wasn't watching
+            self.update(roots, verbose=verbose, trustDirMtime=trustDirMtime)
+            MusicDatabase.updateMtimeCache()
+            print('Watching for changes...')
+            while True:
+                watcher.readEvents(timeout=1)
+                if watcher.overflowed:
+                    # Events were lost, so all directories are checked
+                    print('The inotify event queue overflowed. '
+                          'Updating all music paths')
+                    watcher.overflowed = False
+                    watcher.pending.clear()
+                    watcher.watchRoots()
+                    self.update(roots, verbose=verbose)
+                    MusicDatabase.updateMtimeCache()
+                    continue
+
+                directories = watcher.takeReadyDirectories()
+                if directories:
+                    self.updateDirectories(directories, roots, verbose)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+
+    def notifySimilarityService(self, added, removed):
+        try:
+            SimilarityServiceClient().notifyUpdate(added, removed)
+        except (OSError, RuntimeError) as e:
+            print(f'Error notifying the similarity service: {e}')
+
     def info(self, ids_or_paths, currentlyPlaying=False, show_analysis=False,
              show_decode_messages=False, verbose=False):
         songs = []
@@ -547,6 +887,29 @@ class Bard:
                 else:
                     print("%s" % song.path())
 
+    def listDuplicates(self, songID=None, long_ls=False):
+        if songID:
+            clusters = MusicDatabase.getSongDuplicates(songID)
+        else:
+            clusters = MusicDatabase.getDuplicateClusters()
+        lastClusterID = None
+        for clusterID, songID, path, is_best in clusters:
+            if clusterID != lastClusterID:
+                print('------  cluster %d' % clusterID)
+                lastClusterID = clusterID
+            if long_ls:
+                subprocess.run(['ls', '-l', path])
+            else:
+                print('%s%s' % (path, ' (best)' if is_best else ''))
+
+    def rebuildDuplicateClusters(self):
+        clusters = MusicDatabase.rebuildDuplicateClusters()
+        if clusters is None:
+            return
+        MusicDatabase.commit()
+        songs = sum(len(songs) for songs in clusters.values())
+        print(f'{len(clusters)} duplicate clusters with {songs} songs')
+
     def play(self, ids_or_paths, shuffle, query=None):
         paths = []
         if not ids_or_paths and query:
@@ -560,7 +923,7 @@ class Bard:
             random.shuffle(paths)
         elif shuffle:
             total_songs = 30
-            songs = getMusic('')
+            songs = iterMusic()
             probabilities = []
             userID = MusicDatabase.getUserID(config.config['username'])
             Ratings.cache_all_ratings()
@@ -587,24 +950,24 @@ class Bard:
         subprocess.run(command)
 
     def findDuplicates(self):
-        collection = getMusic()
         hashes = {}
-        for song in collection:
+        for song in iterMusic(metadata=True):
             if song.audioSha256sum() not in hashes:
-                hashes[song.audioSha256sum()] = [song]
+                hashes[song.audioSha256sum()] = [song.id]
             else:
                 # print('Duplicate hash found:',
                 #       hashes[song.audioSha256sum()], song)
-                hashes[song.audioSha256sum()].append(song)
-        for h, songs in hashes.items():
-            if len(songs) > 1:
+                hashes[song.audioSha256sum()].append(song.id)
+        for h, songIDs in hashes.items():
+            if len(songIDs) > 1:
                 # sortSongsList (first song with most tags,symlinks at the end)
-                for song in songs:
+                for songID in songIDs:
+                    song = getSongs(songID=songID, metadata=True)[0]
                     print(song)
                     print(song._path)
 
     def fixMtime(self):
-        collection = getMusic()
+        collection = iterMusic()
         count = 0
         for song in collection:
             if not song.mtime():
@@ -656,20 +1019,20 @@ class Bard:
             sha256sum = song.audioSha256sum()
             song.calculateSilences(threshold, min_length)
 
-            sha256sum_pydub = song.audioSha256sum()
+            decoded_sha256sum = song.audioSha256sum()
             if ((song.path().endswith('flac') or
                  song.path().endswith('ape') or
                  song.path().endswith('.wv')) and
-                    sha256sum != sha256sum_pydub):
+                    sha256sum != decoded_sha256sum):
                 print('Error: sha256 does not match: %s != %s' %
-                      (sha256sum, sha256sum_pydub))
+                      (sha256sum, decoded_sha256sum))
 
             silence1 = silence_at_start if silence_at_start is not None else song.silenceAtStart()
             silence2 = silence_at_end if silence_at_end is not None else song.silenceAtEnd()
 
             if not dry_run:
                 MusicDatabase.addAudioSilences(song.id, silence1, silence2)
-                MusicDatabase.addAudioTrackSha256sum(song.id, sha256sum_pydub)
+                MusicDatabase.addAudioTrackSha256sum(song.id, decoded_sha256sum)
 
             count += 1
             if count % 10:
@@ -706,32 +1069,68 @@ class Bard:
                     print('File not found: %s' % filepath)
                 callback(song)
 
-    def fixChecksums(self, from_song_id=None, removeMissingFiles=False):
+    def songsToScrub(self, from_song_id=None):
+        """Return a dict with an iterator over the songs to check per root.
+
+        Songs are returned ordered by the last time they were checked,
+        with songs never checked first. The order is read once per root
+        when the iteration starts, so songs checked while iterating aren't
+        returned again. If from_song_id is given, songs are returned by id
+        starting from it instead.
+        """
+        roots = [root for root, _ in MusicDatabase.getRoots()]
         if from_song_id:
-            collection = getMusic("WHERE id >= :id",
-                                  {'id': int(from_song_id)},
-                                  order_by='id')
+            return {root: iterMusic('WHERE root = :root AND id >= :id',
+                                    {'root': root, 'id': int(from_song_id)},
+                                    metadata=True)
+                    for root in roots}
+
+        c = MusicDatabase.getCursor()
+        sql = ('SELECT id FROM songs LEFT JOIN checksums ON song_id = id '
+               'WHERE root = :root '
+               "ORDER BY COALESCE(last_check_time, '1970-01-01'), id")
+        result = {}
+        for root in roots:
+            songIDs = [x[0] for x in
+                       c.execute(text(sql), {'root': root}).fetchall()]
+            result[root] = iterMusicByIDs(songIDs, metadata=True)
+        return result
+
+    def checksumScrubScheduler(self, jobs=1, maxMinutes=None, maxGiB=None):
+        return ScrubScheduler(jobs, config.config['scrub_jobs_per_device'],
+                              max_seconds=(maxMinutes * 60
+                                           if maxMinutes is not None
+                                           else None),
+                              max_bytes=(int(maxGiB * 2**30)
+                                         if maxGiB is not None else None))
+
+    def scrubError(self, song, error, removeMissingFiles=False):
+        if not isinstance(error, FileNotFoundError):
+            print('Error checking %s: %s' % (song.path(), error))
+        elif removeMissingFiles:
+            print('Removing file: %s' % song.path())
+            self.db.removeSong(song)
         else:
-            collection = getMusic(order_by='id')
-        count = 0
-        for song in collection:
-            if not song.fileExists():
-                if removeMissingFiles:
-                    print('Removing file: %s' % song.path())
-                    self.db.removeSong(song)
-                else:
-                    print('Missing file at %s' % song.path())
+            print('Missing file at %s' % song.path())
 
+    def fixChecksums(self, from_song_id=None, removeMissingFiles=False,
+                     jobs=1, maxMinutes=None, maxGiB=None):
+        scheduler = self.checksumScrubScheduler(jobs, maxMinutes, maxGiB)
+        collection = self.songsToScrub(from_song_id)
+        count = 0
+        for song, checksums, error in scheduler.run(collection,
+                                                    calculateFileChecksums):
+            if error:
+                self.scrubError(song, error, removeMissingFiles)
                 continue
+            (audioSha256sumInDisk, audioStreamSha256sum, sha256InDisk,
+             properties) = checksums
 
             print('Calculating checksums for %s...' % song.path(), end='',
                   flush=True)
             # check the audio checksum
             audioSha256sumInDB = song.audioSha256sum()
 
-            audiodata, properties = decodeAudio(song.path())
-            audioSha256sumInDisk = calculateSHA256_data(audiodata)
-
             if audioSha256sumInDB != audioSha256sumInDisk:
                 MusicDatabase.addAudioTrackSha256sum(song.id,
                                                      audioSha256sumInDisk)
@@ -739,11 +1138,12 @@ class Bard:
             else:
                 changed_audiosha256 = False
 
+            if song.audioStreamSha256sum() != audioStreamSha256sum:
+                MusicDatabase.addAudioStreamSha256sum(song.id,
+                                                      audioStreamSha256sum)
+
             # check the file checksum
-            # print('. File sha from db', end='', flush=True)
             sha256InDB = song.fileSha256sum()
-            # print('/disk', end='', flush=True)
-            sha256InDisk = calculateFileSHA256(song.path())
             if sha256InDB != sha256InDisk:
                 MusicDatabase.addFileSha256sum(song.id, sha256InDisk)
                 changed_filesha256 = True
@@ -774,50 +1174,60 @@ class Bard:
                 (MusicDatabase.createSongHistoryEntry(song.id,
                  audio_sha256sum=audioSha256sumInDisk,
                  sha256sum=sha256InDisk, description=desc))
-                count += 1
-                if count % 10 == 0:
-                    MusicDatabase.commit()
             else:
                 print(TerminalColors.Ok + 'OK' + TerminalColors.ENDC)
-                count += 1
-                if count % 10 == 0:
-                    MusicDatabase.commit()
+            count += 1
+            if count % 10 == 0:
+                MusicDatabase.commit()
 
+        scheduler.printSummary()
+        MusicDatabase.addChecksumScrubs('fix-checksums',
+                                        scheduler.statistics())
         MusicDatabase.commit()
         print('done')
 
-    def checkChecksums(self, from_song_id=None, removeMissingFiles=False):
-        if from_song_id:
-            collection = getMusic("WHERE id >= :id",
-                                  {'id': int(from_song_id)})
-        else:
-            collection = getMusic()
+    def checkChecksums(self, from_song_id=None, removeMissingFiles=False,
+                       jobs=1, maxMinutes=None, maxGiB=None):
+        """Check that the files of songs weren't modified.
+
+        Files are read in parallel, starting with the ones whose checksum
+        was checked the longest time ago. The time of the check is stored
+        for each file that didn't change, so running it with a time or size
+        limit checks a different part of the collection each time.
+        """
+        scheduler = self.checksumScrubScheduler(jobs, maxMinutes, maxGiB)
+        collection = self.songsToScrub(from_song_id)
+        storeCheckTime = not config.config['immutable_database']
         failedSongs = []
-        for song in collection:
-            if not song.fileExists():
-                if removeMissingFiles:
-                    print('Removing file: %s' % song.path())
-                    self.db.removeSong(song)
-                else:
-                    print('Missing file at %s' % song.path())
-
+        count = 0
+        for song, sha256InDisk, error in scheduler.run(collection,
+                                                       calculateFileSHA256):
+            if error:
+                self.scrubError(song, error, removeMissingFiles)
                 continue
             sha256InDB = song.fileSha256sum()
             if not sha256InDB:
-                print('Calculating SHA256sum for %s' % song.path())
-                sha256InDisk = calculateFileSHA256(song.path())
+                print('Calculated SHA256sum for %s' % song.path())
                 MusicDatabase.addFileSha256sum(song.id, sha256InDisk)
-                MusicDatabase.commit()
+            elif sha256InDB == sha256InDisk:
+                print('Checking %s ... ' % song.path() +
+                      TerminalColors.Ok + 'OK' + TerminalColors.ENDC)
+                if storeCheckTime:
+                    MusicDatabase.updateFileSha256sumLastCheckTime(song.id)
             else:
-                print('Checking %s ... ' % song.path(), end=' ', flush=True)
-                sha256InDisk = calculateFileSHA256(song.path())
-                if sha256InDB == sha256InDisk:
-                    print(TerminalColors.Ok + 'OK' + TerminalColors.ENDC)
-                else:
-                    print(TerminalColors.Error + 'FAIL' + TerminalColors.ENDC +
-                          ' (db contains %s, disk is %s)' %
-                          (sha256InDB, sha256InDisk))
-                    failedSongs.append((song, sha256InDB, sha256InDisk))
+                print('Checking %s ... ' % song.path() +
+                      TerminalColors.Error + 'FAIL' + TerminalColors.ENDC +
+                      ' (db contains %s, disk is %s)' %
+                      (sha256InDB, sha256InDisk))
+                failedSongs.append((song, sha256InDB, sha256InDisk))
+            count += 1
+            if count % 10 == 0:
+                MusicDatabase.commit()
+        scheduler.printSummary()
+        if storeCheckTime:
+            MusicDatabase.addChecksumScrubs('check-checksums',
+                                            scheduler.statistics())
+        MusicDatabase.commit()
 
         if failedSongs:
             print('Failed songs:')
@@ -828,6 +1238,77 @@ class Bard:
             print('All packages successfully checked: ' +
                   TerminalColors.Ok + 'OK' + TerminalColors.ENDC)
 
+    def checkAudio(self, from_song_id=None, jobs=1):  # noqa: C901
+        """Check that the audio of the imported files is not corrupted.
+
+        Files with an embedded audio checksum (the MD5 signature of FLAC
+        files) are decoded and checked against it, which also detects
+        files that were already corrupted when they were imported. The
+        embedded checksum is stored in the database the first time it's
+        found, so a modified one is detected too. Other files are checked
+        against the sha256 of the decoded audio calculated on import.
+        """
+        if from_song_id:
+            collection = iterMusic("WHERE id >= :id",
+                                   {'id': int(from_song_id)})
+        else:
+            collection = iterMusic()
+        songs = {}
+
+        def paths():
+            for song in collection:
+                if not song.fileExists():
+                    print('Missing file at %s' % song.path())
+                    continue
+                songs[song.path()] = song
+                yield song.path()
+
+        failedSongs = []
+        stored = 0
+        for path, (embeddedMD5, checksums) in checkAudioFiles(paths(), jobs):
+            song = songs.pop(path)
+            print('Checking %s ... ' % path, end=' ', flush=True)
+            if checksums is None:
+                error = "audio can't be decoded"
+            elif embeddedMD5:
+                md5InDB = song.embeddedAudioMD5sum()
+                if not md5InDB:
+                    MusicDatabase.addEmbeddedAudioMD5sum(song.id, embeddedMD5)
+                    stored += 1
+                    if stored % 100 == 0:
+                        MusicDatabase.commit()
+                    md5InDB = embeddedMD5
+                if md5InDB != embeddedMD5:
+                    error = ('embedded md5 is %s, db contains %s' %
+                             (embeddedMD5, md5InDB))
+                elif checksums['md5'] != embeddedMD5:
+                    error = ('audio md5 is %s, embedded md5 is %s' %
+                             (checksums['md5'], embeddedMD5))
+                else:
+                    error = None
+            elif checksums['sha256'] != song.audioSha256sum():
+                error = ('audio sha256 is %s, db contains %s' %
+                         (checksums['sha256'], song.audioSha256sum()))
+            else:
+                error = None
+
+            if error:
+                print(TerminalColors.Error + 'FAIL' + TerminalColors.ENDC +
+                      ' (%s)' % error)
+                failedSongs.append((song, error))
+            else:
+                print(TerminalColors.Ok + 'OK' + TerminalColors.ENDC)
+        if stored:
+            MusicDatabase.commit()
+
+        if failedSongs:
+            print('Failed songs:')
+            for song, error in failedSongs:
+                print('%d %s (%s)' % (song.id, song.path(), error))
+        else:
+            print('All songs successfully checked: ' +
+                  TerminalColors.Ok + 'OK' + TerminalColors.ENDC)
+
     def fixTags(self, args):
         for path in args:
             if not os.path.isfile(path):
@@ -842,7 +1323,9 @@ class Bard:
                 self.addSong(path)
 
     def findAudioDuplicates(self, from_song_id=None, songs=[],
-                            verbose=False):  # noqa: C901
+                            verbose=False, exhaustive=False,
+                            threads=None, shard=None,
+                            shard_dir=None, verifyStore=False):  # noqa: C901
         c = MusicDatabase.getCursor()
         info = {}
         print_stats = True
@@ -892,16 +1375,33 @@ class Bard:
             print('Preparing data structures... ', end='')
         percentage = ''
         from bard.bard_ext import FingerprintManager
+        from bard.fingerprint_store import openFingerprintStore
+        store = openFingerprintStore(verify=True, verifyAll=verifyStore,
+                                     verbose=verbose)
         fpm = FingerprintManager()
+        fpm.setStore(store)
         fpm.setMaxOffset(100)
         fpm.setCancelThreshold(storeThreshold)
         fpm.setShortSongCancelThreshold(shortSongStoreThreshold)
         fpm.setShortSongLength(shortSongLength)
+        # Unless an exhaustive search is requested, use an inverted index
+        # of fingerprint frames to select the songs to compare with
+        fpm.setUseIndex(not exhaustive)
+        if threads is None:
+            threads = config.config['fingerprint_threads']
+        fpm.setThreadCount(threads)
+        fpm.setDurationTolerance(config.config['duration_tolerance'])
+        configureOffsetSearch(fpm)
+        if shard is not None:
+            return runSimilarityShard(fpm, store, shard_dir, *shard,
+                                      from_song_id, verbose=verbose)
+        # Similarities are written to the database in batches
+        similarityWriter = SimilarityWriter()
         speeds = []
         songs_processed = 0
         totalSongsCount = MusicDatabase.getSongsCount()
         fpm.setExpectedSize(totalSongsCount + 5)
-        sql = ('SELECT id, fingerprint, sha256sum, audio_sha256sum, path, '
+        sql = ('SELECT id, sha256sum, audio_sha256sum, path, '
                'completeness, duration-silence_at_start-silence_at_end '
                'FROM fingerprints, songs, checksums, properties '
                'WHERE songs.id=fingerprints.song_id and '
@@ -929,13 +1429,12 @@ class Bard:
         # fpm, we compare the song being added just to songs in
         # incremental_song_ids_to_compare and add/remove them to/from the
         # database.
-        for (songID, fingerprint, sha256sum, audioSha256sum, path,
+        # Fingerprints are taken from the fingerprint store (passing None
+        # to fpm methods) so they don't need to be decoded again.
+        for (songID, sha256sum, audioSha256sum, path,
                 completeness, duration) in result.fetchall():
             # print('.', songID, end='', flush=True)
-            if not isinstance(fingerprint, bytes):
-                fingerprint = fingerprint.tobytes()
-            dfp = chromaprint.decode_fingerprint(fingerprint)
-            if not dfp[0]:
+            if not store.contains(songID):
                 print("Error calculating fingerprint of song %s (%s)" %
                       (songID, path))
                 songs_processed += 1
@@ -944,10 +1443,10 @@ class Bard:
             if songID < from_song_id and songID not in songs:
                 if incremental_song_ids_to_compare:
                     start_time = time.time()
-                    result = (fpm.addSongAndCompareToSongList(songID, dfp[0],
+                    result = (fpm.addSongAndCompareToSongList(songID, None,
                               duration, incremental_song_ids_to_compare))
                 else:
-                    fpm.addSong(songID, dfp[0], duration)
+                    fpm.addSong(songID, None, duration)
                     result = []
                 tmp = '%d%% ' % (songID * 100.0 / from_song_id)
                 if tmp != percentage:
@@ -959,7 +1458,7 @@ class Bard:
                     print(('\b' * len(percentage)) + '100%')
                     print('Calculating song similarities...')
                 start_time = time.time()
-                result = fpm.addSongAndCompare(songID, dfp[0], duration)
+                result = fpm.addSongAndCompare(songID, None, duration)
                 if songID in songs:
                     incremental_song_ids_to_compare.append(songID)
             result.sort(key=lambda x: x[0])
@@ -978,7 +1477,7 @@ class Bard:
                                      if x < songID and x not in similar_ids]
 
                 for x in ids_not_found:
-                    MusicDatabase.removeSongsSimilarity(x, songID)
+                    similarityWriter.remove(x, songID)
 
             for (songID2, offset, similarity) in result:
                 match = '*******' if similarity > matchThreshold else ''
@@ -989,8 +1488,7 @@ class Bard:
                                               offset, similarity, match))
                 if delete_not_found_similarities:
                     print(percentage, end='', flush=True)
-                MusicDatabase.addSongsSimilarity(songID2, songID,
-                                                 offset, similarity)
+                similarityWriter.add(songID2, songID, offset, similarity)
 
                 if similarity >= matchThreshold:
                     # print('''Duplicates found!\n''',
@@ -1016,9 +1514,7 @@ class Bard:
                         #       'and %s' % (msg, otherPath, path))
             songs_processed += 1
             info[songID] = (sha256sum, audioSha256sum, path, completeness)
-            if result:
-                MusicDatabase.commit()
-            elif start_time and not incremental_song_ids_to_compare:
+            if not result and start_time and not incremental_song_ids_to_compare:
                 print(f'No match found for song {songID}: {path}')
 
             if print_stats and start_time:
@@ -1041,11 +1537,14 @@ class Bard:
                           (delta_time, len(info), totalSongsCount, speeds[-1],
                            avg, totalSongsCount - songs_processed, now + d))
 
-        fpm.writeToFile(os.path.expanduser('~/.cache/bard-fpm.cache'))
-
+        similarityWriter.flush()
         if delete_not_found_similarities:
             print(('\b' * len(percentage)) + '100% . Done')
-            MusicDatabase.commit()
+
+        if verbose:
+            print(f'Compared {fpm.comparedPairsCount()} pairs of songs '
+                  f'({fpm.prunedPairsCount()} pairs skipped because their '
+                  'durations are too different)')
 
     def compareSongs(self, song1, song2, verbose=False,  # noqa: C901
                      showAudioOffsets=False, storeInDB=False,
@@ -1219,25 +1718,7 @@ class Bard:
         song_fingerprint = song.getAcoustidFingerprint()
         song_dfp = chromaprint.decode_fingerprint(song_fingerprint)
 
-        from_song_id = MusicDatabase \
-            .lastSongIDWithCalculatedSimilarities()
-        from_song_id = from_song_id + 1 if from_song_id else 1
-
-        info = {}
         matchThreshold = config.config['match_threshold']
-        shortSongStoreThreshold = config.config['short_song_store_threshold']
-        shortSongLength = config.config['short_song_length']
-        from bard.bard_ext import FingerprintManager
-        fpm = FingerprintManager()
-        fpm.setMaxOffset(100)
-        fpm.setCancelThreshold(matchThreshold)
-        fpm.setShortSongCancelThreshold(shortSongStoreThreshold)
-        fpm.setShortSongLength(shortSongLength)
-
-        percentage = ''
-        songs_processed = 0
-        totalSongsCount = MusicDatabase.getSongsCount()
-        fpm.setExpectedSize(totalSongsCount + 5)
         c = MusicDatabase.getCursor()
 
         def getInfo(songID):
@@ -1251,46 +1732,18 @@ class Bard:
             result = c.execute(text(sql).bindparams(song_id=songID))
             return result.fetchone()
 
-        useCache = True
-        if useCache:
-            fpm.readFromFile(os.path.expanduser('~/.cache/bard-fpm.cache'))
-            maxSongID = max(fpm.songIDs())
-            completeness = song.getCompleteness()
-        else:
-            sql = ('SELECT id, fingerprint, sha256sum, audio_sha256sum, path, '
-                   'completeness, duration-silence_at_start-silence_at_end '
-                   'FROM fingerprints, songs, checksums, properties '
-                   'WHERE songs.id=fingerprints.song_id and '
-                   'songs.id = checksums.song_id and '
-                   'songs.id = properties.song_id order by id')
-
-            result = c.execute(text(sql))
-            maxSongID = 0
-            for (songID, fingerprint, sha256sum, audioSha256sum, path,
-                    completeness, duration) in result.fetchall():
-                maxSongID = max(maxSongID, songID)
-                info[songID] = (sha256sum, audioSha256sum, path, completeness,
-                                duration)
-                # print('.', songID, end='', flush=True)
-                if not isinstance(fingerprint, bytes):
-                    fingerprint = fingerprint.tobytes()
-                dfp = chromaprint.decode_fingerprint(fingerprint)
-                if not dfp[0]:
-                    print("Error calculating fingerprint of song %s (%s)" %
-                          (songID, path))
-                    songs_processed += 1
-                    continue
-
-                fpm.addSong(songID, dfp[0], duration)
-                result = []
-                tmp = '%d%% ' % (songID * 100.0 / from_song_id)
-                if tmp != percentage:
-                    backspaces = '\b' * len(percentage)
-                    percentage = tmp
-                    print(backspaces + percentage, end='', flush=True)
-
-        result = fpm.addSongAndCompare(maxSongID + 1, song_dfp[0],
-                                       song_duration)
+        # Use the similarity service if it's running to avoid loading all
+        # fingerprints
+        result = SimilarityServiceClient().match(song_dfp[0], song_duration)
+        if result is None:
+            from bard.fingerprint_store import openFingerprintStore
+            store = openFingerprintStore()
+            fpm = createLookupFingerprintManager()
+            fpm.setStore(store)
+            fpm.setExpectedSize(MusicDatabase.getSongsCount())
+            fpm.addSongsFromStore()
+            result = fpm.compareFingerprint(song_dfp[0], song_duration)
+        completeness = song.getCompleteness()
         sha256sum = song.fileSha256sum()
         audioSha256sum = song.audioSha256sum()
 
@@ -1301,12 +1754,8 @@ class Bard:
         for (songID2, offset, similarity) in \
                 sorted(result, key=lambda x: -x[2]):
             if show_all or similarity >= matchThreshold:
-                try:
-                    (otherSha256sum, otherAudioSha256sum, otherPath,
-                        otherCompleteness, otherDuration) = info[songID2]
-                except KeyError:
-                    (otherSha256sum, otherAudioSha256sum, otherPath,
-                        otherCompleteness, otherDuration) = getInfo(songID2)
+                (otherSha256sum, otherAudioSha256sum, otherPath,
+                    otherCompleteness, otherDuration) = getInfo(songID2)
 
                 print('%d (similarity: %f) %s' % (songID2, similarity,
                                                   otherPath))
@@ -1329,33 +1778,122 @@ class Bard:
                     self.info([songID2])
                     first = False
 
-    def calculateDR(self, ids_or_paths, force_recalculate=True):
-        collection = []
+    def checkOffsetSearch(self, sample_size=1000, verbose=False):
+        """Compare the coarse offset search with the exhaustive one.
+
+        A sample of the similarities stored in the database is calculated
+        again using both modes to measure the accuracy and speed of the
+        coarse offset search.
+        """
+        from bard.bard_ext import FingerprintManager
+        from bard.fingerprint_store import openFingerprintStore
+        c = MusicDatabase.getCursor()
+        sql = text('SELECT song_id1, song_id2, match_offset, similarity '
+                   'FROM similarities ORDER BY random() LIMIT :limit')
+        pairs = c.execute(sql.bindparams(limit=sample_size)).fetchall()
+        sql = ('SELECT song_id, duration-silence_at_start-silence_at_end '
+               'FROM properties')
+        durations = dict(c.execute(text(sql)).fetchall())
+
+        store = openFingerprintStore()
+        pairs = [pair for pair in pairs
+                 if store.contains(pair[0]) and store.contains(pair[1])]
+        if not pairs:
+            print('There are no similarities to check in the database')
+            return
+
+        fpm = FingerprintManager()
+        fpm.setStore(store)
+        fpm.setMaxOffset(100)
+        fpm.setCancelThreshold(config.config['store_threshold'])
+        fpm.setShortSongCancelThreshold(
+            config.config['short_song_store_threshold'])
+        fpm.setShortSongLength(config.config['short_song_length'])
+        for songID in sorted({songID for pair in pairs
+                              for songID in pair[:2]}):
+            fpm.addSong(songID, None, durations[songID])
+
+        def compareAll(mode):
+            configureOffsetSearch(fpm, mode)
+            start_time = time.time()
+            result = [fpm.compareSongs(songID1, songID2)
+                      for songID1, songID2, _, _ in pairs]
+            return result, time.time() - start_time
+
+        exhaustive, exhaustive_time = compareAll('exhaustive')
+        coarse, coarse_time = compareAll('coarse')
+
+        matchThreshold = config.config['match_threshold']
+        equal_to_stored = 0
+        same_offset = 0
+        matches = 0
+        missed_matches = 0
+        max_difference = 0
+        for ((songID1, songID2, offset, similarity),
+             (exhaustive_offset, exhaustive_similarity),
+             (coarse_offset, coarse_similarity)) in zip(pairs, exhaustive,
+                                                        coarse):
+            if (exhaustive_offset == offset and
+                    abs(exhaustive_similarity - similarity) < 1e-6):
+                equal_to_stored += 1
+            if coarse_offset == exhaustive_offset:
+                same_offset += 1
+            elif verbose:
+                print(f'{songID1} {songID2}: exhaustive offset '
+                      f'{exhaustive_offset} ({exhaustive_similarity:f}), '
+                      f'coarse offset {coarse_offset} '
+                      f'({coarse_similarity:f})')
+            max_difference = max(max_difference,
+                                 exhaustive_similarity - coarse_similarity)
+            if exhaustive_similarity >= matchThreshold:
+                matches += 1
+                if coarse_similarity < matchThreshold:
+                    missed_matches += 1
+
+        count = len(pairs)
+        print(f'Similarities checked: {count}')
+        print(f'Exhaustive search equal to stored similarity: '
+              f'{equal_to_stored} ({equal_to_stored * 100 / count:.2f}%)')
+        print(f'Coarse search with the same offset: {same_offset} '
+              f'({same_offset * 100 / count:.2f}%)')
+        print(f'Maximum similarity lost: {max_difference:f}')
+        print(f'Matches missed by the coarse search: {missed_matches} of '
+              f'{matches}')
+        print(f'Exhaustive search: {exhaustive_time:.3f} seconds. '
+              f'Coarse search: {coarse_time:.3f} seconds '
+              f'({exhaustive_time / max(coarse_time, 1e-9):.2f}x faster)')
+
+    def calculateDR(self, ids_or_paths, force_recalculate=True, jobs=1):
         if force_recalculate:
-            for path in ids_or_paths:
-                song = Song(path)
-                print(f'DR: {song.dr14}')
-                print(f'Peak dB: {song.db_peak:0.3f}')
-                print(f'RMS dB: {song.db_rms:0.3f}')
+            for path, (dr14, db_peak, db_rms) in \
+                    calculateDRFiles(ids_or_paths, jobs):
+                print(path)
+                print(f'DR: {dr14}')
+                print(f'Peak dB: {db_peak:0.3f}')
+                print(f'RMS dB: {db_rms:0.3f}')
             return
 
+        collection = []
         for id_or_path in ids_or_paths:
             collection.extend(getSongsFromIDorPath(id_or_path))
 
+        missing = {}
         for song in collection:
-            print(song.id, song.path())
             try:
                 song.loadDRData()
-            except:
-                try:
-                    song.calculateDR()
-                except NameError:
-                    return
+            except Exception:
+                missing[song.path()] = song
+
+        for path, r in calculateDRFiles(list(missing), jobs):
+            (missing[path].dr14, missing[path].db_peak,
+             missing[path].db_rms) = r
+
+        for song in collection:
+            print(song.id, song.path())
             print(f'DR: {song.dr14}')
             print(f'Peak dB: {song.db_peak:0.3f}')
             print(f'RMS dB: {song.db_rms:0.3f}')
 
-
     def listGenres(self, id_or_paths=None, root=None, quoted_output=False):
         ids = []
         paths = []
@@ -1605,6 +2143,20 @@ class Bard:
         print(f'Fixing ratings for user {user_id}...')
         MusicDatabase.add_null_ratings(user_id, from_song_id, verbose)
 
+    def backfillDecodedFingerprints(self, verbose=False):
+        songIDs = MusicDatabase.songIDsWithoutDecodedFingerprints()
+        print(f'Decoding fingerprints of {len(songIDs)} songs...')
+        batch_size = 1000
+        for i in range(0, len(songIDs), batch_size):
+            fingerprints = MusicDatabase.getEncodedFingerprints(
+                songIDs[i:i + batch_size])
+            for songID, fingerprint in fingerprints.items():
+                MusicDatabase.updateDecodedFingerprint(songID, fingerprint)
+            MusicDatabase.commit()
+            if verbose:
+                print(f'{min(i + batch_size, len(songIDs))} of '
+                      f'{len(songIDs)} fingerprints decoded')
+
     def addArtistPath(self, path, image_filename=None, verbose=False):
         mbidfile = os.path.join(path, '.artist_mbid')
         mbids = [x.strip('\n') for x in open(mbidfile).readlines()]
@@ -1721,8 +2273,13 @@ class Bard:
             help='''The following commands are available:
 init                initializes the database
 find-duplicates     find duplicate files comparing the checksums
-find-audio-duplicates [-v] [--from-song-id <song_id>] [song_id ...]
+find-audio-duplicates [-v] [--from-song-id <song_id>] [--exhaustive]
+                      [--threads N] [--shard N/M --shard-dir dir]
+                      [--verify-store] [song_id ...]
                     find duplicate files comparing the audio fingerprint
+merge-similarity-shards [-v] <shard_dir>
+                    load the similarities calculated by find-audio-duplicates
+                    --shard into the database
 compare-songs [-i] [id_or_path] [id_or_path]
                     compares two songs given their paths or song id
 compare-files [-i] [path] [path]
@@ -1732,22 +2289,40 @@ compare-dirs [-s] [dir1] [dir2]
 scan-file [--print-match-info] [path]
                     Parse a file and find out if there are similar songs
                     in the database
+similarity-service [-v]
+                    Run a service that keeps fingerprints in memory to
+                    answer scan-file queries quickly
+check-offset-search [-v] [-n N]
+                    Compare the coarse and exhaustive offset search modes
+                    on a sample of the similarities in the database
 fix-mtime           fixes the mtime of imported files (you should never
                     need to use this)
-fix-checksums       fixes the checksums of imported files (you should
+fix-checksums [-j jobs] [--max-minutes minutes] [--max-gib size]
+              [--from-song-id id] [--remove-missing-files]
+                    fixes the checksums of imported files (you should
                     never need to use this)
 fix-ratings [--from-song-id id]
                     fixes the missing ratings of songs (you should never need
                     to use this)
+backfill-decoded-fingerprints [-v]
+                    stores the decoded fingerprints of songs imported with
+                    older versions (you should never need to use this)
 add-silences [-t threshold] [-l length] [-s start] [-e end] [file|song_id ...]
                     adds silence information to the db for files missing it
                     (you should never need to use this)
 check-songs-existence [-v] [path]
                     check for removed files to remove them from the
                     database
-check-checksums     check that the imported files haven't been modified
-                    since they were imported
-import [file_or_directory [file_or_directory ...]]
+check-checksums [-j jobs] [--max-minutes minutes] [--max-gib size]
+                [--from-song-id id] [--remove-missing-files]
+                    check that the imported files haven't been modified
+                    since they were imported, starting with the ones
+                    checked the longest time ago
+check-audio [-j jobs] [--from-song-id id]
+                    check that the audio of the imported files is not
+                    corrupted using the checksums embedded in the files
+                    (FLAC) or the checksums of the decoded audio
+import [-j jobs] [file_or_directory [file_or_directory ...]]
                     import new (or update) music. You can specify the
                     files/directories to import as arguments. If no
                     arguments are given in the command line, the
@@ -1760,6 +2335,13 @@ list|ls [-l] [-d] [-i|--id] [--duration] [-r root] [-g genre] [--rating rating]
 list-similars [-l] [condition]
                     lists files marked as similar in the database
                     (with find-audio-duplicates)
+list-duplicates [-l] [song_id]
+                    lists groups of duplicated songs (songs connected by
+                    similarities above match_threshold) marking the one
+                    with best audio quality, or the duplicates of a song
+rebuild-duplicate-clusters
+                    recalculates the groups of duplicated songs from the
+                    similarities in the database
 list-genres [-r root] [-q] [file | song id]
                     lists genres of songs selected by its name or song id
 list-roots [-q]
@@ -1772,8 +2354,11 @@ play [--sh|--shuffle] [-r root] [-g genre] [--rating rating]
 fix-tags <file_or_directory [file_or_directory ...]>
                     apply several normalization algorithms to fix tags of
                     files passed as arguments
-update [-v]
+update [-v] [-j jobs] [--trust-dir-mtime]
                     Update database with new/modified/deleted files
+watch [-v] [--trust-dir-mtime]
+                    Update database continuously when files are modified,
+                    added or removed in the music paths
 set-rating [-p] <rating> [file | song_id ...]
                     Set rating for a song or songs
 stats [-v]
@@ -1794,9 +2379,9 @@ cache-musicbrainz-db [-v]
                     new tables for fastest access
 analyze-songs [-v] [--from-song-id id]
                     Perform a high-level audio analysis of songs
-calculate-dr [file | song_id ...]
+calculate-dr [-f] [-j jobs] [file | song_id ...]
                     Calculate the Audio Dynamic Range of a song using the
-                    DR14-T.meter library.
+                    DR14-T.meter algorithm.
 update-musicbrainz-artists [-v]
                     Find .artist_mbid files to recognize artist paths
                     and images
@@ -1830,7 +2415,38 @@ mb-check-redirected-uuids [-v] [--list-songs] [--group-size N]
         parser.add_argument('--from-song-id', type=int, metavar='from_song_id',
                             help='Starts fixing checksums from a specific '
                                  'song_id')
+        parser.add_argument('--exhaustive', dest='exhaustive',
+                            action='store_true',
+                            help='Compare each song with all other songs '
+                                 'instead of only with the candidates found '
+                                 'in the fingerprint index')
+        parser.add_argument('--threads', type=int, metavar='N',
+                            help='Number of threads to use to compare '
+                                 'fingerprints (by default, the '
+                                 'fingerprint_threads config value or all '
+                                 'cores if it is 0)')
+        parser.add_argument('--shard', type=parseShard, metavar='N/M',
+                            help='Only calculate the similarities of shard '
+                                 'N of M and store them in --shard-dir')
+        parser.add_argument('--shard-dir', metavar='dir',
+                            help='Directory (which can be shared by several '
+                                 'hosts) where shards store their results '
+                                 'and checkpoints')
+        parser.add_argument('--verify-store', dest='verify_store',
+                            action='store_true',
+                            help='Verify the checksums of all the '
+                                 'fingerprints in the fingerprint store '
+                                 'instead of only the ones added since the '
+                                 'last run')
         parser.add_argument('songs', nargs='*')
+        # merge-similarity-shards command
+        parser = sps.add_parser('merge-similarity-shards',
+                                description='Load the similarities '
+                                'calculated by find-audio-duplicates --shard '
+                                'into the database')
+        parser.add_argument('-v', '--verbose', dest='verbose',
+                            action='store_true', help='Be verbose')
+        parser.add_argument('shard_dir', metavar='shard_dir')
         # compare-songs command
         parser = sps.add_parser('compare-songs',
                                 description='Compares two songs')
@@ -1873,6 +2489,23 @@ mb-check-redirected-uuids [-v] [--list-songs] [--group-size N]
                             help='Print the information of the most similar '
                             'song found')
         parser.add_argument('path', metavar='path')
+        # similarity-service command
+        parser = sps.add_parser('similarity-service',
+                                description='Run a service that keeps '
+                                'fingerprints in memory to answer scan-file '
+                                'queries quickly')
+        parser.add_argument('-v', '--verbose', dest='verbose',
+                            action='store_true', help='Be verbose')
+        # check-offset-search command
+        parser = sps.add_parser('check-offset-search',
+                                description='Compare the coarse and '
+                                'exhaustive offset search modes on a sample '
+                                'of the similarities in the database')
+        parser.add_argument('-v', '--verbose', dest='verbose',
+                            action='store_true', help='Be verbose')
+        parser.add_argument('-n', '--sample-size', type=int, default=1000,
+                            dest='sample_size',
+                            help='Number of similarities to check')
         # fix-mtime command
         sps.add_parser('fix-mtime',
                        description='Fixes the mtime of imported files '
@@ -1909,6 +2542,14 @@ mb-check-redirected-uuids [-v] [--list-songs] [--group-size N]
         parser.add_argument('--remove-missing-files',
                             dest='remove_missing_files', action='store_true',
                             help='Remove missing files')
+        parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help='Number of files to read in parallel')
+        parser.add_argument('--max-minutes', type=float, default=None,
+                            help="Don't start checking more files after "
+                                 'this number of minutes')
+        parser.add_argument('--max-gib', type=float, default=None,
+                            help="Don't start checking more files after "
+                                 'reading this number of GiB')
         # fix-ratings command
         parser = sps.add_parser('fix-ratings',
                                 description='Fixes the missing ratings of '
@@ -1921,6 +2562,14 @@ mb-check-redirected-uuids [-v] [--list-songs] [--group-size N]
                             'specific song_id')
         parser.add_argument('-v', '--verbose', dest='verbose',
                             action='store_true', help='Be verbose')
+        # backfill-decoded-fingerprints command
+        parser = sps.add_parser('backfill-decoded-fingerprints',
+                                description='Stores the decoded '
+                                'fingerprints of songs imported with older '
+                                'versions (you should never need to use '
+                                'this)')
+        parser.add_argument('-v', '--verbose', dest='verbose',
+                            action='store_true', help='Be verbose')
         # check-songs-existence command
         parser = sps.add_parser('check-songs-existence',
                                 description='Check for removed files to '
@@ -1939,6 +2588,24 @@ mb-check-redirected-uuids [-v] [--list-songs] [--group-size N]
         parser.add_argument('--remove-missing-files',
                             dest='remove_missing_files', action='store_true',
                             help='Remove missing files')
+        parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help='Number of files to read in parallel')
+        parser.add_argument('--max-minutes', type=float, default=None,
+                            help="Don't start checking more files after "
+                                 'this number of minutes')
+        parser.add_argument('--max-gib', type=float, default=None,
+                            help="Don't start checking more files after "
+                                 'reading this number of GiB')
+        # check-audio command
+        parser = sps.add_parser('check-audio',
+                                description='Check that the audio of the '
+                                'imported files is not corrupted')
+        parser.add_argument('--from-song-id', type=int, metavar='from_song_id',
+                            help='Starts checking songs '
+                                 'from a specific song_id')
+        parser.add_argument('-j', '--jobs', type=int, default=None,
+                            help='Number of files to decode in parallel '
+                                 '(0 uses one thread per cpu)')
         # import command
         parser = sps.add_parser('import',
                                 description='Import new (or update) music. '
@@ -1946,6 +2613,9 @@ mb-check-redirected-uuids [-v] [--list-songs] [--group-size N]
                                 'import as arguments. If no arguments are '
                                 'given in the command line, the music_paths '
                                 'entries in the configuration file are used')
+        parser.add_argument('-j', '--jobs', type=int, default=None,
+                            help='Number of processes used to analyze files '
+                            '(0 uses one per cpu)')
         parser.add_argument('paths', nargs='*', metavar='file_or_directory')
         # info command
         parser = sps.add_parser('info',
@@ -2046,6 +2716,18 @@ mb-check-redirected-uuids [-v] [--list-songs] [--group-size N]
         parser.add_argument('condition', nargs='*', help='An optional '
                             'condition on similarity (i.e. "> 0.8"). '
                             'By default: ">0.85"')
+        # list-duplicates command
+        parser = sps.add_parser('list-duplicates',
+                                description='List groups of duplicated '
+                                            'songs')
+        parser.add_argument('-l', dest='long_ls', action='store_true',
+                            help='Run ls -l on the files')
+        parser.add_argument('song_id', type=int, nargs='?', default=None,
+                            help='List only the duplicates of this song')
+        # rebuild-duplicate-clusters command
+        parser = sps.add_parser('rebuild-duplicate-clusters',
+                                description='Recalculate the groups of '
+                                            'duplicated songs')
         # play command
         parser = sps.add_parser('play',
                                 description='Play the specified songs')
@@ -2079,6 +2761,23 @@ mb-check-redirected-uuids [-v] [--list-songs] [--group-size N]
         parser.add_argument('--process', dest='process',
                             action='store_true', help='Shortcut to '
                             'process-audio after the update finishes')
+        parser.add_argument('-j', '--jobs', type=int, default=None,
+                            help='Number of processes used to analyze files '
+                            '(0 uses one per cpu)')
+        parser.add_argument('--trust-dir-mtime', dest='trust_dir_mtime',
+                            action='store_true', help="Don't check the "
+                            'files of directories whose mtime and number of '
+                            'files are unchanged since the last update')
+        # watch command
+        parser = sps.add_parser('watch',
+                                description='Update database continuously '
+                                'when files are modified, added or removed')
+        parser.add_argument('-v', '--verbose', dest='verbose',
+                            action='store_true', help='Be verbose')
+        parser.add_argument('--trust-dir-mtime', dest='trust_dir_mtime',
+                            action='store_true', help="Don't check the "
+                            'files of unchanged directories in the initial '
+                            'update')
         # set-rating command
         parser = sps.add_parser('set-rating',
                                 description='Set rating for a song or songs')
@@ -2150,6 +2849,9 @@ mb-check-redirected-uuids [-v] [--list-songs] [--group-size N]
                             action='store_true', help='Force the recalculation'
                             ' of the dynamic range instead of reading it from '
                             'the database')
+        parser.add_argument('-j', '--jobs', type=int, default=None,
+                            help='Number of processes used to calculate '
+                            'the dynamic range (0 uses one per cpu)')
         parser.add_argument('ids_or_paths', nargs='*')
         # update-musicbrainz-artists command
         parser = sps.add_parser('update-musicbrainz-artists', description=''
@@ -2210,7 +2912,10 @@ mb-check-redirected-uuids [-v] [--list-songs] [--group-size N]
             self.fixMtime()
         elif options.command == 'fix-checksums':
             self.fixChecksums(options.from_song_id,
-                              removeMissingFiles=options.remove_missing_files)
+                              removeMissingFiles=options.remove_missing_files,
+                              jobs=options.jobs,
+                              maxMinutes=options.max_minutes,
+                              maxGiB=options.max_gib)
         elif options.command == 'add-silences':
             self.addSilences(options.paths, options.threshold,
                              options.min_length, options.silence_at_start,
@@ -2223,10 +2928,29 @@ mb-check-redirected-uuids [-v] [--list-songs] [--group-size N]
                                             callback=self.db.removeSong)
         elif options.command == 'check-checksums':
             self.checkChecksums(options.from_song_id,
-                                removeMissingFiles=options.remove_missing_files
-                                )
+                                removeMissingFiles=options.remove_missing_files,
+                                jobs=options.jobs,
+                                maxMinutes=options.max_minutes,
+                                maxGiB=options.max_gib)
+        elif options.command == 'check-audio':
+            self.checkAudio(options.from_song_id,
+                            jobs=importJobs(options.jobs))
         elif options.command == 'find-audio-duplicates':
-            self.findAudioDuplicates(options.from_song_id, options.songs, verbose=options.verbose)
+            if (options.shard is None) != (options.shard_dir is None):
+                print('--shard and --shard-dir must be used together')
+                sys.exit(1)
+            if options.shard is not None and options.songs:
+                print("--shard can't be used with a list of songs")
+                sys.exit(1)
+            self.findAudioDuplicates(options.from_song_id, options.songs,
+                                     verbose=options.verbose,
+                                     exhaustive=options.exhaustive,
+                                     threads=options.threads,
+                                     shard=options.shard,
+                                     shard_dir=options.shard_dir,
+                                     verifyStore=options.verify_store)
+        elif options.command == 'merge-similarity-shards':
+            mergeSimilarityShards(options.shard_dir, verbose=options.verbose)
         elif options.command == 'compare-songs':
             self.compareSongIDsOrPaths(options.song1, options.song2,
                                        options.interactive)
@@ -2269,6 +2993,11 @@ mb-check-redirected-uuids [-v] [--list-songs] [--group-size N]
         elif options.command == 'list-similars':
             self.listSimilars(condition=options.condition,
                               long_ls=options.long_ls)
+        elif options.command == 'list-duplicates':
+            self.listDuplicates(songID=options.song_id,
+                                long_ls=options.long_ls)
+        elif options.command == 'rebuild-duplicate-clusters':
+            self.rebuildDuplicateClusters()
         elif options.command == 'play':
             query = Query(options.root, options.genre, options.my_rating,
                           options.others_rating, options.rating)
@@ -2278,12 +3007,17 @@ mb-check-redirected-uuids [-v] [--list-songs] [--group-size N]
             if not paths:
                 paths = config.config['music_paths']
 
-            self.add(paths)
+            self.add(paths, jobs=importJobs(options.jobs))
         elif options.command == 'update':
             paths = config.config['music_paths']
-            self.update(paths, verbose=options.verbose)
+            self.update(paths, verbose=options.verbose,
+                        jobs=importJobs(options.jobs),
+                        trustDirMtime=options.trust_dir_mtime)
             if options.process:
                 self.processSongs(verbose=options.verbose)
+        elif options.command == 'watch':
+            self.watch(verbose=options.verbose,
+                       trustDirMtime=options.trust_dir_mtime)
         elif options.command == 'set-rating':
             self.setRating(options.paths, options.rating, options.playing)
         elif options.command == 'stats':
@@ -2309,6 +3043,8 @@ mb-check-redirected-uuids [-v] [--list-songs] [--group-size N]
         elif options.command == 'fix-ratings':
             self.fixRatings(options.user_id, from_song_id=options.from_song_id,
                             verbose=options.verbose)
+        elif options.command == 'backfill-decoded-fingerprints':
+            self.backfillDecodedFingerprints(verbose=options.verbose)
         elif options.command == 'update-musicbrainz-artists':
             self.updateMusicBrainzArtists(verbose=options.verbose)
         elif options.command == 'process-songs':
@@ -2326,8 +3062,17 @@ mb-check-redirected-uuids [-v] [--list-songs] [--group-size N]
                                                  verbose=options.verbose)
         elif options.command == 'scan-file':
             self.scanFile(options.path, printMatchInfo=options.printMatchInfo)
+        elif options.command == 'similarity-service':
+            from bard.fingerprint_store import openFingerprintStore
+            runSimilarityService(createLookupFingerprintManager(),
+                                 openFingerprintStore(),
+                                 verbose=options.verbose)
+        elif options.command == 'check-offset-search':
+            self.checkOffsetSearch(options.sample_size,
+                                   verbose=options.verbose)
         elif options.command == 'calculate-dr':
-            self.calculateDR(options.ids_or_paths, options.force)
+            self.calculateDR(options.ids_or_paths, options.force,
+                             jobs=importJobs(options.jobs))
 
 
 def main():
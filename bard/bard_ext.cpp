@@ -20,360 +20,1946 @@
 #include <boost/python/extract.hpp>
 #include <boost/python/stl_iterator.hpp>
 #include <boost/python/list.hpp>
+#include <boost/python/dict.hpp>
 #include <boost/python/tuple.hpp>
 #include <boost/python/class.hpp>
+#include <boost/python/enum.hpp>
+#include <boost/python/to_python_converter.hpp>
 #include <vector>
 #include <map>
 #include <iostream>
-#include <parallel/algorithm>
-#include <mutex>
-#include <fstream>
+#include <omp.h>
+#include <numeric>
+#include <cmath>
+#include <unordered_map>
+#include <algorithm>
+#include <cstdint>
+#include <cstring>
+#include <string>
+#include <memory>
+#include <stdexcept>
+#include <cerrno>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+#include <boost/crc.hpp>
+#include <boost/python/object.hpp>
+#include <boost/python/errors.hpp>
+#if defined(__x86_64__) || defined(__i386__)
+#include <immintrin.h>
+#define BARD_X86_KERNELS 1
+#endif
+
+typedef long long fpint;
+
+template<typename T>
+inline
+std::vector<T> to_std_vector( const boost::python::object& iterable )
+{
+    return std::vector<T>( boost::python::stl_input_iterator<T>( iterable ),
+                           boost::python::stl_input_iterator<T>( ) );
+}
+
+template<typename T>
+long greet(boost::python::list &a)
+{
+   auto v = to_std_vector<int>(a);
+   return v[0];
+}
+
+boost::python::tuple greet2()
+{
+   int i1=-1442137496;
+   int i2=1786980374;
+   int a=__builtin_popcount(i1 ^ i2);
+   return boost::python::make_tuple(a,2,3);
+}
+
+/*
+ * Kernels that return the number of different bits between two arrays of
+ * chromaprint frames. The best one supported by the cpu is selected at
+ * runtime and the scalar one is always available as a fallback.
+ */
+
+typedef uint64_t (*XorPopcountFunction)(const uint32_t *a, const uint32_t *b, size_t n);
+
+static uint64_t xorPopcountScalar(const uint32_t *a, const uint32_t *b, size_t n)
+{
+    uint64_t total = 0;
+    for (size_t i = 0; i < n; ++i)
+        total += __builtin_popcount(a[i] ^ b[i]);
+    return total;
+}
+
+#ifdef BARD_X86_KERNELS
+__attribute__((target("popcnt")))
+static uint64_t xorPopcountPopcnt64(const uint32_t *a, const uint32_t *b, size_t n)
+{
+    uint64_t total = 0;
+    size_t i = 0;
+    for (; i + 2 <= n; i += 2)
+    {
+        uint64_t x, y;
+        memcpy(&x, a + i, sizeof(x));
+        memcpy(&y, b + i, sizeof(y));
+        total += __builtin_popcountll(x ^ y);
+    }
+    for (; i < n; ++i)
+        total += __builtin_popcount(a[i] ^ b[i]);
+    return total;
+}
+
+__attribute__((target("avx2")))
+static uint64_t xorPopcountAVX2(const uint32_t *a, const uint32_t *b, size_t n)
+{
+    // Nibble lookup table popcount (Mula et al.), 8 frames per iteration
+    const __m256i lookup = _mm256_setr_epi8(0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4,
+                                            0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4);
+    const __m256i lowMask = _mm256_set1_epi8(0x0f);
+    __m256i acc = _mm256_setzero_si256();
+    size_t i = 0;
+    for (; i + 8 <= n; i += 8)
+    {
+        const __m256i x = _mm256_xor_si256(
+                _mm256_loadu_si256(reinterpret_cast<const __m256i *>(a + i)),
+                _mm256_loadu_si256(reinterpret_cast<const __m256i *>(b + i)));
+        const __m256i lo = _mm256_and_si256(x, lowMask);
+        const __m256i hi = _mm256_and_si256(_mm256_srli_epi16(x, 4), lowMask);
+        const __m256i counts = _mm256_add_epi8(_mm256_shuffle_epi8(lookup, lo),
+                                               _mm256_shuffle_epi8(lookup, hi));
+        acc = _mm256_add_epi64(acc, _mm256_sad_epu8(counts, _mm256_setzero_si256()));
+    }
+    uint64_t total = _mm256_extract_epi64(acc, 0) + _mm256_extract_epi64(acc, 1) +
+                     _mm256_extract_epi64(acc, 2) + _mm256_extract_epi64(acc, 3);
+    for (; i < n; ++i)
+        total += __builtin_popcount(a[i] ^ b[i]);
+    return total;
+}
+
+__attribute__((target("avx512f,avx512vpopcntdq")))
+static uint64_t xorPopcountAVX512(const uint32_t *a, const uint32_t *b, size_t n)
+{
+    // 16 frames per iteration
+    __m512i acc = _mm512_set1_epi32(0);
+    size_t i = 0;
+    for (; i + 16 <= n; i += 16)
+    {
+        const __m512i x = _mm512_xor_si512(_mm512_loadu_si512(a + i),
+                                           _mm512_loadu_si512(b + i));
+        acc = _mm512_add_epi32(acc, _mm512_popcnt_epi32(x));
+    }
+    uint32_t lanes[16];
+    _mm512_storeu_si512(lanes, acc);
+    uint64_t total = 0;
+    for (uint32_t lane : lanes)
+        total += lane;
+    for (; i < n; ++i)
+        total += __builtin_popcount(a[i] ^ b[i]);
+    return total;
+}
+#endif
+
+struct XorPopcountImplementation
+{
+    const char *name;
+    XorPopcountFunction function;
+    bool (*supported)();
+};
+
+static const XorPopcountImplementation s_xorPopcountImplementations[] = {
+#ifdef BARD_X86_KERNELS
+    {"avx512", xorPopcountAVX512, []() { return __builtin_cpu_supports("avx512f") && __builtin_cpu_supports("avx512vpopcntdq"); }},
+    {"avx2", xorPopcountAVX2, []() { return __builtin_cpu_supports("avx2") != 0; }},
+    {"popcnt64", xorPopcountPopcnt64, []() { return __builtin_cpu_supports("popcnt") != 0; }},
+#endif
+    {"scalar", xorPopcountScalar, []() { return true; }},
+};
+
+static const XorPopcountImplementation *selectXorPopcountImplementation()
+{
+#ifdef BARD_X86_KERNELS
+    __builtin_cpu_init();
+#endif
+    for (const auto &implementation : s_xorPopcountImplementations)
+        if (implementation.supported())
+            return &implementation;
+    return nullptr;
+}
+
+static const XorPopcountImplementation *s_xorPopcount = selectXorPopcountImplementation();
+
+std::string popcountImplementation()
+{
+    return s_xorPopcount->name;
+}
+
+boost::python::list popcountImplementations()
+{
+    boost::python::list result;
+    for (const auto &implementation : s_xorPopcountImplementations)
+        if (implementation.supported())
+            result.append(std::string(implementation.name));
+    return result;
+}
+
+bool setPopcountImplementation(const std::string &name)
+{
+    for (const auto &implementation : s_xorPopcountImplementations)
+        if (name == implementation.name && implementation.supported())
+        {
+            s_xorPopcount = &implementation;
+            return true;
+        }
+    return false;
+}
+
+static inline uint64_t xorPopcount(const uint32_t *a, const uint32_t *b, size_t n)
+{
+    return s_xorPopcount->function(a, b, n);
+}
+
+static inline uint64_t popcount(const uint32_t *a, size_t n)
+{
+    uint64_t total = 0;
+    for (size_t i = 0; i < n; ++i)
+        total += __builtin_popcount(a[i]);
+    return total;
+}
+
+/*
+ * Fingerprints are stored as 32 bit chromaprint frames in a single arena.
+ * Each song entry just keeps the position and length of its fingerprint.
+ */
+
+struct SongEntry
+{
+    long songID;
+    size_t offset;
+    uint32_t length;
+    double duration;
+    // Set when the fingerprint is in a mapped FingerprintStore file
+    const uint32_t *mapped;
+};
+
+struct FingerprintView
+{
+    const uint32_t *data;
+    size_t size;
+};
+
+typedef std::vector<SongEntry> SongVector;
+
+struct IndexPosting
+{
+    uint32_t songIndex;
+    uint32_t position;
+};
+
+enum class OffsetSearchMode
+{
+    Exhaustive,
+    Coarse
+};
+
+struct SimilarityMatch
+{
+    long songID;
+    int offset;
+    double similarity;
+};
+
+/*
+ * Statistics about the exact comparisons at a given offset (sweeps). A
+ * sweep is cancelled when it can't reach the cancel threshold anymore, so
+ * comparedFrames is lower than totalFrames when sweeps are cancelled early.
+ */
+struct SweepStatistics
+{
+    long sweeps = 0;
+    long cancelledSweeps = 0;
+    long comparedFrames = 0;
+    long totalFrames = 0;
+
+    SweepStatistics &operator+=(const SweepStatistics &other)
+    {
+        sweeps += other.sweeps;
+        cancelledSweeps += other.cancelledSweeps;
+        comparedFrames += other.comparedFrames;
+        totalFrames += other.totalFrames;
+        return *this;
+    }
+};
+
+/*
+ * Release the GIL while an object of this class exists. No python object
+ * can be used in the meantime.
+ */
+class ReleaseGIL
+{
+public:
+    ReleaseGIL() : m_state(PyEval_SaveThread()) {}
+    ~ReleaseGIL() { PyEval_RestoreThread(m_state); }
+    ReleaseGIL(const ReleaseGIL &) = delete;
+    ReleaseGIL &operator=(const ReleaseGIL &) = delete;
+
+private:
+    PyThreadState *m_state;
+};
+
+/*
+ * A fingerprint given as an object supporting the buffer protocol (bytes,
+ * memoryview, array('I'), numpy arrays, ...) containing 32 bit little
+ * endian frames. valid() returns false if the object doesn't support it.
+ */
+class FingerprintBuffer
+{
+public:
+    explicit FingerprintBuffer(PyObject *object)
+    {
+        if (!PyObject_CheckBuffer(object))
+            return;
+        if (PyObject_GetBuffer(object, &m_buffer, PyBUF_C_CONTIGUOUS) != 0)
+            boost::python::throw_error_already_set();
+        m_valid = true;
+        if ((m_buffer.itemsize != 1 && m_buffer.itemsize != sizeof(uint32_t)) ||
+            m_buffer.len % sizeof(uint32_t) != 0)
+        {
+            PyErr_SetString(PyExc_ValueError, "Fingerprint buffers must contain 32 bit frames");
+            boost::python::throw_error_already_set();
+        }
+    }
+
+    ~FingerprintBuffer()
+    {
+        if (m_valid)
+            PyBuffer_Release(&m_buffer);
+    }
+
+    FingerprintBuffer(const FingerprintBuffer &) = delete;
+    FingerprintBuffer &operator=(const FingerprintBuffer &) = delete;
+
+    bool valid() const { return m_valid; }
+    size_t size() const { return m_buffer.len / sizeof(uint32_t); }
+
+    void copyTo(uint32_t *destination) const
+    {
+        memcpy(destination, m_buffer.buf, m_buffer.len);
+#if __BYTE_ORDER__ == __ORDER_BIG_ENDIAN__
+        for (size_t i = 0; i < size(); ++i)
+            destination[i] = __builtin_bswap32(destination[i]);
+#endif
+    }
+
+private:
+    Py_buffer m_buffer;
+    bool m_valid = false;
+};
+
+// Chromaprint frames are unsigned 32 bit values, but accept them also
+// as signed values.
+static std::vector<uint32_t> toFingerprint(const boost::python::object &fingerprint)
+{
+    std::vector<uint32_t> result;
+    FingerprintBuffer buffer(fingerprint.ptr());
+    if (buffer.valid())
+    {
+        result.resize(buffer.size());
+        buffer.copyTo(result.data());
+        return result;
+    }
+
+    boost::python::stl_input_iterator<fpint> it(fingerprint), end;
+    for (; it != end; ++it)
+        result.push_back(static_cast<uint32_t>(*it));
+    return result;
+}
+
+static inline FingerprintView toView(const std::vector<uint32_t> &fingerprint)
+{
+    return {fingerprint.data(), fingerprint.size()};
+}
+
+/*
+ * FingerprintStore keeps the fingerprints of all songs in a file that is
+ * memory mapped, so they can be used by a FingerprintManager without
+ * copying them.
+ *
+ * The file starts with a StoreHeader followed by records, each of them
+ * a StoreRecordHeader followed by the fingerprint frames. Records are only
+ * appended. A record for a song that is already in the store replaces the
+ * previous one and a tombstone record removes a song. New records are only
+ * visible once the header is updated by sync(), so a file is never left in
+ * an inconsistent state. compact() rewrites the file without the dead
+ * records. Values are stored in native byte order, since the store is just
+ * a local cache of the fingerprints in the database.
+ */
+
+static const char s_storeMagic[8] = {'B', 'A', 'R', 'D', 'F', 'P', 'S', '\0'};
+static const uint32_t s_storeVersion = 1;
+static const uint32_t s_storeByteOrderMark = 0x01020304;
+static const uint32_t s_storeTombstone = 1;
+
+struct StoreHeader
+{
+    char magic[8];
+    uint32_t version;
+    uint32_t byteOrderMark;
+    uint64_t recordCount;
+    uint64_t dataEnd;
+    uint32_t checksum;
+    uint32_t reserved1;
+    // Records before this offset were already verified. Older files have 0
+    uint64_t verifiedEnd;
+    uint32_t reserved[4];
+};
+static_assert(sizeof(StoreHeader) == 64, "StoreHeader must be 64 bytes long");
+
+struct StoreRecordHeader
+{
+    int64_t songID;
+    double duration;
+    double stamp;
+    uint32_t length;
+    uint32_t flags;
+    uint32_t checksum;
+    uint32_t reserved;
+};
+static_assert(sizeof(StoreRecordHeader) == 40, "StoreRecordHeader must be 40 bytes long");
+
+static uint32_t headerChecksum(StoreHeader header)
+{
+    header.checksum = 0;
+    boost::crc_32_type crc;
+    crc.process_bytes(&header, sizeof(header));
+    return crc.checksum();
+}
+
+static uint32_t recordChecksum(StoreRecordHeader header, const uint32_t *data)
+{
+    header.checksum = 0;
+    boost::crc_32_type crc;
+    crc.process_bytes(&header, sizeof(header));
+    crc.process_bytes(data, header.length * sizeof(uint32_t));
+    return crc.checksum();
+}
+
+static void throwErrno(const std::string &msg, const std::string &path)
+{
+    throw std::runtime_error(msg + " " + path + ": " + strerror(errno));
+}
+
+static void writeAll(int fd, const void *data, size_t size, off_t offset, const std::string &path)
+{
+    const char *ptr = static_cast<const char *>(data);
+    while (size > 0)
+    {
+        ssize_t written = pwrite(fd, ptr, size, offset);
+        if (written < 0)
+        {
+            if (errno == EINTR)
+                continue;
+            throwErrno("Error writing fingerprint store", path);
+        }
+        ptr += written;
+        offset += written;
+        size -= written;
+    }
+}
+
+class MappedFile
+{
+public:
+    MappedFile(int fd, size_t size) : m_size(size)
+    {
+        if (size == 0)
+            return;
+        void *addr = mmap(nullptr, size, PROT_READ, MAP_SHARED, fd, 0);
+        if (addr == MAP_FAILED)
+            throw std::runtime_error(std::string("Error mapping fingerprint store: ") + strerror(errno));
+        m_data = static_cast<const char *>(addr);
+    }
+    ~MappedFile()
+    {
+        if (m_data)
+            munmap(const_cast<char *>(m_data), m_size);
+    }
+    MappedFile(const MappedFile &) = delete;
+    MappedFile &operator=(const MappedFile &) = delete;
+
+    const char *data() const { return m_data; }
+    size_t size() const { return m_size; }
+
+private:
+    const char *m_data = nullptr;
+    size_t m_size = 0;
+};
+
+class FingerprintStore
+{
+public:
+    FingerprintStore(const std::string &path);
+    ~FingerprintStore();
+    FingerprintStore(const FingerprintStore &) = delete;
+    FingerprintStore &operator=(const FingerprintStore &) = delete;
+
+    std::string path() const;
+    int size() const;
+    bool contains(long songID) const;
+    boost::python::list songIDs() const;
+    boost::python::list entries() const;
+    boost::python::list fingerprint(long songID) const;
+
+    void append(long songID, boost::python::object &fingerprint, double duration, double stamp);
+    void remove(long songID);
+    void sync();
+    void reload();
+    void compact();
+    boost::python::list verify(bool full);
+
+    size_t fileSize() const;
+    size_t deadBytes() const;
+
+    bool find(long songID, FingerprintView &view, double &duration, bool &mapped) const;
+    std::shared_ptr<MappedFile> mapping() const;
+    std::vector<long> sortedSongIDs() const;
+
+protected:
+    struct Entry
+    {
+        size_t offset; // Offset of the record in the file
+        uint32_t length;
+        double duration;
+        double stamp;
+        bool mapped;
+        size_t heapOffset;
+    };
+
+    void open();
+    void close();
+    void load();
+    void appendRecord(const StoreRecordHeader &header, const uint32_t *data);
+    void writeHeader();
+    FingerprintView entryFingerprint(const Entry &entry) const;
+    static size_t recordSize(uint32_t length);
+
+private:
+    std::string m_path;
+    int m_fd = -1;
+    std::shared_ptr<MappedFile> m_mapping;
+    std::unordered_map<long, Entry> m_entries;
+    std::vector<uint32_t> m_heap;
+    uint64_t m_recordCount = 0;
+    uint64_t m_dataEnd = sizeof(StoreHeader);
+    uint64_t m_deadBytes = 0;
+    uint64_t m_verifiedEnd = 0;
+    bool m_dirty = false;
+};
+
+FingerprintStore::FingerprintStore(const std::string &path) : m_path(path)
+{
+    open();
+}
+
+FingerprintStore::~FingerprintStore()
+{
+    try
+    {
+        sync();
+    }
+    catch (const std::exception &e)
+    {
+        std::cerr << e.what() << std::endl;
+    }
+    close();
+}
+
+void FingerprintStore::open()
+{
+    m_fd = ::open(m_path.c_str(), O_RDWR | O_CREAT | O_CLOEXEC, 0644);
+    if (m_fd < 0)
+        throwErrno("Error opening fingerprint store", m_path);
+
+    try
+    {
+        load();
+    }
+    catch (...)
+    {
+        close();
+        throw;
+    }
+}
+
+void FingerprintStore::close()
+{
+    m_mapping.reset();
+    m_entries.clear();
+    m_heap.clear();
+    if (m_fd >= 0)
+        ::close(m_fd);
+    m_fd = -1;
+}
+
+size_t FingerprintStore::recordSize(uint32_t length)
+{
+    return sizeof(StoreRecordHeader) + length * sizeof(uint32_t);
+}
+
+void FingerprintStore::load()
+{
+    struct stat st;
+    if (fstat(m_fd, &st) < 0)
+        throwErrno("Error reading fingerprint store", m_path);
+
+    m_recordCount = 0;
+    m_dataEnd = sizeof(StoreHeader);
+    m_deadBytes = 0;
+    m_verifiedEnd = 0;
+    if (st.st_size == 0)
+    {
+        writeHeader();
+        return;
+    }
+
+    StoreHeader header;
+    if (static_cast<size_t>(st.st_size) < sizeof(header) ||
+        pread(m_fd, &header, sizeof(header), 0) != sizeof(header))
+        throw std::runtime_error("Truncated fingerprint store " + m_path);
+    if (memcmp(header.magic, s_storeMagic, sizeof(s_storeMagic)) != 0 ||
+        header.byteOrderMark != s_storeByteOrderMark)
+        throw std::runtime_error("Invalid fingerprint store " + m_path);
+    if (header.version != s_storeVersion)
+        throw std::runtime_error("Unsupported fingerprint store version " + std::to_string(header.version) + " in " + m_path);
+    if (header.checksum != headerChecksum(header) || header.dataEnd < sizeof(header) ||
+        header.dataEnd > static_cast<uint64_t>(st.st_size))
+        throw std::runtime_error("Corrupted fingerprint store header in " + m_path);
+
+    m_mapping = std::make_shared<MappedFile>(m_fd, header.dataEnd);
+    const char *data = m_mapping->data();
+    size_t offset = sizeof(header);
+    for (uint64_t i = 0; i < header.recordCount; ++i)
+    {
+        StoreRecordHeader record;
+        if (offset + sizeof(record) > header.dataEnd)
+            throw std::runtime_error("Corrupted fingerprint store " + m_path);
+        memcpy(&record, data + offset, sizeof(record));
+        const size_t size = recordSize(record.length);
+        if (offset + size > header.dataEnd)
+            throw std::runtime_error("Corrupted fingerprint store " + m_path);
+
+        auto it = m_entries.find(record.songID);
+        if (it != m_entries.end())
+        {
+            m_deadBytes += recordSize(it->second.length);
+            m_entries.erase(it);
+        }
+        if (record.flags & s_storeTombstone)
+            m_deadBytes += size;
+        else
+            m_entries[record.songID] = {offset, record.length, record.duration, record.stamp, true, 0};
+        offset += size;
+    }
+    m_recordCount = header.recordCount;
+    m_dataEnd = offset;
+    m_verifiedEnd = std::min(header.verifiedEnd, m_dataEnd);
+}
+
+void FingerprintStore::writeHeader()
+{
+    StoreHeader header;
+    memset(&header, 0, sizeof(header));
+    memcpy(header.magic, s_storeMagic, sizeof(s_storeMagic));
+    header.version = s_storeVersion;
+    header.byteOrderMark = s_storeByteOrderMark;
+    header.recordCount = m_recordCount;
+    header.dataEnd = m_dataEnd;
+    header.verifiedEnd = m_verifiedEnd;
+    header.checksum = headerChecksum(header);
+    writeAll(m_fd, &header, sizeof(header), 0, m_path);
+    if (fdatasync(m_fd) < 0)
+        throwErrno("Error syncing fingerprint store", m_path);
+}
+
+void FingerprintStore::sync()
+{
+    if (!m_dirty || m_fd < 0)
+        return;
+
+    // Make sure the records are written before the header refers to them
+    if (fdatasync(m_fd) < 0)
+        throwErrno("Error syncing fingerprint store", m_path);
+    writeHeader();
+    m_dirty = false;
+}
+
+/*
+ * Open the file again to see the records appended by other processes, or
+ * the new file if it was compacted. FingerprintManagers using the previous
+ * mapping keep it alive until they release it.
+ */
+void FingerprintStore::reload()
+{
+    sync();
+    close();
+    open();
+}
+
+void FingerprintStore::appendRecord(const StoreRecordHeader &header, const uint32_t *data)
+{
+    writeAll(m_fd, &header, sizeof(header), m_dataEnd, m_path);
+    if (header.length)
+        writeAll(m_fd, data, header.length * sizeof(uint32_t), m_dataEnd + sizeof(header), m_path);
+    m_dataEnd += recordSize(header.length);
+    ++m_recordCount;
+    m_dirty = true;
+}
+
+void FingerprintStore::append(long songID, boost::python::object &fingerprint, double duration, double stamp)
+{
+    const std::vector<uint32_t> v = toFingerprint(fingerprint);
+    StoreRecordHeader header;
+    memset(&header, 0, sizeof(header));
+    header.songID = songID;
+    header.duration = duration;
+    header.stamp = stamp;
+    header.length = v.size();
+    header.checksum = recordChecksum(header, v.data());
+
+    const size_t offset = m_dataEnd;
+    appendRecord(header, v.data());
+
+    auto it = m_entries.find(songID);
+    if (it != m_entries.end())
+        m_deadBytes += recordSize(it->second.length);
+    const size_t heapOffset = m_heap.size();
+    m_heap.insert(m_heap.end(), v.begin(), v.end());
+    m_entries[songID] = {offset, header.length, duration, stamp, false, heapOffset};
+}
+
+void FingerprintStore::remove(long songID)
+{
+    auto it = m_entries.find(songID);
+    if (it == m_entries.end())
+        return;
+
+    StoreRecordHeader header;
+    memset(&header, 0, sizeof(header));
+    header.songID = songID;
+    header.flags = s_storeTombstone;
+    header.checksum = recordChecksum(header, nullptr);
+    appendRecord(header, nullptr);
+    m_deadBytes += recordSize(it->second.length) + recordSize(0);
+    m_entries.erase(it);
+}
+
+void FingerprintStore::compact()
+{
+    const std::string tmpPath = m_path + ".tmp";
+    int fd = ::open(tmpPath.c_str(), O_RDWR | O_CREAT | O_TRUNC | O_CLOEXEC, 0644);
+    if (fd < 0)
+        throwErrno("Error creating", tmpPath);
+
+    uint64_t recordCount = 0;
+    uint64_t dataEnd = sizeof(StoreHeader);
+    try
+    {
+        for (long songID : sortedSongIDs())
+        {
+            const Entry &entry = m_entries.at(songID);
+            const FingerprintView fp = entryFingerprint(entry);
+            StoreRecordHeader header;
+            memset(&header, 0, sizeof(header));
+            header.songID = songID;
+            header.duration = entry.duration;
+            header.stamp = entry.stamp;
+            header.length = entry.length;
+            header.checksum = recordChecksum(header, fp.data);
+            writeAll(fd, &header, sizeof(header), dataEnd, tmpPath);
+            writeAll(fd, fp.data, fp.size * sizeof(uint32_t), dataEnd + sizeof(header), tmpPath);
+            dataEnd += recordSize(header.length);
+            ++recordCount;
+        }
+
+        StoreHeader header;
+        memset(&header, 0, sizeof(header));
+        memcpy(header.magic, s_storeMagic, sizeof(s_storeMagic));
+        header.version = s_storeVersion;
+        header.byteOrderMark = s_storeByteOrderMark;
+        header.recordCount = recordCount;
+        header.dataEnd = dataEnd;
+        header.checksum = headerChecksum(header);
+        writeAll(fd, &header, sizeof(header), 0, tmpPath);
+        if (fsync(fd) < 0)
+            throwErrno("Error syncing", tmpPath);
+        if (rename(tmpPath.c_str(), m_path.c_str()) < 0)
+            throwErrno("Error renaming", tmpPath);
+    }
+    catch (...)
+    {
+        ::close(fd);
+        unlink(tmpPath.c_str());
+        throw;
+    }
+    ::close(fd);
+
+    // FingerprintManagers using the previous mapping keep it alive
+    m_dirty = false;
+    close();
+    open();
+}
+
+/*
+ * Return the IDs of the songs whose records in the file don't match their
+ * checksum. Unless full is true, only the records appended after the last
+ * verification are checked, so the whole file isn't read every time.
+ */
+boost::python::list FingerprintStore::verify(bool full)
+{
+    boost::python::list result;
+    const uint64_t start = full ? 0 : m_verifiedEnd;
+    for (long songID : sortedSongIDs())
+    {
+        const Entry &entry = m_entries.at(songID);
+        if (!entry.mapped || entry.offset < start)
+            continue;
+        StoreRecordHeader header;
+        memcpy(&header, m_mapping->data() + entry.offset, sizeof(header));
+        if (header.checksum != recordChecksum(header, entryFingerprint(entry).data))
+            result.append(songID);
+    }
+    // The records appended by this process are verified the next time the
+    // file is loaded, since only the mapped ones were read from the file
+    const uint64_t verifiedEnd = m_mapping ? m_mapping->size() : m_verifiedEnd;
+    if (verifiedEnd != m_verifiedEnd)
+    {
+        m_verifiedEnd = verifiedEnd;
+        m_dirty = true;
+    }
+    return result;
+}
+
+FingerprintView FingerprintStore::entryFingerprint(const Entry &entry) const
+{
+    if (entry.mapped)
+        return {reinterpret_cast<const uint32_t *>(m_mapping->data() + entry.offset + sizeof(StoreRecordHeader)), entry.length};
+    return {m_heap.data() + entry.heapOffset, entry.length};
+}
+
+bool FingerprintStore::find(long songID, FingerprintView &view, double &duration, bool &mapped) const
+{
+    auto it = m_entries.find(songID);
+    if (it == m_entries.end())
+        return false;
+    view = entryFingerprint(it->second);
+    duration = it->second.duration;
+    mapped = it->second.mapped;
+    return true;
+}
+
+std::shared_ptr<MappedFile> FingerprintStore::mapping() const
+{
+    return m_mapping;
+}
+
+std::vector<long> FingerprintStore::sortedSongIDs() const
+{
+    std::vector<long> result;
+    result.reserve(m_entries.size());
+    for (const auto &it : m_entries)
+        result.push_back(it.first);
+    std::sort(result.begin(), result.end());
+    return result;
+}
+
+std::string FingerprintStore::path() const
+{
+    return m_path;
+}
+
+int FingerprintStore::size() const
+{
+    return m_entries.size();
+}
+
+bool FingerprintStore::contains(long songID) const
+{
+    return m_entries.find(songID) != m_entries.end();
+}
+
+boost::python::list FingerprintStore::songIDs() const
+{
+    boost::python::list result;
+    for (long songID : sortedSongIDs())
+        result.append(songID);
+    return result;
+}
+
+boost::python::list FingerprintStore::entries() const
+{
+    boost::python::list result;
+    for (long songID : sortedSongIDs())
+    {
+        const Entry &entry = m_entries.at(songID);
+        result.append(boost::python::make_tuple(songID, entry.stamp, entry.duration));
+    }
+    return result;
+}
+
+boost::python::list FingerprintStore::fingerprint(long songID) const
+{
+    boost::python::list result;
+    auto it = m_entries.find(songID);
+    if (it == m_entries.end())
+        return result;
+    const FingerprintView fp = entryFingerprint(it->second);
+    for (size_t i = 0; i < fp.size; ++i)
+        result.append(fp.data[i]);
+    return result;
+}
+
+size_t FingerprintStore::fileSize() const
+{
+    return m_dataEnd;
+}
+
+size_t FingerprintStore::deadBytes() const
+{
+    return m_deadBytes;
+}
+
+
+class FingerprintManager
+{
+public:
+    FingerprintManager();
+    void setMaxOffset(int maxoffset);
+    int maxOffset() const;
+
+    void setExpectedSize(int expectedSize);
+    int size() const;
+
+    void setCancelThreshold(double cancelThreshold);
+    double cancelThreshold() const;
+
+    void setShortSongCancelThreshold(double shortSongCancelThreshold);
+    double shortSongCancelThreshold() const;
+
+    void setShortSongLength(double shortSongLength);
+    double shortSongLength() const;
+
+    void setUseIndex(bool useIndex);
+    bool useIndex() const;
+
+    void setIndexBits(int indexBits);
+    int indexBits() const;
+
+    void setIndexStep(int indexStep);
+    int indexStep() const;
+
+    void setMinIndexVotes(int minIndexVotes);
+    int minIndexVotes() const;
+
+    void setMaxPostingsPerKey(int maxPostingsPerKey);
+    int maxPostingsPerKey() const;
+
+    long candidatesCount() const;
+
+    void setThreadCount(int threadCount);
+    int threadCount() const;
+
+    void setDurationTolerance(double durationTolerance);
+    double durationTolerance() const;
+
+    void setOffsetSearchMode(OffsetSearchMode offsetSearchMode);
+    OffsetSearchMode offsetSearchMode() const;
+
+    void setCoarseStep(int coarseStep);
+    int coarseStep() const;
+
+    void setCoarseCandidates(int coarseCandidates);
+    int coarseCandidates() const;
+
+    long comparedPairsCount() const;
+    long prunedPairsCount() const;
+    boost::python::dict sweepStatistics() const;
+
+    size_t memoryUsage() const;
+
+    void setStore(FingerprintStore &store);
+    void addSongsFromStore();
+    void releaseOldMappings();
+
+    void addSong(long songID, boost::python::object &fingerprint, double duration);
+    boost::python::list addSongAndCompare(long songID, boost::python::object &fingerprint, double duration);
+    boost::python::list addSongAndCompareToSongList(long songID, boost::python::object &fingerprint, double duration, boost::python::list &songsToCompare);
+    boost::python::list compareFingerprint(boost::python::object &fingerprint, double duration);
+    bool removeSong(long songID);
+    std::pair<int, double> compareSongs(long songID1, long songID2);
+    boost::python::list compareSongsVerbose(long songID1, long songID2);
+
+    std::pair<int, double> compareChromaprintFingerprintsAndOffset(FingerprintView fp1, FingerprintView fp2, double cancelThreshold, SweepStatistics &statistics) const;
+    std::pair<int, double> exhaustiveOffsetSearch(FingerprintView fp1, FingerprintView fp2, double cancelThreshold, SweepStatistics &statistics) const;
+    std::pair<int, double> coarseOffsetSearch(FingerprintView fp1, FingerprintView fp2, double cancelThreshold, SweepStatistics &statistics) const;
+    boost::python::list compareChromaprintFingerprintsAndOffsetVerbose(FingerprintView fp1, FingerprintView fp2) const;
+
+    boost::python::list songIDs();
+
+protected:
+    FingerprintView songFingerprint(const SongEntry &song) const;
+    SongVector::const_iterator songIterator(long songID) const;
+    void appendSong(long songID, const std::vector<uint32_t> &fingerprint, double duration);
+    void appendMappedSong(long songID, FingerprintView fingerprint, double duration);
+    void insertSong(const SongEntry &song);
+    void addToLookups(size_t songIndex);
+    void removeFromLookups(size_t songIndex);
+    void moveInLookups(size_t from, size_t to);
+    std::vector<SimilarityMatch> findMatches(FingerprintView fp, double duration);
+    const uint32_t *queryFingerprint(long songID, const boost::python::object &fingerprint, std::vector<uint32_t> &v);
+    void addQueriedSong(long songID, const std::vector<uint32_t> &v, const uint32_t *mapped, double duration);
+
+    uint32_t indexKey(uint32_t value) const;
+    void addToIndex(size_t songIndex);
+    std::vector<uint32_t> songIndexKeys(size_t songIndex) const;
+    void rebuildIndex();
+    std::vector<size_t> indexCandidates(FingerprintView fp) const;
+
+    long durationBucket(double duration) const;
+    bool similarDuration(double duration1, double duration2) const;
+    std::vector<size_t> durationCandidates(double duration) const;
+    void pruneByDuration(std::vector<size_t> &songIndexes, double duration);
+
+    std::vector<SimilarityMatch> compareWithSongs(FingerprintView fp, double duration, const std::vector<size_t> &songIndexes) const;
+    static boost::python::list toPythonList(const std::vector<SimilarityMatch> &matches);
+
+private:
+    int m_maxoffset = 50;
+    double m_cancelThreshold = 0.5;
+    double m_shortSongCancelThreshold = 0.6;
+    double m_shortSongLength = 30;
+
+    bool m_useIndex = false;
+    int m_indexBits = 16;
+    int m_indexStep = 4;
+    int m_minIndexVotes = 2;
+    int m_maxPostingsPerKey = 20000;
+    long m_candidatesCount = 0;
+    int m_threadCount = 0;
+    double m_durationTolerance = 0;
+    OffsetSearchMode m_offsetSearchMode = OffsetSearchMode::Exhaustive;
+    int m_coarseStep = 4;
+    int m_coarseCandidates = 3;
+    long m_comparedPairsCount = 0;
+    long m_prunedPairsCount = 0;
+    // Updated by compareWithSongs, which is const
+    mutable SweepStatistics m_sweepStatistics;
+
+    std::vector<uint32_t> m_arena;
+    SongVector m_songs;
+    // Index of each song ID in m_songs
+    std::unordered_map<long, uint32_t> m_songIndexes;
+    std::unordered_map<uint32_t, std::vector<IndexPosting>> m_index;
+    // Indexes of m_songs grouped in buckets of s_durationBucketSize seconds
+    std::map<long, std::vector<uint32_t>> m_durationBuckets;
+
+    FingerprintStore *m_store = nullptr;
+    std::vector<std::shared_ptr<MappedFile>> m_mappings;
+};
+
+FingerprintManager::FingerprintManager()
+{
+}
+
+
+void FingerprintManager::setMaxOffset(int maxoffset)
+{
+    m_maxoffset = maxoffset;
+}
+
+int FingerprintManager::maxOffset() const
+{
+    return m_maxoffset;
+}
+
+void FingerprintManager::setExpectedSize(int expectedSize)
+{
+    m_songs.reserve(expectedSize);
+}
+
+int FingerprintManager::size() const
+{
+    return m_songs.size();
+}
+
+void FingerprintManager::setCancelThreshold(double cancelThreshold)
+{
+    m_cancelThreshold = cancelThreshold;
+}
+
+double FingerprintManager::cancelThreshold() const
+{
+    return m_cancelThreshold;
+}
+
+void FingerprintManager::setShortSongCancelThreshold(double shortSongCancelThreshold)
+{
+    m_shortSongCancelThreshold = shortSongCancelThreshold;
+}
+
+double FingerprintManager::shortSongCancelThreshold() const
+{
+    return m_shortSongCancelThreshold;
+}
+
+void FingerprintManager::setShortSongLength(double shortSongLength)
+{
+    m_shortSongLength = shortSongLength;
+}
+
+double FingerprintManager::shortSongLength() const
+{
+    return m_shortSongLength;
+}
+
+void FingerprintManager::setUseIndex(bool useIndex)
+{
+    if (useIndex == m_useIndex)
+        return;
+    m_useIndex = useIndex;
+    rebuildIndex();
+}
+
+bool FingerprintManager::useIndex() const
+{
+    return m_useIndex;
+}
+
+void FingerprintManager::setIndexBits(int indexBits)
+{
+    m_indexBits = std::clamp(indexBits, 1, 32);
+    rebuildIndex();
+}
+
+int FingerprintManager::indexBits() const
+{
+    return m_indexBits;
+}
+
+void FingerprintManager::setIndexStep(int indexStep)
+{
+    m_indexStep = std::max(indexStep, 1);
+    rebuildIndex();
+}
+
+int FingerprintManager::indexStep() const
+{
+    return m_indexStep;
+}
+
+void FingerprintManager::setMinIndexVotes(int minIndexVotes)
+{
+    m_minIndexVotes = std::max(minIndexVotes, 1);
+}
+
+int FingerprintManager::minIndexVotes() const
+{
+    return m_minIndexVotes;
+}
+
+void FingerprintManager::setMaxPostingsPerKey(int maxPostingsPerKey)
+{
+    m_maxPostingsPerKey = maxPostingsPerKey;
+}
+
+int FingerprintManager::maxPostingsPerKey() const
+{
+    return m_maxPostingsPerKey;
+}
+
+long FingerprintManager::candidatesCount() const
+{
+    return m_candidatesCount;
+}
+
+void FingerprintManager::setThreadCount(int threadCount)
+{
+    m_threadCount = std::max(threadCount, 0);
+}
+
+/*
+ * Number of threads used to compare songs. 0 means to use as many threads
+ * as OpenMP uses by default (usually, the number of available cores).
+ */
+int FingerprintManager::threadCount() const
+{
+    return m_threadCount;
+}
+
+/*
+ * Songs whose durations differ in more than durationTolerance seconds are
+ * not compared. A value <= 0 compares all songs regardless of duration.
+ */
+void FingerprintManager::setDurationTolerance(double durationTolerance)
+{
+    m_durationTolerance = durationTolerance;
+}
+
+double FingerprintManager::durationTolerance() const
+{
+    return m_durationTolerance;
+}
+
+void FingerprintManager::setOffsetSearchMode(OffsetSearchMode offsetSearchMode)
+{
+    m_offsetSearchMode = offsetSearchMode;
+}
+
+OffsetSearchMode FingerprintManager::offsetSearchMode() const
+{
+    return m_offsetSearchMode;
+}
+
+/*
+ * In coarse mode, only one block of frames out of every coarseStep blocks
+ * is used to estimate the similarity at each offset.
+ */
+void FingerprintManager::setCoarseStep(int coarseStep)
+{
+    m_coarseStep = std::max(coarseStep, 1);
+}
+
+int FingerprintManager::coarseStep() const
+{
+    return m_coarseStep;
+}
+
+/*
+ * In coarse mode, number of offsets with the best estimated similarity
+ * that are compared exactly (together with their adjacent offsets).
+ */
+void FingerprintManager::setCoarseCandidates(int coarseCandidates)
+{
+    m_coarseCandidates = std::max(coarseCandidates, 1);
+}
 
-typedef long long fpint;
+int FingerprintManager::coarseCandidates() const
+{
+    return m_coarseCandidates;
+}
 
-template<typename T>
-inline
-std::vector<T> to_std_vector( const boost::python::object& iterable )
+long FingerprintManager::comparedPairsCount() const
 {
-    return std::vector<T>( boost::python::stl_input_iterator<T>( iterable ),
-                           boost::python::stl_input_iterator<T>( ) );
+    return m_comparedPairsCount;
 }
 
-template<typename T>
-long greet(boost::python::list &a)
+long FingerprintManager::prunedPairsCount() const
 {
-   auto v = to_std_vector<int>(a);
-   return v[0];
+    return m_prunedPairsCount;
 }
 
-boost::python::tuple greet2()
+boost::python::dict FingerprintManager::sweepStatistics() const
 {
-   int i1=-1442137496;
-   int i2=1786980374;
-   int a=__builtin_popcount(i1 ^ i2);
-   return boost::python::make_tuple(a,2,3);
+    boost::python::dict result;
+    result["sweeps"] = m_sweepStatistics.sweeps;
+    result["cancelled_sweeps"] = m_sweepStatistics.cancelledSweeps;
+    result["compared_frames"] = m_sweepStatistics.comparedFrames;
+    result["total_frames"] = m_sweepStatistics.totalFrames;
+    return result;
 }
 
-typedef std::vector<std::tuple<int,std::vector<fpint>,double> > FingerprintVector;
+size_t FingerprintManager::memoryUsage() const
+{
+    size_t result = m_arena.capacity() * sizeof(uint32_t) +
+                    m_songs.capacity() * sizeof(SongEntry);
+    for (const auto &it : m_index)
+        result += sizeof(it) + it.second.capacity() * sizeof(IndexPosting);
+    for (const auto &it : m_durationBuckets)
+        result += sizeof(it) + it.second.capacity() * sizeof(uint32_t);
+    result += m_songIndexes.size() * sizeof(std::pair<long, uint32_t>);
+    return result;
+}
 
-class FingerprintManager
+uint32_t FingerprintManager::indexKey(uint32_t value) const
 {
-public:
-    FingerprintManager();
-    void setMaxOffset(int maxoffset);
-    int maxOffset() const;
+    // The most significant bits of a chromaprint frame belong to a subset
+    // of its classifiers, so two frames sharing them are likely to come
+    // from the same audio.
+    return value >> (32 - m_indexBits);
+}
 
-    void setExpectedSize(int expectedSize);
-    int size() const;
+void FingerprintManager::addToIndex(size_t songIndex)
+{
+    const FingerprintView fp = songFingerprint(m_songs[songIndex]);
 
-    void setCancelThreshold(double cancelThreshold);
-    double cancelThreshold() const;
+    for (size_t i = 0; i < fp.size; i += m_indexStep)
+    {
+        m_index[indexKey(fp.data[i])].push_back({static_cast<uint32_t>(songIndex),
+                                                 static_cast<uint32_t>(i)});
+    }
+}
 
-    void setShortSongCancelThreshold(double shortSongCancelThreshold);
-    double shortSongCancelThreshold() const;
+/*
+ * Return the keys of the frames of a song in the index without repetitions,
+ * so each posting list is only traversed once when updating the song.
+ */
+std::vector<uint32_t> FingerprintManager::songIndexKeys(size_t songIndex) const
+{
+    const FingerprintView fp = songFingerprint(m_songs[songIndex]);
+    std::vector<uint32_t> keys;
+    for (size_t i = 0; i < fp.size; i += m_indexStep)
+        keys.push_back(indexKey(fp.data[i]));
+    std::sort(keys.begin(), keys.end());
+    keys.erase(std::unique(keys.begin(), keys.end()), keys.end());
+    return keys;
+}
 
-    void setShortSongLength(double shortSongLength);
-    double shortSongLength() const;
+void FingerprintManager::rebuildIndex()
+{
+    m_index.clear();
+    if (!m_useIndex)
+        return;
 
-    void addSong(long songID, boost::python::list &fingerprint, double duration);
-    boost::python::list addSongAndCompare(long songID, boost::python::list &fingerprint, double duration);
-    boost::python::list addSongAndCompareToSongList(long songID, boost::python::list &fingerprint, double duration, boost::python::list &songsToCompare);
-    std::pair<int, double> compareSongs(long songID1, long songID2);
-    boost::python::list compareSongsVerbose(long songID1, long songID2);
+    for (size_t i = 0; i < m_songs.size(); ++i)
+        addToIndex(i);
+}
 
-    std::pair<int, double> compareChromaprintFingerprintsAndOffset(const std::vector<fpint> &fp1, const std::vector<fpint> &fp2, double cancelThreshold) const;
-    boost::python::list compareChromaprintFingerprintsAndOffsetVerbose(std::vector<fpint> fp1, std::vector<fpint> fp2) const;
+std::vector<size_t> FingerprintManager::indexCandidates(FingerprintView fp) const
+{
+    // Every query frame votes for the (song, offset) pairs whose indexed
+    // frames share its key. Songs that get enough votes at a single offset
+    // are the candidates that will be compared with the full sweep.
+    std::unordered_map<uint64_t, int> votes;
+    std::vector<size_t> candidates;
+    const uint64_t offsetRange = 2 * m_maxoffset;
 
-    boost::python::list songIDs();
+    for (size_t j = 0; j < fp.size; ++j)
+    {
+        auto it = m_index.find(indexKey(fp.data[j]));
+        if (it == m_index.end() || it->second.size() > static_cast<size_t>(m_maxPostingsPerKey))
+            continue;
 
+        for (const IndexPosting &posting : it->second)
+        {
+            const long offset = static_cast<long>(j) - posting.position;
+            if (offset >= m_maxoffset || offset <= -m_maxoffset)
+                continue;
 
-    boost::python::object writeToFile(const std::string &filename);
-    boost::python::object readFromFile(const std::string &filename);
+            const uint64_t key = posting.songIndex * offsetRange + (offset + m_maxoffset);
+            if (++votes[key] == m_minIndexVotes)
+                candidates.push_back(posting.songIndex);
+        }
+    }
 
-protected:
-    std::vector<fpint> songFingerprint(int songID) const;
-    double songDuration(int songID) const;
-    FingerprintVector::const_iterator songIterator(int songID) const;
+    std::sort(candidates.begin(), candidates.end());
+    candidates.erase(std::unique(candidates.begin(), candidates.end()), candidates.end());
+    return candidates;
+}
 
-private:
-    int m_maxoffset = 50;
-    double m_cancelThreshold = 0.5;
-    double m_shortSongCancelThreshold = 0.6;
-    double m_shortSongLength = 30;
+static const double s_durationBucketSize = 10.0;
 
-    FingerprintVector m_fingerprints;
-};
+long FingerprintManager::durationBucket(double duration) const
+{
+    return static_cast<long>(std::floor(duration / s_durationBucketSize));
+}
 
-FingerprintManager::FingerprintManager()
+bool FingerprintManager::similarDuration(double duration1, double duration2) const
 {
+    return m_durationTolerance <= 0 || std::abs(duration1 - duration2) <= m_durationTolerance;
 }
 
+/*
+ * Return the indexes of the songs with a duration similar to duration,
+ * sorted so m_songs is traversed in order.
+ */
+std::vector<size_t> FingerprintManager::durationCandidates(double duration) const
+{
+    std::vector<size_t> candidates;
+    if (m_durationTolerance <= 0)
+    {
+        candidates.resize(m_songs.size());
+        std::iota(candidates.begin(), candidates.end(), 0);
+        return candidates;
+    }
 
-void FingerprintManager::setMaxOffset(int maxoffset)
+    auto it = m_durationBuckets.lower_bound(durationBucket(duration - m_durationTolerance));
+    const auto end = m_durationBuckets.upper_bound(durationBucket(duration + m_durationTolerance));
+    for (; it != end; ++it)
+    {
+        for (uint32_t songIndex : it->second)
+            if (similarDuration(duration, m_songs[songIndex].duration))
+                candidates.push_back(songIndex);
+    }
+    std::sort(candidates.begin(), candidates.end());
+    return candidates;
+}
+
+void FingerprintManager::pruneByDuration(std::vector<size_t> &songIndexes, double duration)
 {
-    m_maxoffset = maxoffset;
+    const size_t size = songIndexes.size();
+    songIndexes.erase(std::remove_if(songIndexes.begin(), songIndexes.end(),
+        [&](size_t songIndex)
+        { return !similarDuration(duration, m_songs[songIndex].duration);
+        }), songIndexes.end());
+    m_prunedPairsCount += size - songIndexes.size();
 }
 
-int FingerprintManager::maxOffset() const
+SongVector::const_iterator FingerprintManager::songIterator(long songID) const
 {
-    return m_maxoffset;
+    auto it = m_songIndexes.find(songID);
+    if (it == m_songIndexes.end())
+    {
+        std::cout << "Fingerprint not found for song ID " << songID << " . size: " << m_songs.size() << std::endl;
+
+        return m_songs.end();
+    }
+    else
+        return m_songs.begin() + it->second;
 }
 
-void FingerprintManager::setExpectedSize(int expectedSize)
+FingerprintView FingerprintManager::songFingerprint(const SongEntry &song) const
 {
-    m_fingerprints.reserve(expectedSize);
+    if (song.mapped)
+        return {song.mapped, song.length};
+    return {m_arena.data() + song.offset, song.length};
 }
 
-int FingerprintManager::size() const
+void FingerprintManager::appendSong(long songID, const std::vector<uint32_t> &fingerprint, double duration)
 {
-    return m_fingerprints.size();
+    const size_t offset = m_arena.size();
+    m_arena.insert(m_arena.end(), fingerprint.begin(), fingerprint.end());
+    insertSong({songID, offset, static_cast<uint32_t>(fingerprint.size()), duration, nullptr});
 }
 
-void FingerprintManager::setCancelThreshold(double cancelThreshold)
+void FingerprintManager::appendMappedSong(long songID, FingerprintView fingerprint, double duration)
 {
-    m_cancelThreshold = cancelThreshold;
+    if (m_mappings.empty() || m_mappings.back() != m_store->mapping())
+        m_mappings.push_back(m_store->mapping());
+    insertSong({songID, 0, static_cast<uint32_t>(fingerprint.size), duration, fingerprint.data});
 }
 
-double FingerprintManager::cancelThreshold() const
+/*
+ * The position of a song in m_songs doesn't change while it's in the
+ * manager, so m_index and m_durationBuckets are updated with just the
+ * postings and bucket of the songs inserted or removed. A song that
+ * replaces another one with the same ID takes its position and a removed
+ * song is replaced by the last one. The fingerprint of a replaced song is
+ * kept in the arena.
+ */
+void FingerprintManager::insertSong(const SongEntry &song)
 {
-    return m_cancelThreshold;
+    auto it = m_songIndexes.find(song.songID);
+    if (it != m_songIndexes.end())
+    {
+        removeFromLookups(it->second);
+        m_songs[it->second] = song;
+        addToLookups(it->second);
+        return;
+    }
+
+    m_songIndexes[song.songID] = m_songs.size();
+    m_songs.push_back(song);
+    addToLookups(m_songs.size() - 1);
 }
 
-void FingerprintManager::setShortSongCancelThreshold(double shortSongCancelThreshold)
+bool FingerprintManager::removeSong(long songID)
 {
-    m_shortSongCancelThreshold = shortSongCancelThreshold;
+    auto it = m_songIndexes.find(songID);
+    if (it == m_songIndexes.end())
+        return false;
+    const size_t songIndex = it->second;
+    m_songIndexes.erase(it);
+
+    removeFromLookups(songIndex);
+    const size_t last = m_songs.size() - 1;
+    if (songIndex != last)
+    {
+        moveInLookups(last, songIndex);
+        m_songs[songIndex] = m_songs[last];
+        m_songIndexes[m_songs[songIndex].songID] = songIndex;
+    }
+    m_songs.pop_back();
+    return true;
 }
 
-double FingerprintManager::shortSongCancelThreshold() const
+void FingerprintManager::addToLookups(size_t songIndex)
 {
-    return m_shortSongCancelThreshold;
+    m_durationBuckets[durationBucket(m_songs[songIndex].duration)].push_back(songIndex);
+    if (m_useIndex)
+        addToIndex(songIndex);
 }
 
-void FingerprintManager::setShortSongLength(double shortSongLength)
+void FingerprintManager::removeFromLookups(size_t songIndex)
 {
-    m_shortSongLength = shortSongLength;
+    auto bucket = m_durationBuckets.find(durationBucket(m_songs[songIndex].duration));
+    bucket->second.erase(std::find(bucket->second.begin(), bucket->second.end(), songIndex));
+    if (bucket->second.empty())
+        m_durationBuckets.erase(bucket);
+
+    if (!m_useIndex)
+        return;
+    for (uint32_t key : songIndexKeys(songIndex))
+    {
+        auto postings = m_index.find(key);
+        postings->second.erase(std::remove_if(postings->second.begin(), postings->second.end(),
+            [songIndex](const IndexPosting &posting)
+            { return posting.songIndex == songIndex;
+            }), postings->second.end());
+        if (postings->second.empty())
+            m_index.erase(postings);
+    }
 }
 
-double FingerprintManager::shortSongLength() const
+/*
+ * Make the postings and bucket entry of the song at index from refer to
+ * index to, before the song is moved there.
+ */
+void FingerprintManager::moveInLookups(size_t from, size_t to)
 {
-    return m_shortSongLength;
+    auto &bucket = m_durationBuckets[durationBucket(m_songs[from].duration)];
+    *std::find(bucket.begin(), bucket.end(), from) = to;
+
+    if (!m_useIndex)
+        return;
+    for (uint32_t key : songIndexKeys(from))
+    {
+        for (IndexPosting &posting : m_index[key])
+            if (posting.songIndex == from)
+                posting.songIndex = to;
+    }
 }
 
-FingerprintVector::const_iterator FingerprintManager::songIterator(int songID) const
+void FingerprintManager::setStore(FingerprintStore &store)
 {
-    auto it = std::lower_bound( m_fingerprints.begin(), m_fingerprints.end(), songID,
-            [](auto x, auto y)
-            { return std::get<0>(x) < y;
-            });
-    if (it == m_fingerprints.end())
+    m_store = &store;
+}
+
+/*
+ * Return the fingerprint to compare for songID. If fingerprint is None, it's
+ * obtained from the store and if it's in the mapped file, a pointer to it is
+ * returned so it can be added without copying it. Otherwise, it's copied to v.
+ */
+const uint32_t *FingerprintManager::queryFingerprint(long songID, const boost::python::object &fingerprint, std::vector<uint32_t> &v)
+{
+    if (!fingerprint.is_none())
     {
-        std::cout << "Fingerprint not found for song ID " << songID << " . size: " << m_fingerprints.size() << " . first: " << std::get<0>(m_fingerprints[0]) << std::endl;
+        v = toFingerprint(fingerprint);
+        return nullptr;
+    }
 
-        return FingerprintVector::iterator();
+    FingerprintView view;
+    double duration;
+    bool mapped;
+    if (!m_store || !m_store->find(songID, view, duration, mapped))
+    {
+        PyErr_SetString(PyExc_KeyError, ("Fingerprint not found in store for song ID " + std::to_string(songID)).c_str());
+        boost::python::throw_error_already_set();
     }
+    v.assign(view.data, view.data + view.size);
+    return mapped ? view.data : nullptr;
+}
+
+void FingerprintManager::addQueriedSong(long songID, const std::vector<uint32_t> &v, const uint32_t *mapped, double duration)
+{
+    if (mapped)
+        appendMappedSong(songID, {mapped, v.size()}, duration);
     else
-        return it;
+        appendSong(songID, v, duration);
 }
 
-std::vector<fpint> FingerprintManager::songFingerprint(int songID) const
+void FingerprintManager::addSongsFromStore()
 {
-    return std::get<1>(*songIterator(songID));
+    if (!m_store)
+        return;
+
+    FingerprintView view;
+    double duration;
+    bool mapped;
+    for (long songID : m_store->sortedSongIDs())
+    {
+        m_store->find(songID, view, duration, mapped);
+        if (mapped)
+            appendMappedSong(songID, view, duration);
+        else
+            appendSong(songID, std::vector<uint32_t>(view.data, view.data + view.size), duration);
+    }
 }
 
-double FingerprintManager::songDuration(int songID) const
+/*
+ * Point the mapped songs to the current mapping of the store and release the
+ * mappings that aren't used by any song anymore. This should be called after
+ * the store is reloaded or compacted, since the songs added before still use
+ * the previous mappings of the file.
+ */
+void FingerprintManager::releaseOldMappings()
 {
-    return std::get<2>(*songIterator(songID));
+    if (!m_store)
+        return;
+
+    FingerprintView view;
+    double duration;
+    bool mapped;
+    for (SongEntry &song : m_songs)
+    {
+        if (song.mapped && m_store->find(song.songID, view, duration, mapped) &&
+            mapped && view.size == song.length)
+            song.mapped = view.data;
+    }
+
+    std::vector<std::shared_ptr<MappedFile>> mappings;
+    mappings.swap(m_mappings);
+    mappings.push_back(m_store->mapping());
+    for (const auto &mapping : mappings)
+    {
+        if (!mapping || std::find(m_mappings.begin(), m_mappings.end(), mapping) != m_mappings.end())
+            continue;
+        const uintptr_t begin = reinterpret_cast<uintptr_t>(mapping->data());
+        const uintptr_t end = begin + mapping->size();
+        const bool used = std::any_of(m_songs.begin(), m_songs.end(),
+            [&](const SongEntry &song)
+            { const uintptr_t data = reinterpret_cast<uintptr_t>(song.mapped);
+              return data >= begin && data < end;
+            });
+        if (used)
+            m_mappings.push_back(mapping);
+    }
 }
 
-void FingerprintManager::addSong(long songID, boost::python::list &fingerprint, double duration)
+void FingerprintManager::addSong(long songID, boost::python::object &fingerprint, double duration)
 {
-    auto v = to_std_vector<fpint>(fingerprint);
-    v.insert(v.begin(), m_maxoffset, 0);
 //    std::cout << "song added: " << songID << std::endl;
-    m_fingerprints.emplace_back(std::make_tuple(songID, std::move(v), duration));
+    std::vector<uint32_t> v;
+    const uint32_t *mapped = queryFingerprint(songID, fingerprint, v);
+    addQueriedSong(songID, v, mapped, duration);
 }
 
-boost::python::list FingerprintManager::addSongAndCompare(long songID, boost::python::list &fingerprint, double duration)
+/*
+ * Compare fp with the songs at songIndexes in m_songs using m_threadCount
+ * threads. Each thread collects the matches in its own vector and they're
+ * merged at the end sorted by song ID. This doesn't use any python object,
+ * so it can be called without holding the GIL.
+ */
+std::vector<SimilarityMatch> FingerprintManager::compareWithSongs(FingerprintView fp, double duration, const std::vector<size_t> &songIndexes) const
 {
-    std::mutex result_mutex;
-    boost::python::list result;
-#if __GNUC__ >= 7 || __clang_major__ >= 5
-    auto v = to_std_vector<fpint>(fingerprint);
-    double threshold;
-    v.insert(v.begin(), m_maxoffset, 0);
+    const int threads = m_threadCount > 0 ? m_threadCount : omp_get_max_threads();
+    std::vector<std::vector<SimilarityMatch>> threadMatches(threads);
+
+    #pragma omp parallel num_threads(threads)
+    {
+        // Each thread counts its own sweeps so sweepOffset doesn't need any
+        // lock
+        SweepStatistics statistics;
 
-    __gnu_parallel::for_each(m_fingerprints.begin(), m_fingerprints.end(),
-        [&](const auto &itSong)
+        #pragma omp for schedule(dynamic, 16)
+        for (size_t i = 0; i < songIndexes.size(); ++i)
         {
-            auto & [itSongID, itFingerprint, itDuration] = itSong;
-            if (duration < m_shortSongLength || itDuration < m_shortSongLength)
-                threshold = m_shortSongCancelThreshold;
-            else
-                threshold = m_cancelThreshold;
-            auto [offset, similarity] = compareChromaprintFingerprintsAndOffset(itFingerprint, v, threshold);
+            const SongEntry &song = m_songs[songIndexes[i]];
+            const double threshold = (duration < m_shortSongLength || song.duration < m_shortSongLength) ?
+                m_shortSongCancelThreshold : m_cancelThreshold;
+            auto [offset, similarity] = compareChromaprintFingerprintsAndOffset(songFingerprint(song), fp, threshold, statistics);
             if (similarity > threshold)
-            {
-                result_mutex.lock();
-                result.append(boost::python::make_tuple(itSongID, offset, similarity));
-                result_mutex.unlock();
-            }
-        }, __gnu_parallel::parallel_balanced);
-    m_fingerprints.emplace_back(songID, std::move(v), duration);
+                threadMatches[omp_get_thread_num()].push_back({song.songID, offset, similarity});
+        }
+
+        #pragma omp critical
+        m_sweepStatistics += statistics;
+    }
+
+    std::vector<SimilarityMatch> matches;
+    for (auto &v : threadMatches)
+        matches.insert(matches.end(), v.begin(), v.end());
+    std::sort(matches.begin(), matches.end(),
+        [](const SimilarityMatch &a, const SimilarityMatch &b)
+        { return a.songID < b.songID; });
+    return matches;
+}
+
+boost::python::list FingerprintManager::toPythonList(const std::vector<SimilarityMatch> &matches)
+{
+    boost::python::list result;
+    for (const SimilarityMatch &match : matches)
+        result.append(boost::python::make_tuple(match.songID, match.offset, match.similarity));
+    return result;
+}
+
+/*
+ * Return the songs similar to fp. This releases the GIL, so it must be
+ * called while holding it.
+ */
+std::vector<SimilarityMatch> FingerprintManager::findMatches(FingerprintView fp, double duration)
+{
+    ReleaseGIL releaseGIL;
+    std::vector<size_t> songIndexes;
+    if (m_useIndex)
+    {
+        songIndexes = indexCandidates(fp);
+        m_candidatesCount += songIndexes.size();
+        pruneByDuration(songIndexes, duration);
+    }
+    else
+    {
+        songIndexes = durationCandidates(duration);
+        m_prunedPairsCount += m_songs.size() - songIndexes.size();
+    }
+    m_comparedPairsCount += songIndexes.size();
+    return compareWithSongs(fp, duration, songIndexes);
+}
+
+boost::python::list FingerprintManager::addSongAndCompare(long songID, boost::python::object &fingerprint, double duration)
+{
+#if __GNUC__ >= 7 || __clang_major__ >= 5
+    std::vector<uint32_t> v;
+    const uint32_t *mapped = queryFingerprint(songID, fingerprint, v);
+    const std::vector<SimilarityMatch> matches = findMatches(toView(v), duration);
+    addQueriedSong(songID, v, mapped, duration);
+    return toPythonList(matches);
 #else
     #warning Support to compare audio signatures will not be built
     std::cout << "The support to compare audio signatures was not built since the compiler was too old" << std::endl;
+    return boost::python::list();
 #endif
-    return result;
 }
 
-boost::python::list FingerprintManager::addSongAndCompareToSongList(long songID, boost::python::list &fingerprint, double duration, boost::python::list &songsToCompare)
+boost::python::list FingerprintManager::addSongAndCompareToSongList(long songID, boost::python::object &fingerprint, double duration, boost::python::list &songsToCompare)
 {
-    std::mutex result_mutex;
-    boost::python::list result;
 #if __GNUC__ >= 7 || __clang_major__ >= 5
-    auto v = to_std_vector<fpint>(fingerprint);
-    auto songIDsToCompare = to_std_vector<long>(songsToCompare);
-    double threshold;
-    v.insert(v.begin(), m_maxoffset, 0);
+    std::vector<uint32_t> v;
+    const uint32_t *mapped = queryFingerprint(songID, fingerprint, v);
+    const FingerprintView fp = toView(v);
+    std::vector<size_t> songIndexes;
+    for (long itSongID : to_std_vector<long>(songsToCompare))
+    {
+        auto itSong = songIterator(itSongID);
+        if (itSong != m_songs.end())
+            songIndexes.push_back(itSong - m_songs.begin());
+    }
+    pruneByDuration(songIndexes, duration);
+    m_comparedPairsCount += songIndexes.size();
+    std::vector<SimilarityMatch> matches;
 
-    __gnu_parallel::for_each(songIDsToCompare.begin(), songIDsToCompare.end(),
-        [&](const long &itSongID)
-        {
-            auto & [_ , itFingerprint, itDuration] = *songIterator(itSongID);
-            if (duration < m_shortSongLength || itDuration < m_shortSongLength)
-                threshold = m_shortSongCancelThreshold;
-            else
-                threshold = m_cancelThreshold;
-            auto [offset, similarity] = compareChromaprintFingerprintsAndOffset(itFingerprint, v, threshold);
-            if (similarity > threshold)
-            {
-                result_mutex.lock();
-                result.append(boost::python::make_tuple(itSongID, offset, similarity));
-                result_mutex.unlock();
-            }
-        }, __gnu_parallel::parallel_balanced);
-    m_fingerprints.emplace_back(songID, std::move(v), duration);
+    {
+        ReleaseGIL releaseGIL;
+        matches = compareWithSongs(fp, duration, songIndexes);
+    }
+    addQueriedSong(songID, v, mapped, duration);
+    return toPythonList(matches);
 #else
     std::cout << "The support to compare audio signatures was not built since the compiler was too old" << std::endl;
+    return boost::python::list();
 #endif
-    return result;
 }
 
-std::pair<int, double> FingerprintManager::compareChromaprintFingerprintsAndOffset(const std::vector<fpint> &fp1, const std::vector<fpint> &fp2, double cancelThreshold) const
+/*
+ * Return the songs similar to a fingerprint without adding it.
+ */
+boost::python::list FingerprintManager::compareFingerprint(boost::python::object &fingerprint, double duration)
 {
-    std::vector<fpint>::const_iterator it1, it2;
-    int offset;
-    int total_idx;
-    int remaining;
-    int threshold_bits;
-    int equal_bits, total_bits;
-    double best_result = -1;
-    int best_offset = -1;
-    bool ok;
-    for (offset=0; offset < m_maxoffset; ++offset)
+#if __GNUC__ >= 7 || __clang_major__ >= 5
+    const std::vector<uint32_t> v = toFingerprint(fingerprint);
+    return toPythonList(findMatches(toView(v), duration));
+#else
+    std::cout << "The support to compare audio signatures was not built since the compiler was too old" << std::endl;
+    return boost::python::list();
+#endif
+}
+
+/*
+ * Compare two fingerprints shifting one of them up to maxoffset frames.
+ * A shifted fingerprint is compared as if it was preceded by frames with
+ * all bits set to 0 (which is how fingerprints were padded originally).
+ *
+ * The number of equal bits is accumulated in blocks so the xor/popcount
+ * kernel can process many frames at once. The cancel condition is checked
+ * after each block. Since equal_bits + remaining can only decrease, this
+ * cancels exactly the same comparisons as checking it after every frame.
+ */
+static const size_t s_compareBlockSize = 64;
+
+static bool sweepOffset(const uint32_t *shifted, size_t shiftedSize,
+                        const uint32_t *other, size_t otherSize,
+                        int offset, double cancelThreshold,
+                        SweepStatistics &statistics, double *result)
+{
+    const size_t total_idx = std::min(shiftedSize + offset, otherSize);
+    const int total_bits = total_idx * 32;
+    const int threshold_bits = total_bits * cancelThreshold;
+    int remaining = total_bits;
+    int equal_bits = 0;
+    ++statistics.sweeps;
+    statistics.totalFrames += total_idx;
+
+    // Padding frames
+    const size_t padding = std::min(static_cast<size_t>(offset), total_idx);
+    equal_bits += padding * 32 - popcount(other, padding);
+    remaining -= padding * 32;
+    if (equal_bits + remaining < threshold_bits)
+    {
+        ++statistics.cancelledSweeps;
+        statistics.comparedFrames += padding;
+        return false;
+    }
+
+    for (size_t idx = padding; idx < total_idx; idx += s_compareBlockSize)
     {
-//        std::cout << "offset " << offset << "----------" << std::endl;
-        it1 = fp1.cbegin() + (m_maxoffset - offset);
-        it2 = fp2.cbegin() + m_maxoffset;
-        ok = true;
-        equal_bits = 0;
-        total_idx = std::min(fp1.size()-m_maxoffset+offset, fp2.size()-m_maxoffset);
-//        std::cout << "total_idx " << total_idx << std::endl;
-        remaining = total_bits = total_idx * 32;
-        threshold_bits = total_bits * cancelThreshold;
-//        std::cout << "threshold " << threshold_bits << std::endl;
-        int idx=0;
-        for (; it1!=fp1.end() && it2!=fp2.end() ; ++it1, ++it2, ++idx)
+        const size_t n = std::min(s_compareBlockSize, total_idx - idx);
+        equal_bits += n * 32 - xorPopcount(shifted + idx - offset, other + idx, n);
+        remaining -= n * 32;
+        if (equal_bits + remaining < threshold_bits)
         {
-//            std::cout << "(" << (idx-offset) << ") " << *it1 << " (" << idx << ") " << *it2 << std::endl;
-            equal_bits += 32 - __builtin_popcount(*it1 ^ *it2);
-            remaining -= 32;
-//            std::cout << "equal_bits " << equal_bits << "  remaining " << remaining << " threshold_bits " << threshold_bits << std::endl;
-            if (equal_bits + remaining < threshold_bits)
-            {
-                ok = false;
-//                std::cout << "break" << *it2 << std::endl;
-                break;
-            }
+            ++statistics.cancelledSweeps;
+            statistics.comparedFrames += idx + n;
+            return false;
         }
-       if (ok)
-       {
-           double result = equal_bits/(double)total_bits;
-           if (result > best_result)
-           {
-               best_result = result;
-               best_offset = offset;
-           }
-       }
     }
-    for (offset=1; offset < m_maxoffset; ++offset)
+    statistics.comparedFrames += total_idx;
+    *result = equal_bits / (double)total_bits;
+    return true;
+}
+
+static double sweepOffsetVerbose(const uint32_t *shifted, size_t shiftedSize,
+                                 const uint32_t *other, size_t otherSize,
+                                 int offset)
+{
+    const size_t total_idx = std::min(shiftedSize + offset, otherSize);
+    const size_t padding = std::min(static_cast<size_t>(offset), total_idx);
+    const int total_bits = total_idx * 32;
+    const int equal_bits = total_bits - popcount(other, padding)
+        - xorPopcount(shifted + padding - offset, other + padding, total_idx - padding);
+
+    return equal_bits / (double)total_bits;
+}
+
+/*
+ * Estimate the similarity of two fingerprints at an offset comparing only
+ * one block of s_coarseBlockSize frames out of every step blocks. Padding
+ * frames are cheap to count, so they're always counted exactly.
+ */
+static const size_t s_coarseBlockSize = 16;
+
+static double coarseSweepOffset(const uint32_t *shifted, size_t shiftedSize,
+                                const uint32_t *other, size_t otherSize,
+                                int offset, int step)
+{
+    const size_t total_idx = std::min(shiftedSize + offset, otherSize);
+    const size_t padding = std::min(static_cast<size_t>(offset), total_idx);
+    long sampled_bits = padding * 32;
+    long equal_bits = padding * 32 - popcount(other, padding);
+
+    for (size_t idx = padding; idx < total_idx; idx += s_coarseBlockSize * step)
+    {
+        const size_t n = std::min(s_coarseBlockSize, total_idx - idx);
+        equal_bits += n * 32 - xorPopcount(shifted + idx - offset, other + idx, n);
+        sampled_bits += n * 32;
+    }
+    return sampled_bits ? equal_bits / (double)sampled_bits : 0;
+}
+
+std::pair<int, double> FingerprintManager::compareChromaprintFingerprintsAndOffset(FingerprintView fp1, FingerprintView fp2, double cancelThreshold, SweepStatistics &statistics) const
+{
+    if (m_offsetSearchMode == OffsetSearchMode::Coarse)
+        return coarseOffsetSearch(fp1, fp2, cancelThreshold, statistics);
+    return exhaustiveOffsetSearch(fp1, fp2, cancelThreshold, statistics);
+}
+
+/*
+ * Estimate the similarity at every offset with coarseSweepOffset and only
+ * compare exactly the best m_coarseCandidates offsets and the offsets next
+ * to them. Candidates are compared in the same order as in the exhaustive
+ * search, so both return the same result when the best offset is found.
+ */
+std::pair<int, double> FingerprintManager::coarseOffsetSearch(FingerprintView fp1, FingerprintView fp2, double cancelThreshold, SweepStatistics &statistics) const
+{
+    if (m_maxoffset <= 0)
+        return std::make_pair(-1, -1.0);
+
+    // Offsets are stored as 0 .. maxoffset-1 for fp1 shifted by offset and
+    // maxoffset .. 2*maxoffset-2 for fp2 shifted by 1 .. maxoffset-1
+    const int offsetsCount = 2 * m_maxoffset - 1;
+    auto signedOffset = [&](int i) { return i < m_maxoffset ? i : m_maxoffset - 1 - i; };
+
+    std::vector<double> estimates(offsetsCount);
+    for (int i = 0; i < offsetsCount; ++i)
+    {
+        const int offset = signedOffset(i);
+        estimates[i] = (offset >= 0) ?
+            coarseSweepOffset(fp1.data, fp1.size, fp2.data, fp2.size, offset, m_coarseStep) :
+            coarseSweepOffset(fp2.data, fp2.size, fp1.data, fp1.size, -offset, m_coarseStep);
+    }
+
+    std::vector<int> order(offsetsCount);
+    std::iota(order.begin(), order.end(), 0);
+    const int best = std::min(m_coarseCandidates, offsetsCount);
+    std::partial_sort(order.begin(), order.begin() + best, order.end(),
+        [&](int a, int b) { return estimates[a] > estimates[b]; });
+
+    std::vector<int> candidates;
+    for (int k = 0; k < best; ++k)
     {
-//        std::cout << "offset " << offset << "----------" << std::endl;
-        it1 = fp1.cbegin() + m_maxoffset;
-        it2 = fp2.cbegin() + (m_maxoffset - offset);
-        ok = true;
-        equal_bits = 0;
-        total_idx = std::min(fp1.size()-m_maxoffset, fp2.size()-m_maxoffset+offset);
-//        std::cout << "total_idx " << total_idx << std::endl;
-        remaining = total_bits = total_idx * 32;
-        threshold_bits = total_bits * cancelThreshold;
-//        std::cout << "threshold " << threshold_bits << std::endl;
-        int idx = 0;
-        for (; it1!=fp1.end() && it2!=fp2.end() ; ++it1, ++it2, ++idx)
+        const int offset = signedOffset(order[k]);
+        for (int neighbour = offset - 1; neighbour <= offset + 1; ++neighbour)
         {
-//            std::cout << "(" << (idx) << ") " << *it1 << " (" << idx-offset << ") " << *it2 << std::endl;
-            equal_bits += 32 - __builtin_popcount(*it1 ^ *it2);
-            remaining -= 32;
-//            std::cout << "equal_bits " << equal_bits << "  remaining " << remaining << " threshold_bits " << threshold_bits << std::endl;
-            if (equal_bits + remaining < threshold_bits)
-            {
-                ok = false;
-//                std::cout << "break" << *it2 << std::endl;
-                break;
-            }
+            if (neighbour > -m_maxoffset && neighbour < m_maxoffset)
+                candidates.push_back(neighbour >= 0 ? neighbour : m_maxoffset - 1 - neighbour);
         }
-        if (ok)
+    }
+    std::sort(candidates.begin(), candidates.end());
+    candidates.erase(std::unique(candidates.begin(), candidates.end()), candidates.end());
+
+    double best_result = -1;
+    int best_offset = -1;
+    double result;
+    for (int i : candidates)
+    {
+        const int offset = signedOffset(i);
+        const bool found = (offset >= 0) ?
+            sweepOffset(fp1.data, fp1.size, fp2.data, fp2.size, offset, cancelThreshold, statistics, &result) :
+            sweepOffset(fp2.data, fp2.size, fp1.data, fp1.size, -offset, cancelThreshold, statistics, &result);
+        if (found && result > best_result)
         {
-            double result = equal_bits/(double)total_bits;
-            if (result > best_result)
-            {
-                best_result = result;
-                best_offset = -offset;
-            }
+            best_result = result;
+            best_offset = offset;
         }
     }
     return std::make_pair(best_offset, best_result);
 }
 
-boost::python::list FingerprintManager::compareChromaprintFingerprintsAndOffsetVerbose(std::vector<fpint> fp1, std::vector<fpint> fp2) const
+std::pair<int, double> FingerprintManager::exhaustiveOffsetSearch(FingerprintView fp1, FingerprintView fp2, double cancelThreshold, SweepStatistics &statistics) const
 {
-    std::vector<fpint>::const_iterator it1, it2;
-    boost::python::list result;
     int offset;
-    int equal_bits, total_bits;
+    double best_result = -1;
+    int best_offset = -1;
+    double result;
     for (offset=0; offset < m_maxoffset; ++offset)
     {
-        it1 = fp1.cbegin() + (m_maxoffset - offset);
-        it2 = fp2.cbegin() + m_maxoffset;
-        total_bits = std::min(fp1.size()-m_maxoffset+offset, fp2.size()-m_maxoffset) * 32;
-        equal_bits = 0;
-        for (; it1!=fp1.end() && it2!=fp2.end() ; ++it1, ++it2)
+        if (sweepOffset(fp1.data, fp1.size, fp2.data, fp2.size, offset, cancelThreshold, statistics, &result) &&
+            result > best_result)
         {
-            equal_bits += 32 - __builtin_popcount(*it1 ^ *it2);
+            best_result = result;
+            best_offset = offset;
         }
-        result.append(boost::python::make_tuple(offset, equal_bits/(double)total_bits));
     }
     for (offset=1; offset < m_maxoffset; ++offset)
     {
-        it1 = fp1.cbegin() + m_maxoffset;
-        it2 = fp2.cbegin() + (m_maxoffset - offset);
-        total_bits = std::min(fp1.size()-m_maxoffset, fp2.size()-m_maxoffset+offset) * 32;
-        equal_bits = 0;
-        for (; it1!=fp1.end() && it2!=fp2.end() ; ++it1, ++it2)
+        if (sweepOffset(fp2.data, fp2.size, fp1.data, fp1.size, offset, cancelThreshold, statistics, &result) &&
+            result > best_result)
         {
-            equal_bits += 32 - __builtin_popcount(*it1 ^ *it2);
+            best_result = result;
+            best_offset = -offset;
         }
-        result.append(boost::python::make_tuple(-offset, equal_bits/(double)total_bits));
+    }
+    return std::make_pair(best_offset, best_result);
+}
+
+boost::python::list FingerprintManager::compareChromaprintFingerprintsAndOffsetVerbose(FingerprintView fp1, FingerprintView fp2) const
+{
+    boost::python::list result;
+    int offset;
+    for (offset=0; offset < m_maxoffset; ++offset)
+    {
+        result.append(boost::python::make_tuple(offset, sweepOffsetVerbose(fp1.data, fp1.size, fp2.data, fp2.size, offset)));
+    }
+    for (offset=1; offset < m_maxoffset; ++offset)
+    {
+        result.append(boost::python::make_tuple(-offset, sweepOffsetVerbose(fp2.data, fp2.size, fp1.data, fp1.size, offset)));
     }
     return result;
 }
@@ -381,14 +1967,16 @@ boost::python::list FingerprintManager::compareChromaprintFingerprintsAndOffsetV
 std::pair<int, double> FingerprintManager::compareSongs(long songID1, long songID2)
 {
 #if __GNUC__ >= 7 || __clang_major__ >= 5
-    auto & [_ , fingerprint1, duration1] = *songIterator(songID1);
-    auto & [__ , fingerprint2, duration2] = *songIterator(songID2);
+    auto song1 = songIterator(songID1);
+    auto song2 = songIterator(songID2);
+    if (song1 == m_songs.end() || song2 == m_songs.end())
+        return std::make_pair(-1, -1.0);
     double cancelThreshold;
-    if (duration1 < m_shortSongLength || duration2 < m_shortSongLength)
+    if (song1->duration < m_shortSongLength || song2->duration < m_shortSongLength)
         cancelThreshold = m_shortSongCancelThreshold;
     else
         cancelThreshold = m_cancelThreshold;
-    return compareChromaprintFingerprintsAndOffset(fingerprint1, fingerprint2, cancelThreshold);
+    return compareChromaprintFingerprintsAndOffset(songFingerprint(*song1), songFingerprint(*song2), cancelThreshold, m_sweepStatistics);
 #else
     std::cout << "The support to compare audio signatures was not built since the compiler was too old" << std::endl;
     return std::make_pair(0, 0.0);
@@ -397,80 +1985,54 @@ std::pair<int, double> FingerprintManager::compareSongs(long songID1, long songI
 
 boost::python::list FingerprintManager::compareSongsVerbose(long songID1, long songID2)
 {
-    return compareChromaprintFingerprintsAndOffsetVerbose(songFingerprint(songID1), songFingerprint(songID2));
-}
-
-boost::python::object FingerprintManager::writeToFile(const std::string &filename)
-{
-    std::ofstream outFile(filename, std::ios::out | std::ios::binary);
-    size_t tmp = m_fingerprints.size();
-    outFile.write(reinterpret_cast<const char*>(&tmp), sizeof(tmp));
-    int i=0;
-    for (const auto &iter : m_fingerprints)
-    {
-        const auto songID = std::get<0>(iter);
-        const std::vector <fpint> fingerprint = std::get<1>(iter);
-        const auto duration = std::get<2>(iter);
-        outFile.write(reinterpret_cast<const char*>(&songID), sizeof(songID));
-        outFile.write(reinterpret_cast<const char*>(&duration), sizeof(duration));
-        const size_t fingerprint_size = fingerprint.size();
-        outFile.write(reinterpret_cast<const char*>(&fingerprint_size), sizeof(size_t));
-        for (const fpint &val : fingerprint) //outFile << val ;
-        {
-            outFile.write(reinterpret_cast<const char*>(&val), sizeof(int));
-        }
-        ++i;
-    }
-    return boost::python::object(true);
-}
-
-boost::python::object FingerprintManager::readFromFile(const std::string &filename)
-{
-    m_fingerprints.clear();
-    std::ifstream inFile(filename, std::ios::in | std::ios::binary);
-    int songID, v;
-    size_t size, fingerprint_size;
-    double duration;
-    inFile.read(reinterpret_cast<char*>(&size), sizeof(size));
-
-    m_fingerprints.reserve(size);
-    for (size_t i=0; i< size; ++i)
-    {
-        std::vector <fpint> fingerprint;
-        inFile.read(reinterpret_cast<char*>(&songID), sizeof(songID));
-        inFile.read(reinterpret_cast<char*>(&duration), sizeof(duration));
-        inFile.read(reinterpret_cast<char*>(&fingerprint_size), sizeof(fingerprint_size));
-        fingerprint.reserve(fingerprint_size);
-        for (size_t j=0; j< fingerprint_size; ++j)
-        {
-            inFile.read(reinterpret_cast<char*>(&v), sizeof(v));
-            fingerprint.push_back(v);
-        }
-
-        m_fingerprints.emplace_back(std::make_tuple(songID, std::move(fingerprint), duration));
-    }
-    return boost::python::object(true);
+    auto song1 = songIterator(songID1);
+    auto song2 = songIterator(songID2);
+    if (song1 == m_songs.end() || song2 == m_songs.end())
+        return boost::python::list();
+    return compareChromaprintFingerprintsAndOffsetVerbose(songFingerprint(*song1), songFingerprint(*song2));
 }
 
 boost::python::list FingerprintManager::songIDs()
 {
     boost::python::list result;
 
-    for (const auto &iter : m_fingerprints)
-        result.append(std::get<0>(iter));
+    std::vector<long> songIDs;
+    songIDs.reserve(m_songs.size());
+    for (const SongEntry &song : m_songs)
+        songIDs.push_back(song.songID);
+    std::sort(songIDs.begin(), songIDs.end());
+    for (long songID : songIDs)
+        result.append(songID);
 
     return result;
 }
 
+struct PairToTuple
+{
+    static PyObject *convert(const std::pair<int, double> &pair)
+    {
+        return boost::python::incref(boost::python::make_tuple(pair.first, pair.second).ptr());
+    }
+};
+
 BOOST_PYTHON_MODULE(bard_ext)
 {
     using namespace boost::python;
+    to_python_converter<std::pair<int, double>, PairToTuple>();
+    enum_<OffsetSearchMode>("OffsetSearchMode")
+        .value("Exhaustive", OffsetSearchMode::Exhaustive)
+        .value("Coarse", OffsetSearchMode::Coarse);
     def("greet", greet<int>);
     def("greet2", greet2);
+    def("popcountImplementation", popcountImplementation);
+    def("popcountImplementations", popcountImplementations);
+    def("setPopcountImplementation", setPopcountImplementation);
     class_<FingerprintManager>("FingerprintManager")
         .def("addSong", &FingerprintManager::addSong)
         .def("addSongAndCompare", &FingerprintManager::addSongAndCompare)
         .def("addSongAndCompareToSongList", &FingerprintManager::addSongAndCompareToSongList)
+        .def("compareFingerprint", &FingerprintManager::compareFingerprint)
+        .def("removeSong", &FingerprintManager::removeSong)
         .def("compareSongs", &FingerprintManager::compareSongs)
         .def("compareSongsVerbose", &FingerprintManager::compareSongsVerbose)
         .def("setMaxOffset", &FingerprintManager::setMaxOffset)
@@ -483,9 +2045,50 @@ BOOST_PYTHON_MODULE(bard_ext)
         .def("shortSongCancelThreshold", &FingerprintManager::shortSongCancelThreshold)
         .def("setShortSongLength", &FingerprintManager::setShortSongLength)
         .def("shortSongLength", &FingerprintManager::shortSongLength)
-        .def("writeToFile", &FingerprintManager::writeToFile)
-        .def("readFromFile", &FingerprintManager::readFromFile)
+        .def("setUseIndex", &FingerprintManager::setUseIndex)
+        .def("useIndex", &FingerprintManager::useIndex)
+        .def("setIndexBits", &FingerprintManager::setIndexBits)
+        .def("indexBits", &FingerprintManager::indexBits)
+        .def("setIndexStep", &FingerprintManager::setIndexStep)
+        .def("indexStep", &FingerprintManager::indexStep)
+        .def("setMinIndexVotes", &FingerprintManager::setMinIndexVotes)
+        .def("minIndexVotes", &FingerprintManager::minIndexVotes)
+        .def("setMaxPostingsPerKey", &FingerprintManager::setMaxPostingsPerKey)
+        .def("maxPostingsPerKey", &FingerprintManager::maxPostingsPerKey)
+        .def("candidatesCount", &FingerprintManager::candidatesCount)
+        .def("setThreadCount", &FingerprintManager::setThreadCount)
+        .def("threadCount", &FingerprintManager::threadCount)
+        .def("setDurationTolerance", &FingerprintManager::setDurationTolerance)
+        .def("durationTolerance", &FingerprintManager::durationTolerance)
+        .def("setOffsetSearchMode", &FingerprintManager::setOffsetSearchMode)
+        .def("offsetSearchMode", &FingerprintManager::offsetSearchMode)
+        .def("setCoarseStep", &FingerprintManager::setCoarseStep)
+        .def("coarseStep", &FingerprintManager::coarseStep)
+        .def("setCoarseCandidates", &FingerprintManager::setCoarseCandidates)
+        .def("coarseCandidates", &FingerprintManager::coarseCandidates)
+        .def("comparedPairsCount", &FingerprintManager::comparedPairsCount)
+        .def("prunedPairsCount", &FingerprintManager::prunedPairsCount)
+        .def("sweepStatistics", &FingerprintManager::sweepStatistics)
+        .def("memoryUsage", &FingerprintManager::memoryUsage)
+        .def("setStore", &FingerprintManager::setStore, with_custodian_and_ward<1, 2>())
+        .def("addSongsFromStore", &FingerprintManager::addSongsFromStore)
+        .def("releaseOldMappings", &FingerprintManager::releaseOldMappings)
         .def("songIDs", &FingerprintManager::songIDs);
+    class_<FingerprintStore, boost::noncopyable>("FingerprintStore", init<std::string>())
+        .def("path", &FingerprintStore::path)
+        .def("size", &FingerprintStore::size)
+        .def("contains", &FingerprintStore::contains)
+        .def("songIDs", &FingerprintStore::songIDs)
+        .def("entries", &FingerprintStore::entries)
+        .def("fingerprint", &FingerprintStore::fingerprint)
+        .def("append", &FingerprintStore::append)
+        .def("remove", &FingerprintStore::remove)
+        .def("sync", &FingerprintStore::sync)
+        .def("reload", &FingerprintStore::reload)
+        .def("compact", &FingerprintStore::compact)
+        .def("verify", &FingerprintStore::verify)
+        .def("fileSize", &FingerprintStore::fileSize)
+        .def("deadBytes", &FingerprintStore::deadBytes);
 }
 
 
@@ -37,6 +37,17 @@ def add_default_values(config):
         'store_threshold': 0.60,
         'short_song_store_threshold': 0.68,
         'short_song_length': 53,
+        'fingerprint_threads': 0,
+        'fingerprint_max_length': 0,
+        'import_jobs': 1,
+        'full_rescan_interval_days': 7,
+        'watch_debounce_seconds': 5,
+        'scrub_jobs_per_device': 2,
+        'duration_tolerance': 30,
+        'offset_search_mode': 'exhaustive',
+        'coarse_offset_step': 8,
+        'coarse_offset_candidates': 3,
+        'similarity_service_socket': '~/.cache/bard/similarity-service.socket',
         'port': 5000,
         'use_ssl': False,
         'database': 'sqlite',
@@ -49,6 +60,7 @@ def add_default_values(config):
         'ignore_files': [],
         'translate_paths': False,
         'path_translation_map': {},
+        'fingerprint_store_path': '~/.cache/bard/fingerprints.store',
     }
 
     for key, value in defaults.items():
@@ -56,6 +68,8 @@ def add_default_values(config):
             config[key] = value
 
     path_keys = ['database_path',
+                 'fingerprint_store_path',
+                 'similarity_service_socket',
                  'music_paths',
                  'musicbrainz_tagged_music_paths',
                  'ssl_certificate_key_file',
@@ -1,6 +1,6 @@
 from sqlalchemy import MetaData, Table, Column, Index, \
     ForeignKey, UniqueConstraint, PrimaryKeyConstraint
-from sqlalchemy import Integer, Text, Numeric, Boolean, \
+from sqlalchemy import Integer, BigInteger, Text, Numeric, Boolean, \
     LargeBinary, DateTime, REAL, TIMESTAMP
 from sqlalchemy import select, func
 from sqlalchemy.sql import expression
@@ -163,7 +163,9 @@ Checksums = \
           Column('last_check_time', TIMESTAMP,
                  server_default=func.current_timestamp()),
           Column('insert_time', TIMESTAMP,
-                 server_default=func.current_timestamp()))
+                 server_default=func.current_timestamp()),
+          Column('audio_stream_sha256sum', Text),
+          Column('embedded_audio_md5sum', Text))
 
 Fingerprints = \
     Table('fingerprints', metadata,
@@ -174,6 +176,15 @@ Fingerprints = \
           Column('insert_time', TIMESTAMP,
                  server_default=func.current_timestamp()))
 
+# Fingerprints decoded to little endian 32 bit frames so they can be loaded
+# without decoding them again
+DecodedFingerprints = \
+    Table('decoded_fingerprints', metadata,
+          Column('song_id', Integer,
+                 ForeignKey(Songs.c.id, ondelete='CASCADE'),
+                 primary_key=True, autoincrement=False),
+          Column('fingerprint', LargeBinary, nullable=False))
+
 Similarities = \
     Table('similarities', metadata,
           Column('song_id1', Integer,
@@ -189,6 +200,36 @@ Similarities = \
           Index('similarities_song_id1_idx', 'song_id1'),
           Index('similarities_song_id2_idx', 'song_id2'))
 
+# Groups of songs connected by similarities above match_threshold. Each
+# cluster is named by its lowest song ID and is_best marks the song with the
+# best audio quality in it
+DuplicateClusters = \
+    Table('duplicate_clusters', metadata,
+          Column('song_id', Integer,
+                 ForeignKey(Songs.c.id, ondelete='CASCADE'),
+                 primary_key=True, autoincrement=False),
+          Column('cluster_id', Integer, nullable=False),
+          Column('is_best', Boolean, nullable=False),
+          Index('duplicate_clusters_cluster_id_idx', 'cluster_id'))
+
+DirectoryScans = \
+    Table('directory_scans', metadata,
+          Column('path', Text, primary_key=True),
+          Column('mtime_ns', BigInteger, nullable=False),
+          Column('entry_count', Integer, nullable=False),
+          Column('scan_time', Numeric(20, 8), nullable=False))
+
+ChecksumScrubs = \
+    Table('checksum_scrubs', metadata,
+          Column('id', Integer, primary_key=True, autoincrement=True),
+          Column('command', Text, nullable=False),
+          Column('start_time', TIMESTAMP,
+                 server_default=func.current_timestamp()),
+          Column('root', Text, nullable=False),
+          Column('files', Integer, nullable=False),
+          Column('bytes', BigInteger, nullable=False),
+          Column('seconds', Numeric(20, 8), nullable=False))
+
 Users = \
     Table('users', metadata,
           Column('id', Integer, primary_key=True,
@@ -1,21 +1,28 @@
+"""Calculate the Dynamic Range of audio.
+
+This implements the algorithm of DR14 T.meter (compute_dr14) processing
+the audio block by block. The samples of each block are normalized to the
+same float types and their squares are added in the same order, so the
+values are identical to the ones DR14 T.meter calculates (and previous
+versions stored in the database).
+"""
+
 import numpy
-try:
-    from dr14tmeter.compute_dr14 import compute_dr14
-    from dr14tmeter.duration import StructDuration
-except ModuleNotFoundError:
-    pass
+from bard.utils import decodeAudioChunks
 
-def calculate(audiodata, properties):
-    nframes = properties.samples
-    channels = properties.channels
-    if properties.decoded_sample_format == 'flt':
-        sample_type = "float%d" % (properties.decoded_bytes_per_sample * 8)
-    else:
-        sample_type = "int%d" % (properties.decoded_bytes_per_sample * 8)
+# Channels whose rms is lower than this or with a dynamic range larger than
+# 24 bit audio can have are ignored
+AUDIO_MIN = 1.0 / (2.0 ** 24)
+MAX_DYNAMIC = 20.0 * numpy.log10(2.0 ** 24)
+
+
+def sampleType(sample_format, bytes_per_sample):
+    if sample_format == 'flt':
+        return "float%d" % (bytes_per_sample * 8)
+    return "int%d" % (bytes_per_sample * 8)
 
-    Y = numpy.fromstring(audiodata, dtype=sample_type).reshape(
-               nframes, channels)
 
+def normalizeSamples(Y, sample_type, sample_format):
     if sample_type == 'int16':
         convert_16_bit = numpy.float32(2**15 + 1.0)
         Y = Y / (convert_16_bit)
@@ -25,15 +32,175 @@ def calculate(audiodata, properties):
     elif sample_type == 'int8':
         convert_8_bit = numpy.float32(2**8 + 1.0)
         Y = Y / (convert_8_bit)
-    elif properties.decoded_sample_format != 'flt':
+    elif sample_format != 'flt':
         print('sample type unsupported?')
         raise RuntimeError('Sample type unsupported')
+    return Y
+
+
+def decibel(y, ref=1.0):
+    return 20.0 * numpy.log10(y / ref)
+
+
+def calculate(audiodata, properties):
+    meter = DynamicRangeMeter(properties.decoded_sample_format,
+                              properties.decoded_bytes_per_sample,
+                              properties.sample_rate, properties.channels)
+    meter.feed(audiodata)
+    return meter.finish()
+
+
+def calculateFile(filething):
+    """Decode filething and return its (dr14, db_peak, db_rms).
+
+    The audio is processed while it's decoded, so it's never kept in
+    memory at once.
+    """
+    consumer = DynamicRangeMeterConsumer()
+    decodeAudioChunks(filething, consumer)
+    if consumer.meter is None:
+        raise ValueError('No audio was decoded')
+    return consumer.meter.finish()
+
+
+class DynamicRangeMeter:
+    """Calculate the Dynamic Range of audio fed in chunks.
+
+    compute_dr14 only uses the rms and peak of each block of 3 seconds, so
+    they're calculated as each block is completed and only the audio of the
+    current block is kept.
+    """
+
+    def __init__(self, sample_format, bytes_per_sample, sample_rate,
+                 channels):
+        self.sample_format = sample_format
+        self.sample_type = sampleType(sample_format, bytes_per_sample)
+        self.channels = channels
+        if sample_format != 'flt' and \
+                self.sample_type not in ('int8', 'int16', 'int32'):
+            print('sample type unsupported?')
+            raise RuntimeError('Sample type unsupported')
+
+        delta_fs = 60 if sample_rate == 44100 else 0
+        self.block_samples = 3 * (sample_rate + delta_fs)
+        self._frame_width = bytes_per_sample * channels
+        self._data = b''
+        self._length = 0
+        self._rms = []
+        self._peaks = []
+
+    def _frames(self, data):
+        Y = numpy.frombuffer(data, dtype=self.sample_type)
+        return Y[:len(Y) - len(Y) % self.channels].reshape(-1, self.channels)
+
+    def _blockRMS(self, Y):
+        Y = normalizeSamples(Y, self.sample_type, self.sample_format)
+        if Y.base is None:
+            # Y was created by normalizeSamples, so it can be reused
+            Y = numpy.square(Y, out=Y)
+        else:
+            Y = Y**2.0
+        if self.channels == 1 or not len(Y):
+            sum_squares = numpy.sum(Y, 0)
+        else:
+            # With more than one channel, numpy.sum adds the rows of Y
+            # sequentially, which cumsum does in the same order but faster
+            sum_squares = numpy.cumsum(Y, 0, out=Y)[-1]
+        return numpy.sqrt(2.0 * sum_squares / float(Y.shape[0]))
+
+    def _blockPeaks(self, Y):
+        """Return the maximum absolute value of each channel normalized.
+
+        Normalizing is monotonic and symmetric, so only the maximum and
+        minimum samples are normalized. The minimum is normalized before
+        taking its absolute value since the minimum value of an integer
+        type can't be negated. The extremes of groups of 64 frames are
+        calculated first, since reducing wide rows is much faster.
+        """
+        n = len(Y) - len(Y) % 64
+        maxima = [Y[n:]]
+        minima = [Y[n:]]
+        if n:
+            groups = Y[:n].reshape(-1, 64 * self.channels)
+            maxima.append(numpy.max(groups, 0).reshape(64, self.channels))
+            minima.append(numpy.min(groups, 0).reshape(64, self.channels))
+        Ymax = normalizeSamples(numpy.max(numpy.concatenate(maxima), 0),
+                                self.sample_type, self.sample_format)
+        Ymin = normalizeSamples(numpy.min(numpy.concatenate(minima), 0),
+                                self.sample_type, self.sample_format)
+        return numpy.maximum(numpy.abs(Ymax), numpy.abs(Ymin))
+
+    def feed(self, data):
+        if self._data:
+            self._data = bytes(self._data) + bytes(data)
+        else:
+            self._data = data
+        self._length += len(data)
+
+        block_size = self.block_samples * self._frame_width
+        offset = 0
+        while len(self._data) - offset >= block_size:
+            Y = self._frames(memoryview(self._data)[offset:
+                                                    offset + block_size])
+            self._rms.append(self._blockRMS(Y))
+            self._peaks.append(self._blockPeaks(Y))
+            offset += block_size
+        if offset:
+            self._data = bytes(memoryview(self._data)[offset:])
+
+    def finish(self):
+        """Return (dr14, db_peak, db_rms) like compute_dr14."""
+        frames = self._length // self._frame_width
+        seg_cnt = int(numpy.floor(frames / self.block_samples) + 1)
+
+        rms = numpy.zeros((seg_cnt, self.channels))
+        peaks = numpy.zeros((seg_cnt, self.channels))
+        for i, (block_rms, block_peaks) in enumerate(zip(self._rms,
+                                                         self._peaks)):
+            rms[i, :] = block_rms
+            peaks[i, :] = block_peaks
+
+        # compute_dr14 leaves out the last frame of the last block
+        remaining = frames - len(self._rms) * self.block_samples
+        if remaining > 0:
+            Y = self._frames(self._data)[:remaining - 1, :]
+            rms[seg_cnt - 1, :] = self._blockRMS(Y)
+            peaks[seg_cnt - 1, :] = self._blockPeaks(Y)
+        self._data = b''
+
+        peaks = numpy.sort(peaks, 0)
+        rms = numpy.sort(rms, 0)
+
+        n_blk = int(numpy.floor(seg_cnt * 0.2))
+        if n_blk == 0:
+            n_blk = 1
+
+        r = numpy.arange(seg_cnt - n_blk, seg_cnt)
+        rms_sum = numpy.sum(rms[r, :]**2, 0)
+
+        ch_dr14 = -20.0 * numpy.log10(numpy.sqrt(rms_sum / n_blk) * 1.0 /
+                                      peaks[seg_cnt - 2, :])
+
+        err_i = numpy.logical_or(rms_sum < AUDIO_MIN,
+                                 numpy.abs(ch_dr14) > MAX_DYNAMIC)
+        ch_dr14[err_i] = 0.0
+
+        dr14 = numpy.round(numpy.mean(ch_dr14))
+        db_peak = decibel(numpy.max(peaks))
+        y_rms = numpy.sum(numpy.mean(rms, 0)) / 2.0
+        db_rms = decibel(y_rms)
+        return (dr14, db_peak, db_rms)
+
+
+class DynamicRangeMeterConsumer:
+    """decodeAudioChunks consumer that feeds a DynamicRangeMeter."""
+
+    def __init__(self):
+        self.meter = None
 
-    try:
-        duration = StructDuration()
-    except NameError:
-        print('Error: DR14-T.meter python module not found, this is required to calculate Dynamic Range')
-        raise
+    def start(self, sample_format, bytes_per_sample, sample_rate, channels):
+        self.meter = DynamicRangeMeter(sample_format, bytes_per_sample,
+                                       sample_rate, channels)
 
-    (dr14, db_peak, db_rms) = compute_dr14(Y, properties.sample_rate)
-    return (dr14, db_peak, db_rms)
+    def feed(self, data):
+        self.meter.feed(data)
@@ -0,0 +1,396 @@
+"""Benchmark and regression checks for FingerprintManager.
+
+A collection of synthetic chromaprint-like fingerprints is loaded and
+queried with near-duplicates of songs in the collection (shifted by a
+known offset and with random bit flips) and with unrelated songs. For
+each number of threads it reports:
+
+  * the throughput (compared pairs and query songs per second),
+  * the early abandon rate (the ratio of offsets whose comparison was
+    cancelled before the end because it couldn't reach the threshold),
+  * the recall and precision of the detected (song, offset) pairs.
+
+It also reports the load rate and the memory used per song. The results
+can be written as JSON to track them across versions and compared with
+the results of a previous run:
+
+    python3 -m bard.fingerprint_benchmark [--songs N] [--queries N]
+        [--threads 1,2,4] [--json] [--output file] [--baseline file]
+"""
+
+import argparse
+import functools
+import itertools
+import json
+import operator
+import platform
+import random
+import resource
+import sys
+import time
+from array import array
+
+from bard.bard_ext import FingerprintManager
+from bard import bard_ext
+from bard import __version__
+
+# About 120 seconds of audio, which is what chromaprint fingerprints
+FINGERPRINT_LENGTH = 950
+
+# Metrics compared with the baseline and whether higher values are better
+REGRESSION_METRICS = {'load_songs_per_second': True,
+                      'rss_bytes_per_song': False,
+                      'compared_pairs_per_second': True,
+                      'compared_songs_per_second': True,
+                      'recall': True,
+                      'precision': True}
+
+
+def current_rss():
+    """Return the resident set size of the process in bytes."""
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * resource.getpagesize()
+
+
+def synthetic_fingerprint(rng, length=FINGERPRINT_LENGTH):
+    """Return random frames with about 8 bits changing between frames.
+
+    Consecutive frames of chromaprint fingerprints are similar, which
+    makes the neighbours of the right offset similar too.
+    """
+    size = length * 4
+    changes = (int.from_bytes(rng.randbytes(size), 'little') &
+               int.from_bytes(rng.randbytes(size), 'little'))
+    frames = array('I', changes.to_bytes(size, 'little'))
+    frames[0] = rng.getrandbits(32)
+    return array('I', itertools.accumulate(frames, operator.xor))
+
+
+def song_fingerprint(seed, song_id):
+    """Return the fingerprint of a song of the synthetic collection."""
+    return synthetic_fingerprint(random.Random(seed * 1000003 + song_id))
+
+
+def noisy_copy(rng, fingerprint, offset, bit_error_rate):
+    """Return a copy of fingerprint shifted by offset frames with noise.
+
+    FingerprintManager reports the returned fingerprint as similar to the
+    original one at -offset.
+    """
+    if offset >= 0:
+        result = list(fingerprint[offset:])
+    else:
+        result = list(synthetic_fingerprint(rng, -offset)) + list(fingerprint)
+    for i, value in enumerate(result):
+        for bit in range(32):
+            if rng.random() < bit_error_rate:
+                value ^= 1 << bit
+        result[i] = value
+    return result
+
+
+def create_manager(max_offset=100, store_threshold=0.60,
+                   short_song_store_threshold=0.68, short_song_length=53):
+    fpm = FingerprintManager()
+    fpm.setMaxOffset(max_offset)
+    fpm.setCancelThreshold(store_threshold)
+    fpm.setShortSongCancelThreshold(short_song_store_threshold)
+    fpm.setShortSongLength(short_song_length)
+    return fpm
+
+
+@functools.lru_cache(maxsize=None)
+def accepts_buffers():
+    # Old versions only accept lists of frames
+    try:
+        FingerprintManager().compareFingerprint(array('I', [0]), 0.0)
+    except TypeError:
+        return False
+    return True
+
+
+def fingerprint_argument(fingerprint):
+    if accepts_buffers():
+        return fingerprint
+    return list(fingerprint)
+
+
+def sweep_statistics(fpm):
+    if hasattr(fpm, 'sweepStatistics'):
+        return fpm.sweepStatistics()
+    return None
+
+
+def create_queries(rng, seed, songs, queries, unrelated_queries, durations,
+                   max_offset, bit_error_rate):
+    """Return a list of (fingerprint, duration, expected) tuples.
+
+    expected is the (song_id, offset) that should be found or None for
+    unrelated songs.
+    """
+    result = []
+    for song_id in rng.sample(range(1, songs + 1), queries):
+        offset = rng.randint(-(max_offset - 1), max_offset - 1)
+        fingerprint = noisy_copy(rng, song_fingerprint(seed, song_id),
+                                 offset, bit_error_rate)
+        result.append((fingerprint, durations[song_id] - offset * 0.1238,
+                       (song_id, -offset)))
+    for _ in range(unrelated_queries):
+        result.append((list(synthetic_fingerprint(rng)),
+                       rng.uniform(120, 400), None))
+    return result
+
+
+def evaluate(matches, queries, songs):
+    """Return the recall and precision of the matches of each query."""
+    positives = sum(1 for _, _, expected in queries if expected)
+    true_positives = 0
+    offset_errors = 0
+    detected = 0
+    for query_matches, (_, _, expected) in zip(matches, queries):
+        for song_id, offset, similarity in query_matches:
+            if song_id > songs:
+                # Queries added to the collection by old versions
+                continue
+            detected += 1
+            if expected and song_id == expected[0]:
+                if offset == expected[1]:
+                    true_positives += 1
+                else:
+                    offset_errors += 1
+    return {'matches': detected,
+            'true_positives': true_positives,
+            'offset_errors': offset_errors,
+            'recall': true_positives / positives if positives else 1.0,
+            'precision': true_positives / detected if detected else 1.0}
+
+
+def run_queries(fpm, queries, songs, threads, next_song_id):
+    if hasattr(fpm, 'setThreadCount'):
+        fpm.setThreadCount(threads)
+    compared_before = (fpm.comparedPairsCount()
+                       if hasattr(fpm, 'comparedPairsCount') else None)
+    sweeps_before = sweep_statistics(fpm)
+
+    matches = []
+    start = time.time()
+    for fingerprint, duration, _ in queries:
+        fingerprint = fingerprint_argument(fingerprint)
+        if hasattr(fpm, 'compareFingerprint'):
+            result = fpm.compareFingerprint(fingerprint, duration)
+        else:
+            result = fpm.addSongAndCompare(next_song_id, fingerprint,
+                                           duration)
+            next_song_id += 1
+        matches.append(sorted((song_id, offset, round(similarity, 6))
+                              for song_id, offset, similarity in result))
+    compare_time = time.time() - start
+
+    if compared_before is not None:
+        compared_pairs = fpm.comparedPairsCount() - compared_before
+    else:
+        compared_pairs = len(queries) * songs
+    result = {'threads': threads,
+              'compared_pairs': compared_pairs,
+              'compared_pairs_per_second': compared_pairs / compare_time,
+              'compared_songs_per_second': len(queries) / compare_time}
+    if sweeps_before is not None:
+        sweeps = {key: value - sweeps_before[key]
+                  for key, value in sweep_statistics(fpm).items()}
+        result['sweeps'] = sweeps['sweeps']
+        result['early_abandon_rate'] = (sweeps['cancelled_sweeps'] /
+                                        max(sweeps['sweeps'], 1))
+        result['compared_frames_ratio'] = (sweeps['compared_frames'] /
+                                           max(sweeps['total_frames'], 1))
+    result.update(evaluate(matches, queries, songs))
+    return result, matches, next_song_id
+
+
+def run(songs=20000, queries=20, seed=0, use_index=False, threads=[0],
+        max_offset=100, threshold=0.60, bit_error_rate=0.1,
+        unrelated_queries=5, duration_tolerance=0):
+    rng = random.Random(seed)
+    durations = [0.0] + [rng.uniform(120, 400) for _ in range(songs)]
+
+    fpm = create_manager(max_offset=max_offset, store_threshold=threshold)
+    if use_index and hasattr(fpm, 'setUseIndex'):
+        fpm.setUseIndex(True)
+    if duration_tolerance and hasattr(fpm, 'setDurationTolerance'):
+        fpm.setDurationTolerance(duration_tolerance)
+    fpm.setExpectedSize(songs + queries * len(threads))
+
+    rss_before = current_rss()
+    load_time = 0
+    for song_id in range(1, songs + 1):
+        fingerprint = fingerprint_argument(song_fingerprint(seed, song_id))
+        start = time.time()
+        fpm.addSong(song_id, fingerprint, durations[song_id])
+        load_time += time.time() - start
+    rss_after = current_rss()
+
+    result = {'version': __version__,
+              'python_version': platform.python_version(),
+              'machine': platform.machine(),
+              'parameters': {'songs': songs,
+                             'queries': queries,
+                             'unrelated_queries': unrelated_queries,
+                             'seed': seed,
+                             'use_index': use_index,
+                             'max_offset': max_offset,
+                             'threshold': threshold,
+                             'bit_error_rate': bit_error_rate,
+                             'duration_tolerance': duration_tolerance},
+              'load_songs_per_second': songs / load_time,
+              'rss_bytes': rss_after - rss_before,
+              'rss_bytes_per_song': (rss_after - rss_before) / songs}
+    if hasattr(fpm, 'memoryUsage'):
+        result['memory_usage_bytes_per_song'] = fpm.memoryUsage() / songs
+    if hasattr(bard_ext, 'popcountImplementation'):
+        result['popcount_implementation'] = \
+            bard_ext.popcountImplementation()
+
+    query_list = create_queries(rng, seed, songs, queries, unrelated_queries,
+                                durations, max_offset, bit_error_rate)
+    result['runs'] = []
+    all_matches = []
+    next_song_id = songs + 1
+    for thread_count in threads:
+        run_result, matches, next_song_id = run_queries(
+            fpm, query_list, songs, thread_count, next_song_id)
+        result['runs'].append(run_result)
+        all_matches.append([[m for m in query_matches if m[0] <= songs]
+                            for query_matches in matches])
+    # The results shouldn't depend on the number of threads
+    result['consistent_results'] = all(matches == all_matches[0]
+                                       for matches in all_matches)
+    return result
+
+
+def compare_with_baseline(result, baseline, tolerance):
+    """Return a list of messages about metrics worse than in baseline."""
+    regressions = []
+
+    def check(name, key, value, base_value):
+        if key not in REGRESSION_METRICS or base_value is None:
+            return
+        if REGRESSION_METRICS[key]:
+            worse = value < base_value * (1 - tolerance)
+        else:
+            worse = value > base_value * (1 + tolerance)
+        if worse:
+            regressions.append(f'{name}: {value:.4g} (baseline: '
+                               f'{base_value:.4g})')
+
+    for key, value in result.items():
+        if isinstance(value, (int, float)):
+            check(key, key, value, baseline.get(key))
+    base_runs = {run['threads']: run for run in baseline.get('runs', [])}
+    for run in result['runs']:
+        base_run = base_runs.get(run['threads'])
+        if not base_run:
+            continue
+        for key, value in run.items():
+            check(f'{key} ({run["threads"]} threads)', key, value,
+                  base_run.get(key))
+    return regressions
+
+
+def print_result(result, prefix=''):
+    for key, value in result.items():
+        if isinstance(value, dict):
+            print_result(value, prefix=f'{prefix}{key}.')
+        elif isinstance(value, list):
+            for item in value:
+                print_result(item, prefix=f'{prefix}{key}'
+                             f'[threads={item["threads"]}].')
+        elif isinstance(value, float):
+            print(f'{prefix}{key}: {value:.4f}')
+        else:
+            print(f'{prefix}{key}: {value}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the comparison '
+                                     'of audio fingerprints')
+    parser.add_argument('--songs', type=int, default=20000,
+                        help='Number of songs in the collection')
+    parser.add_argument('--queries', type=int, default=20,
+                        help='Number of near-duplicates of songs in the '
+                        'collection to compare to the collection')
+    parser.add_argument('--unrelated-queries', type=int, default=5,
+                        help='Number of unrelated songs to compare to the '
+                        'collection')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--use-index', action='store_true',
+                        help='Use the fingerprint index to find candidates')
+    parser.add_argument('--threads', default='0',
+                        help='Comma separated list of numbers of threads '
+                        'used to compare fingerprints (0 uses the default)')
+    parser.add_argument('--max-offset', type=int, default=100,
+                        help='Maximum offset in frames between songs')
+    parser.add_argument('--threshold', type=float, default=0.60,
+                        help='Similarity threshold to report matches')
+    parser.add_argument('--bit-error-rate', type=float, default=0.1,
+                        help='Probability of flipping each bit of the '
+                        'near-duplicates')
+    parser.add_argument('--duration-tolerance', type=float, default=0,
+                        help='Only compare songs with durations that differ '
+                        'less than this number of seconds')
+    parser.add_argument('--popcount', default=None,
+                        help='Popcount implementation to use (one of '
+                        'bard_ext.popcountImplementations())')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as JSON')
+    parser.add_argument('--output', default=None,
+                        help='Write the results as JSON to this file')
+    parser.add_argument('--baseline', default=None,
+                        help='JSON results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Relative difference with the baseline '
+                        'considered a regression')
+    options = parser.parse_args()
+    if options.popcount:
+        if not bard_ext.setPopcountImplementation(options.popcount):
+            print(f'Unsupported popcount implementation: {options.popcount}')
+            return 1
+    try:
+        threads = [int(x) for x in options.threads.split(',')]
+    except ValueError:
+        print(f'Invalid list of threads: {options.threads}')
+        return 1
+
+    result = run(options.songs, options.queries, options.seed,
+                 options.use_index, threads, options.max_offset,
+                 options.threshold, options.bit_error_rate,
+                 options.unrelated_queries, options.duration_tolerance)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    if options.json:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    else:
+        print_result(result)
+
+    ret = 0 if result['consistent_results'] else 1
+    if not result['consistent_results']:
+        print('Error: The results depend on the number of threads',
+              file=sys.stderr)
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('parameters') != result['parameters']:
+            print('Warning: The baseline was run with different parameters',
+                  file=sys.stderr)
+        regressions = compare_with_baseline(result, baseline,
+                                            options.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}', file=sys.stderr)
+        if regressions:
+            ret = 1
+    return ret
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
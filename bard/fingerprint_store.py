@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+from bard.musicdatabase import MusicDatabase
+from bard.bard_ext import FingerprintStore
+from bard.utils import decodeFingerprint
+import bard.config as config
+from sqlalchemy import text
+import contextlib
+import datetime
+import fcntl
+import os
+
+
+def stampFromTimestamp(timestamp):
+    """Return a song's update_time as a number to store with fingerprints.
+
+    The timestamp is converted without taking timezones into account, so
+    it doesn't change if the local timezone changes.
+    """
+    if timestamp is None:
+        return 0.0
+    if isinstance(timestamp, str):
+        timestamp = datetime.datetime.fromisoformat(timestamp)
+    timestamp = timestamp.replace(tzinfo=None)
+    return (timestamp - datetime.datetime(1970, 1, 1)).total_seconds()
+
+
+def syncFingerprintStore(store, verify=False, verifyAll=False,
+                         verbose=False):
+    """Update the fingerprint store with the fingerprints in the database.
+
+    Only the fingerprints of songs which were added or updated since the
+    last sync are read from the database. They're taken from the
+    decoded_fingerprints table when possible to avoid decoding them.
+    If verify is True, the checksums of the records appended since the
+    last verification are checked, or of all records if verifyAll is True.
+    """
+    c = MusicDatabase.getCursor()
+    sql = ('SELECT songs.id, songs.update_time, '
+           'duration-silence_at_start-silence_at_end '
+           'FROM songs, properties, fingerprints '
+           'WHERE songs.id = properties.song_id and '
+           'songs.id = fingerprints.song_id')
+    songs = {songID: (stampFromTimestamp(update_time), duration)
+             for songID, update_time, duration
+             in c.execute(text(sql)).fetchall()}
+
+    stored = {songID: stamp for songID, stamp, _ in store.entries()}
+    if verify or verifyAll:
+        for songID in store.verify(verifyAll):
+            print(f'Fingerprint of song {songID} is corrupted in the '
+                  'fingerprint store')
+            store.remove(songID)
+            del stored[songID]
+
+    removed = [songID for songID in stored if songID not in songs]
+    for songID in removed:
+        store.remove(songID)
+
+    missing = sorted(songID for songID, (stamp, _) in songs.items()
+                     if stored.get(songID) != stamp)
+    if verbose or len(missing) > 1000:
+        print(f'Updating fingerprint store ({len(missing)} new songs, '
+              f'{len(removed)} removed songs)')
+    batch_size = 1000
+    for i in range(0, len(missing), batch_size):
+        ids = missing[i:i + batch_size]
+        fingerprints = MusicDatabase.getDecodedFingerprints(ids)
+        not_decoded = [songID for songID in ids if songID not in fingerprints]
+        if not_decoded:
+            for songID, fingerprint in \
+                    MusicDatabase.getEncodedFingerprints(not_decoded).items():
+                fingerprints[songID] = decodeFingerprint(fingerprint)
+        for songID, fingerprint in fingerprints.items():
+            if not fingerprint:
+                continue
+            stamp, duration = songs[songID]
+            store.append(songID, fingerprint, duration, stamp)
+
+    # Rewrite the file when most of it is taken by old records
+    if store.deadBytes() > store.fileSize() / 2:
+        store.compact()
+    store.sync()
+
+
+@contextlib.contextmanager
+def lockFingerprintStore(path):
+    """Hold a lock so only one process writes to the store at a time."""
+    with open(path + '.lock', 'w') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        yield
+
+
+def openFingerprintStore(verify=False, verifyAll=False, verbose=False):
+    """Open the fingerprint store and sync it with the database.
+
+    The store is recreated if it's corrupted or uses an unsupported format.
+    """
+    path = config.config['fingerprint_store_path']
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with lockFingerprintStore(path):
+        try:
+            store = FingerprintStore(path)
+        except RuntimeError as e:
+            print(f'{e}. Recreating the fingerprint store')
+            os.remove(path)
+            store = FingerprintStore(path)
+        syncFingerprintStore(store, verify=verify, verifyAll=verifyAll,
+                             verbose=verbose)
+    return store
+
+
+def refreshFingerprintStore(store, verbose=False):
+    """Reload an open fingerprint store and sync it with the database.
+
+    This reads the records appended by other processes into the same
+    FingerprintStore object, so a FingerprintManager using it doesn't need
+    a new store.
+    """
+    with lockFingerprintStore(store.path()):
+        store.reload()
+        syncFingerprintStore(store, verbose=verbose)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+"""Analyze song files in worker processes.
+
+Decoding and analyzing the audio of a file (checksums, dynamic range,
+silences and fingerprint) is the slow part of importing it. Workers only
+do that and return a SongAnalysis, so the database is only written by the
+main process, which reads the tags again and adds the songs in order.
+"""
+
+from bard.song import Song
+from bard.utils import embeddedAudioMD5, calculateAudioChecksums, \
+    decodeAudio, calculateSHA256_data, calculateAudioStreamSHA256, \
+    calculateFileSHA256
+import bard.dynamicrange as dynamicrange
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque
+import contextlib
+import io
+import itertools
+import mutagen
+
+
+def analyzeSongFile(path):
+    """Return the SongAnalysis of the file at path.
+
+    Everything printed while analyzing it is returned in the output field
+    so the main process prints it when the song is added.
+    """
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        metadata = mutagen.File(path)
+        analysis = Song.analyzeFile(path, metadata)
+    return analysis._replace(output=output.getvalue())
+
+
+def analyzeSongFiles(paths, jobs):
+    """Yield (path, analysis) for each path using jobs processes.
+
+    Results are returned in the same order as paths. An exception raised
+    while analyzing a file is raised when its result is reached. Only a few
+    files are analyzed ahead of the one being returned, so the results
+    don't use much memory if the caller is slower than the workers.
+    """
+    yield from mapInOrder(analyzeSongFile, paths, jobs)
+
+
+def calculateDRFiles(paths, jobs):
+    """Yield (path, (dr14, db_peak, db_rms)) for each path.
+
+    Like analyzeSongFiles, but only the dynamic range is calculated.
+    """
+    yield from mapInOrder(dynamicrange.calculateFile, paths, jobs)
+
+
+def checkAudioFile(path):
+    """Return (embedded_md5, checksums) of the file at path.
+
+    embedded_md5 is the audio checksum stored in the file (or None if it
+    doesn't have one) and checksums is the result of
+    calculateAudioChecksums, which also calculates the md5 of the decoded
+    audio when the file has an embedded one.
+    """
+    embeddedMD5, bitsPerSample = embeddedAudioMD5(mutagen.File(path))
+    return embeddedMD5, calculateAudioChecksums(path, bitsPerSample)
+
+
+def checkAudioFiles(paths, jobs):
+    """Yield (path, (embedded_md5, checksums)) for each path.
+
+    Files are decoded by bard_audiofile without holding the GIL, so they're
+    checked in jobs threads instead of processes.
+    """
+    yield from mapInOrder(checkAudioFile, paths, jobs,
+                          executor_class=ThreadPoolExecutor)
+
+
+def calculateFileChecksums(path):
+    """Return the checksums of the file at path that fix-checksums stores.
+
+    Returns a (audio_sha256, audio_stream_sha256, file_sha256,
+    decode_properties) tuple.
+    """
+    audiodata, properties = decodeAudio(path)
+    return (calculateSHA256_data(audiodata),
+            calculateAudioStreamSHA256(path),
+            calculateFileSHA256(path),
+            properties)
+
+
+def mapInOrder(function, items, jobs, executor_class=ProcessPoolExecutor):
+    """Yield (item, function(item)) for each item using jobs workers.
+
+    Workers are processes unless a different executor_class is given.
+    """
+    if jobs <= 1:
+        for item in items:
+            yield item, function(item)
+        return
+
+    items = iter(items)
+    executor = executor_class(jobs)
+    try:
+        pending = deque((item, executor.submit(function, item))
+                        for item in itertools.islice(items, jobs * 2))
+        while pending:
+            item, future = pending.popleft()
+            result = future.result()
+            for nextItem in itertools.islice(items, 1):
+                pending.append((nextItem,
+                                executor.submit(function, nextItem)))
+            yield item, result
+    finally:
+        executor.shutdown(cancel_futures=True)
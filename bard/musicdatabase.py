@@ -3,12 +3,15 @@
 import bard.config as config
 from bard.normalizetags import normalizeTagValues
 from bard.utils import DecodedAudioPropertiesTuple, DecodeMessageRecord, \
-    removeNonPrintableCharacters
+    removeNonPrintableCharacters, decodeFingerprint, audioQualityKey, \
+    UnionFind
 from bard.album import albumPath
 from bard.db import metadata
 from bard.db.core import AlbumProperties, AlbumSongs, AlbumRelease, SongsMB, \
     Properties, AlbumsRatings, SongsRatings, AvgSongsRatings, Tags, Songs, \
-    DecodeMessages, DecodeProperties, Users, Albums, DynamicRangeData
+    DecodeMessages, DecodeProperties, Users, Albums, DynamicRangeData, \
+    Fingerprints, DecodedFingerprints, Similarities, DuplicateClusters, \
+    DirectoryScans, ChecksumScrubs
 from bard.db.musicbrainz import Release
 import sqlalchemy
 from sqlalchemy import create_engine, text, select, and_, or_, exists, func, \
@@ -346,301 +349,366 @@ class MusicDatabase:
         command.stamp(alembic_cfg, "head")
         print('Database created')
 
+    updateSongRowSQL = ('UPDATE songs SET root=:root, filename=:filename, '
+                        'mtime=:mtime, title=:title, '
+                        'artist=:artist, album=:album, '
+                        'albumArtist=:albumartist, '
+                        'track=:track, date=:date, genre=:genre, '
+                        'discnumber=:discnumber, coverwidth=:coverwidth, '
+                        'coverheight=:coverheight, covermd5=:covermd5, '
+                        'completeness=:completeness, '
+                        'update_time=CURRENT_TIMESTAMP '
+                        'WHERE id = :id')
+
+    @staticmethod
+    def songRowValues(song):
+        """Return the values of the songs table row of song."""
+        return {'root': song.root(),
+                'filename': song.filename(),
+                'mtime': song.mtime(),
+                'title': song['title'],
+                'artist': toString(song['artist']),
+                'album': song['album'],
+                'albumartist': song['albumartist'],
+                'track': removeNonPrintableCharacters(song['tracknumber']),
+                'date': song['date'],
+                'genre': toString(song['genre']),
+                'discnumber': song['discnumber'],
+                'coverwidth': song.coverWidth(),
+                'coverheight': song.coverHeight(),
+                'covermd5': song.coverMD5(),
+                'completeness': song.completeness
+                }
+
     @staticmethod
-    def addSong(song):  # noqa
+    def replaceSongTags(song, c):
+        """Replace the tags and cuesheet of song in the database."""
+        values = {'id': song.id}
+        sql = 'DELETE from tags where song_id = :id'
+        c.execute(text(sql).bindparams(**values))
+
+        tags = extractTagsList(song)
+
+        if tags:
+            sql = ('INSERT INTO tags(song_id, name, value, pos) '
+                   'VALUES (:id,:name,:value,:pos)')
+            try:
+                c.execute(text(sql), tags)
+            except ValueError:
+                c.rollback()
+                print(sql, tags)
+                raise
+
+        sql = 'DELETE from cuesheets where song_id = :id'
+        c.execute(text(sql).bindparams(**values))
+
+        cuesheettracks = extractCueSheetTracks(song)
+
+        if cuesheettracks:
+            sql = ('INSERT INTO cuesheets(song_id, idx, sample_position, '
+                   'time_position, title) '
+                   'VALUES (:id,:idx,:sample_position,:time_position, '
+                   '        :title)')
+            try:
+                c.execute(text(sql), cuesheettracks)
+            except ValueError:
+                c.rollback()
+                print(sql, cuesheettracks)
+                raise
+
+    @staticmethod
+    def updateSongMetadata(song):
+        """Update a song whose file changed but not its audio.
+
+        Only the tags, cover, cuesheet, mtime and file checksum of song are
+        updated. The audio properties, fingerprint, dynamic range, etc.
+        stored in the database are kept.
+        """
         if config.config['immutable_database']:
-            print("Error: Can't add song to DB: "
+            print("Error: Can't update song metadata: "
                   "The database is configured as immutable")
             return
         song.calculateCompleteness()
 
         c = MusicDatabase.getCursor()
-        sql = text('SELECT id FROM songs where path = :path')
-
-        result = c.execute(sql.bindparams(path=song.path()))
-        songID = result.fetchone()
-
-        values = {'root': song.root(),
-                  'filename': song.filename(),
-                  'mtime': song.mtime(),
-                  'title': song['title'],
-                  'artist': toString(song['artist']),
-                  'album': song['album'],
-                  'albumartist': song['albumartist'],
-                  'track': removeNonPrintableCharacters(song['tracknumber']),
-                  'date': song['date'],
-                  'genre': toString(song['genre']),
-                  'discnumber': song['discnumber'],
-                  'coverwidth': song.coverWidth(),
-                  'coverheight': song.coverHeight(),
-                  'covermd5': song.coverMD5(),
-                  'completeness': song.completeness
-                  }
-
-        if songID:  # song is already in db, we have to update it
-            song.id = songID[0]
-            if MusicDatabase.checkChangesForSongHistoryEntry(song):
-                MusicDatabase.createSongHistoryEntry(song.id)
+        MusicDatabase.createSongHistoryEntry(song.id)
 
-            values['id'] = song.id
-            # print('Updating song in database')
-            sql = ('UPDATE songs SET root=:root, filename=:filename, '
-                   'mtime=:mtime, title=:title, '
-                   'artist=:artist, album=:album, albumArtist=:albumartist, '
-                   'track=:track, date=:date, genre=:genre, '
-                   'discnumber=:discnumber, coverwidth=:coverwidth, '
-                   'coverheight=:coverheight, covermd5=:covermd5, '
-                   'completeness=:completeness, update_time=CURRENT_TIMESTAMP '
-                   'WHERE id = :id')
+        values = MusicDatabase.songRowValues(song)
+        values['id'] = song.id
+        c.execute(text(MusicDatabase.updateSongRowSQL).bindparams(**values))
 
-            c.execute(text(sql).bindparams(**values))
-
-            values = {'sha256sum': song.fileSha256sum(),
-                      'id': song.id}
-            sql = 'UPDATE checksums SET sha256sum=:sha256sum WHERE song_id=:id'
-            c.execute(text(sql).bindparams(**values))
-
-            values = {'fingerprint': song.fingerprint,
-                      'id': song.id}
-            sql = ('UPDATE fingerprints SET fingerprint=:fingerprint '
-                   'WHERE song_id=:id')
-            c.execute(text(sql).bindparams(**values))
+        values = {'sha256sum': song.fileSha256sum(),
+                  'id': song.id}
+        sql = 'UPDATE checksums SET sha256sum=:sha256sum WHERE song_id=:id'
+        c.execute(text(sql).bindparams(**values))
 
-            values = {'format': song.format(),
-                      'duration': song.duration(),
-                      'bitrate': song.bitrate(),
-                      'bits_per_sample': song.bits_per_sample(),
-                      'sample_rate': song.sample_rate(),
-                      'channels': song.channels(),
-                      'audio_sha256sum': song.audioSha256sum(),
-                      'silence_at_start': song.silenceAtStart(),
-                      'silence_at_end': song.silenceAtEnd(),
-                      'id': song.id}
-            sql = ('UPDATE properties SET format=:format, duration=:duration, '
-                   'bitrate=:bitrate, bits_per_sample=:bits_per_sample, '
-                   'sample_rate=:sample_rate, channels=:channels, '
-                   'audio_sha256sum=:audio_sha256sum, '
-                   'silence_at_start=:silence_at_start, '
-                   'silence_at_end=:silence_at_end WHERE song_id=:id')
-            c.execute(text(sql).bindparams(**values))
+        MusicDatabase.replaceSongTags(song, c)
 
-            prop = song.decode_properties()
-            values = {'codec': CodecEnum.id_value(prop.codec),
-                      'format': FormatEnum.id_value(prop.format_name),
-                      'container_duration': prop.container_duration,
-                      'decoded_duration': prop.decoded_duration,
-                      'container_bitrate': prop.container_bitrate,
-                      'stream_bitrate': prop.stream_bitrate,
-                      'stream_sample_format':
-                      SampleFormatEnum.id_value(prop.stream_sample_format),
-                      'stream_bits_per_raw_sample':
-                      prop.stream_bits_per_raw_sample,
-                      'decoded_sample_format':
-                      SampleFormatEnum.id_value(prop.decoded_sample_format),
-                      'samples': prop.samples,
-                      'library_versions':
-                      LibraryVersionsEnum.id_value(prop.library_versions),
-                      'id': song.id}
-            sql = ('UPDATE decode_properties SET codec=:codec, '
-                   'format=:format, container_duration=:container_duration, '
-                   'decoded_duration=:decoded_duration, '
-                   'container_bitrate=:container_bitrate, '
-                   'stream_bitrate=:stream_bitrate, '
-                   'stream_sample_format=:stream_sample_format, '
-                   'stream_bits_per_raw_sample=:stream_bits_per_raw_sample, '
-                   'decoded_sample_format=:decoded_sample_format, '
-                   'samples=:samples, '
-                   'library_versions=:library_versions '
-                   'WHERE song_id=:id')
-            c.execute(text(sql).bindparams(**values))
+    @staticmethod
+    def addSong(song):
+        MusicDatabase.addSongs([song])
+
+    # Statements used by addSongs. Each one is executed once per batch
+    # with the parameters of all the songs (executemany)
+    insertChecksumsSQL = ('INSERT INTO checksums(song_id, sha256sum, '
+                          'audio_stream_sha256sum, embedded_audio_md5sum) '
+                          'VALUES (:id,:sha256sum,:audio_stream_sha256sum,'
+                          ':embedded_audio_md5sum)')
+    updateChecksumsSQL = ('UPDATE checksums SET sha256sum=:sha256sum, '
+                          'audio_stream_sha256sum=:audio_stream_sha256sum, '
+                          'embedded_audio_md5sum=:embedded_audio_md5sum '
+                          'WHERE song_id=:id')
+    insertFingerprintsSQL = ('INSERT INTO fingerprints(song_id, fingerprint) '
+                             'VALUES (:id,:fingerprint)')
+    updateFingerprintsSQL = ('UPDATE fingerprints SET fingerprint=:fingerprint '
+                             'WHERE song_id=:id')
+    insertPropertiesSQL = ('INSERT INTO properties(song_id, format, duration, '
+                           'bitrate, bits_per_sample, sample_rate, channels, '
+                           'audio_sha256sum, silence_at_start, '
+                           'silence_at_end) '
+                           'VALUES (:id,:format,:duration,:bitrate,'
+                           ':bits_per_sample,:sample_rate,:channels,'
+                           ':audio_sha256sum,:silence_at_start,'
+                           ':silence_at_end)')
+    updatePropertiesSQL = ('UPDATE properties SET format=:format, '
+                           'duration=:duration, bitrate=:bitrate, '
+                           'bits_per_sample=:bits_per_sample, '
+                           'sample_rate=:sample_rate, channels=:channels, '
+                           'audio_sha256sum=:audio_sha256sum, '
+                           'silence_at_start=:silence_at_start, '
+                           'silence_at_end=:silence_at_end WHERE song_id=:id')
+    insertDecodePropertiesSQL = ('INSERT INTO decode_properties(song_id, codec, '
+                                 'format, container_duration, '
+                                 'decoded_duration, container_bitrate, '
+                                 'stream_bitrate, stream_sample_format, '
+                                 'stream_bits_per_raw_sample, '
+                                 'decoded_sample_format, samples, '
+                                 'library_versions) VALUES (:id,:codec,'
+                                 ':format, :container_duration, '
+                                 ':decoded_duration, :container_bitrate, '
+                                 ':stream_bitrate, :stream_sample_format, '
+                                 ':stream_bits_per_raw_sample, '
+                                 ':decoded_sample_format, :samples, '
+                                 ':library_versions)')
+    updateDecodePropertiesSQL = ('UPDATE decode_properties SET codec=:codec, '
+                                 'format=:format, '
+                                 'container_duration=:container_duration, '
+                                 'decoded_duration=:decoded_duration, '
+                                 'container_bitrate=:container_bitrate, '
+                                 'stream_bitrate=:stream_bitrate, '
+                                 'stream_sample_format=:stream_sample_format, '
+                                 'stream_bits_per_raw_sample='
+                                 ':stream_bits_per_raw_sample, '
+                                 'decoded_sample_format='
+                                 ':decoded_sample_format, '
+                                 'samples=:samples, '
+                                 'library_versions=:library_versions '
+                                 'WHERE song_id=:id')
+    insertDynamicRangeSQL = ('INSERT INTO dynamic_range_data(song_id, dr14, '
+                             'db_peak, db_rms) '
+                             'VALUES (:id, :dr14, :db_peak, :db_rms)')
+    updateDynamicRangeSQL = ('UPDATE dynamic_range_data SET dr14=:dr14, '
+                             'db_peak=:db_peak, db_rms=:db_rms '
+                             'WHERE song_id=:id')
+    insertDecodeMessagesSQL = ('INSERT INTO decode_messages(song_id, '
+                               'time_position, level, message, pos) '
+                               'VALUES (:id,:time_position,:level,:message,'
+                               ':pos)')
+    insertTagsSQL = ('INSERT INTO tags(song_id, name, value, pos) '
+                     'VALUES (:id,:name,:value,:pos)')
+    insertCuesheetsSQL = ('INSERT INTO cuesheets(song_id, idx, '
+                          'sample_position, time_position, title) '
+                          'VALUES (:id,:idx,:sample_position,:time_position,'
+                          ':title)')
 
-            values = {'id': song.id}
-            sql = 'DELETE from decode_messages where song_id = :id'
-            c.execute(text(sql).bindparams(**values))
+    @staticmethod
+    def executeMany(c, sql, rows):
+        if not rows:
+            return
+        try:
+            c.execute(text(sql), rows)
+        except ValueError:
+            c.rollback()
+            print(sql, rows)
+            raise
 
-            tags = extractDecodeMessagesList(song.id, prop.messages)
-
-            if tags:
-                sql = ('INSERT INTO decode_messages(song_id, time_position, '
-                       'level, message, pos) VALUES (:id,:time_position,'
-                       ':level,:message,:pos)')
-                try:
-                    c.execute(text(sql), tags)
-                except ValueError:
-                    c.rollback()
-                    print(sql, tags)
-                    raise
-
-            values = {'id': song.id}
-            sql = 'DELETE from tags where song_id = :id'
-            c.execute(text(sql).bindparams(**values))
+    @staticmethod
+    def getSongIDsByPath(paths):
+        """Return a dict with the IDs of the songs at paths."""
+        c = MusicDatabase.getCursor()
+        songIDs = {}
+        for i in range(0, len(paths), 500):
+            sel = (select(Songs.c.path, Songs.c.id)
+                   .where(Songs.c.path.in_(paths[i:i + 500])))
+            songIDs.update(c.execute(sel).fetchall())
+        return songIDs
 
-            tags = extractTagsList(song)
+    @staticmethod
+    def deleteSongRows(c, table, songIDs):
+        table = MusicDatabase.table(table)
+        for i in range(0, len(songIDs), 500):
+            c.execute(table.delete()
+                      .where(table.c.song_id.in_(songIDs[i:i + 500])))
 
-            if tags:
-                sql = ('INSERT INTO tags(song_id, name, value, pos) '
-                       'VALUES (:id,:name,:value,:pos)')
-                try:
-                    c.execute(text(sql), tags)
-                except ValueError:
-                    c.rollback()
-                    print(sql, tags)
-                    raise
+    @staticmethod
+    def addSongs(songs):  # noqa: C901
+        """Add songs to the database or update them if they're already in it.
+
+        Instead of writing each song separately, each table is written
+        with a single statement executed with the values of all songs, so
+        the number of statements doesn't depend on the number of songs.
+        song.id is set in each song. Nothing is committed.
+        """
+        if config.config['immutable_database']:
+            print("Error: Can't add song to DB: "
+                  "The database is configured as immutable")
+            return
+        if not songs:
+            return
+        for song in songs:
+            song.calculateCompleteness()
 
-            sql = 'DELETE from cuesheets where song_id = :id'
-            c.execute(text(sql).bindparams(**values))
+        c = MusicDatabase.getCursor()
+        songIDs = MusicDatabase.getSongIDsByPath([song.path()
+                                                  for song in songs])
+        updated = [song for song in songs if song.path() in songIDs]
+        new = [song for song in songs if song.path() not in songIDs]
 
-            cuesheettracks = extractCueSheetTracks(song)
-
-            if cuesheettracks:
-                sql = ('INSERT INTO cuesheets(song_id, idx, sample_position, '
-                       'time_position, title) '
-                       'VALUES (:id,:idx,:sample_position,:time_position, '
-                       '        :title)')
-                try:
-                    c.execute(text(sql), cuesheettracks)
-                except ValueError:
-                    c.rollback()
-                    print(sql, cuesheettracks)
-                    raise
-
-            values = {'dr14': song.dr14,
-                      'db_peak': song.db_peak,
-                      'db_rms': song.db_rms,
-                      'id': song.id}
-            sql = ('UPDATE dynamic_range_data SET dr14=:dr14, '
-                   'db_peak=:db_peak, db_rms=:db_rms '
-                   'WHERE song_id=:id')
-            c.execute(text(sql).bindparams(**values))
-        else:
-            # print('Adding song to database')
-            values['path'] = song.path()
-            # print(values)
-            ins = Songs.insert().values(**values)
+        for song in updated:  # songs already in db, we have to update them
+            song.id = songIDs[song.path()]
+            if MusicDatabase.checkChangesForSongHistoryEntry(song):
+                MusicDatabase.createSongHistoryEntry(song.id)
+        MusicDatabase.executeMany(
+            c, MusicDatabase.updateSongRowSQL,
+            [dict(MusicDatabase.songRowValues(song), id=song.id)
+             for song in updated])
+
+        if new:
+            rows = [dict(MusicDatabase.songRowValues(song), path=song.path())
+                    for song in new]
             try:
-                result = c.execute(ins)
+                c.execute(Songs.insert(), rows)
             except ValueError:
                 c.rollback()
-                print(values)
+                print(rows)
                 raise
-            song.id = result.inserted_primary_key[0]
-
-            values = {'sha256sum': song.fileSha256sum(),
-                      'id': song.id}
-            sql = ('INSERT INTO checksums(song_id, sha256sum) '
-                   'VALUES (:id,:sha256sum)')
-            c.execute(text(sql).bindparams(**values))
-
-            values = {'fingerprint': song.fingerprint,
-                      'id': song.id}
-            sql = ('INSERT INTO fingerprints(song_id, fingerprint) '
-                   'VALUES (:id,:fingerprint)')
-            c.execute(text(sql).bindparams(**values))
-
-            values = {'format': song.format(),
-                      'duration': song.duration(),
-                      'bitrate': song.bitrate(),
-                      'bits_per_sample': song.bits_per_sample(),
-                      'sample_rate': song.sample_rate(),
-                      'channels': song.channels(),
-                      'audio_sha256sum': song.audioSha256sum(),
-                      'silence_at_start': song.silenceAtStart(),
-                      'silence_at_end': song.silenceAtEnd(),
-                      'id': song.id}
-            sql = ('INSERT INTO properties(song_id, format, duration, '
-                   'bitrate, bits_per_sample, sample_rate, channels, '
-                   'audio_sha256sum, silence_at_start, silence_at_end) '
-                   'VALUES (:id,:format,:duration,:bitrate,:bits_per_sample,'
-                   ':sample_rate,:channels,:audio_sha256sum,'
-                   ':silence_at_start,:silence_at_end)')
-            c.execute(text(sql).bindparams(**values))
-
+            songIDs = MusicDatabase.getSongIDsByPath([song.path()
+                                                      for song in new])
+            for song in new:
+                song.id = songIDs[song.path()]
+
+        def checksums(song):
+            return {'sha256sum': song.fileSha256sum(),
+                    'audio_stream_sha256sum': song.audioStreamSha256sum(),
+                    'embedded_audio_md5sum': song.embeddedAudioMD5sum(),
+                    'id': song.id}
+
+        def fingerprint(song):
+            return {'fingerprint': song.fingerprint,
+                    'id': song.id}
+
+        def properties(song):
+            return {'format': song.format(),
+                    'duration': song.duration(),
+                    'bitrate': song.bitrate(),
+                    'bits_per_sample': song.bits_per_sample(),
+                    'sample_rate': song.sample_rate(),
+                    'channels': song.channels(),
+                    'audio_sha256sum': song.audioSha256sum(),
+                    'silence_at_start': song.silenceAtStart(),
+                    'silence_at_end': song.silenceAtEnd(),
+                    'id': song.id}
+
+        def decodeProperties(song):
             prop = song.decode_properties()
-            values = {'codec': CodecEnum.id_value(prop.codec),
-                      'format': FormatEnum.id_value(prop.format_name),
-                      'container_duration': prop.container_duration,
-                      'decoded_duration': prop.decoded_duration,
-                      'container_bitrate': prop.container_bitrate,
-                      'stream_bitrate': prop.stream_bitrate,
-                      'stream_sample_format':
-                      SampleFormatEnum.id_value(prop.stream_sample_format),
-                      'stream_bits_per_raw_sample':
-                      prop.stream_bits_per_raw_sample,
-                      'decoded_sample_format':
-                      SampleFormatEnum.id_value(prop.decoded_sample_format),
-                      'samples': prop.samples,
-                      'library_versions':
-                      LibraryVersionsEnum.id_value(prop.library_versions),
-                      'id': song.id}
-            sql = ('INSERT INTO decode_properties(song_id, codec, '
-                   'format, container_duration, decoded_duration, '
-                   'container_bitrate, stream_bitrate, stream_sample_format, '
-                   'stream_bits_per_raw_sample, decoded_sample_format, '
-                   'samples, library_versions) VALUES (:id,:codec,'
-                   ':format, :container_duration, :decoded_duration, '
-                   ':container_bitrate, :stream_bitrate, '
-                   ':stream_sample_format, :stream_bits_per_raw_sample, '
-                   ':decoded_sample_format, :samples, :library_versions)')
-            c.execute(text(sql).bindparams(**values))
-
-            tags = extractDecodeMessagesList(song.id, prop.messages)
-            if tags:
-                sql = ('INSERT INTO decode_messages(song_id, time_position, '
-                       'level, message, pos) VALUES (:id,:time_position,'
-                       ':level,:message,:pos)')
-                try:
-                    c.execute(text(sql), tags)
-                except ValueError:
-                    c.rollback()
-                    print(sql, tags)
-                    raise
-
-            tags = extractTagsList(song)
-            if tags:
-                sql = ('INSERT INTO tags(song_id, name, value, pos) '
-                       'VALUES (:id,:name,:value,:pos)')
-                try:
-                    c.execute(text(sql), tags)
-                except ValueError:
-                    c.rollback()
-                    print(sql, tags)
-                    raise
-            albumID = MusicDatabase.getAlbumID(albumPath(song.path()),
-                                               connection=c)
-            MusicDatabase.setSongInAlbum(song.id, albumID, connection=c)
-
-            cuesheettracks = extractCueSheetTracks(song)
-
-            if cuesheettracks:
-                sql = ('INSERT INTO cuesheets(song_id, idx, sample_position, '
-                       'time_position, title) '
-                       'VALUES (:id,:idx,:sample_position,:time_position,'
-                       '        :title)')
-                try:
-                    c.execute(text(sql), cuesheettracks)
-                except ValueError:
-                    c.rollback()
-                    print(sql, cuesheettracks)
-                    raise
-
-            values = {'dr14': song.dr14,
-                      'db_peak': song.db_peak,
-                      'db_rms': song.db_rms,
-                      'id': song.id}
-            sql = ('INSERT INTO dynamic_range_data(song_id, dr14, db_peak, '
-                   'db_rms) VALUES (:id, :dr14, :db_peak, :db_rms)')
-            c.execute(text(sql).bindparams(**values))
-
-            sql = text('select id from users')
-            result = c.execute(sql)
-            user_ids = [x[0] for x in result.fetchall()]
+            return {'codec': CodecEnum.id_value(prop.codec),
+                    'format': FormatEnum.id_value(prop.format_name),
+                    'container_duration': prop.container_duration,
+                    'decoded_duration': prop.decoded_duration,
+                    'container_bitrate': prop.container_bitrate,
+                    'stream_bitrate': prop.stream_bitrate,
+                    'stream_sample_format':
+                    SampleFormatEnum.id_value(prop.stream_sample_format),
+                    'stream_bits_per_raw_sample':
+                    prop.stream_bits_per_raw_sample,
+                    'decoded_sample_format':
+                    SampleFormatEnum.id_value(prop.decoded_sample_format),
+                    'samples': prop.samples,
+                    'library_versions':
+                    LibraryVersionsEnum.id_value(prop.library_versions),
+                    'id': song.id}
+
+        def dynamicRange(song):
+            return {'dr14': song.dr14,
+                    'db_peak': song.db_peak,
+                    'db_rms': song.db_rms,
+                    'id': song.id}
+
+        for values, insertSQL, updateSQL in \
+                ((checksums, MusicDatabase.insertChecksumsSQL,
+                  MusicDatabase.updateChecksumsSQL),
+                 (fingerprint, MusicDatabase.insertFingerprintsSQL,
+                  MusicDatabase.updateFingerprintsSQL),
+                 (properties, MusicDatabase.insertPropertiesSQL,
+                  MusicDatabase.updatePropertiesSQL),
+                 (decodeProperties, MusicDatabase.insertDecodePropertiesSQL,
+                  MusicDatabase.updateDecodePropertiesSQL),
+                 (dynamicRange, MusicDatabase.insertDynamicRangeSQL,
+                  MusicDatabase.updateDynamicRangeSQL)):
+            MusicDatabase.executeMany(c, insertSQL,
+                                      [values(song) for song in new])
+            MusicDatabase.executeMany(c, updateSQL,
+                                      [values(song) for song in updated])
+
+        updatedIDs = [song.id for song in updated]
+        for table in ('decoded_fingerprints', 'decode_messages', 'tags',
+                      'cuesheets'):
+            MusicDatabase.deleteSongRows(c, table, updatedIDs)
+
+        rows = []
+        for song in songs:
+            decoded = song.rawFingerprint
+            if decoded is None and song.fingerprint:
+                decoded = decodeFingerprint(song.fingerprint)
+            if decoded:
+                rows.append({'song_id': song.id, 'fingerprint': decoded})
+        if rows:
+            c.execute(DecodedFingerprints.insert(), rows)
+
+        MusicDatabase.executeMany(
+            c, MusicDatabase.insertDecodeMessagesSQL,
+            [row for song in songs for row in extractDecodeMessagesList(
+                song.id, song.decode_properties().messages)])
+        MusicDatabase.executeMany(
+            c, MusicDatabase.insertTagsSQL,
+            [row for song in songs for row in extractTagsList(song)])
+        MusicDatabase.executeMany(
+            c, MusicDatabase.insertCuesheetsSQL,
+            [row for song in songs for row in extractCueSheetTracks(song)])
+
+        if not new:
+            return
 
-            values = {'song_id': song.id, 'rating': None}
+        newIDs = [song.id for song in new]
+        albumIDs = {}
+        rows = []
+        for song in new:
+            path = albumPath(song.path())
+            if path not in albumIDs:
+                albumIDs[path] = MusicDatabase.getAlbumID(path, connection=c)
+            rows.append({'song_id': song.id, 'album_id': albumIDs[path]})
+        MusicDatabase.deleteSongRows(c, 'album_songs', newIDs)
+        c.execute(MusicDatabase.table('album_songs').insert(), rows)
+
+        sql = text('select id from users')
+        result = c.execute(sql)
+        user_ids = [x[0] for x in result.fetchall()]
+        rows = [{'song_id': songID, 'user_id': user_id, 'rating': None}
+                for songID in newIDs for user_id in user_ids]
+        if rows:
             sql = text('INSERT INTO songs_ratings(song_id, user_id, rating) '
                        'VALUES (:song_id,:user_id, :rating)')
-            for user_id in user_ids:
-                values['user_id'] = user_id
-                c.execute(sql.bindparams(**values))
+            c.execute(sql, rows)
 
     @staticmethod
     def removeSong(song=None, byID=None):
@@ -659,11 +727,18 @@ class MusicDatabase:
         params = {'id': byID}
         c.execute(text('DELETE FROM checksums where song_id=:id').bindparams(**params))
         c.execute(text('DELETE FROM fingerprints where song_id=:id').bindparams(**params))
+        c.execute(text('DELETE FROM decoded_fingerprints where song_id=:id').bindparams(**params))
         c.execute(text('DELETE FROM tags where song_id=:id').bindparams(**params))
         c.execute(text('DELETE FROM properties where song_id=:id').bindparams(**params))
         c.execute(text('DELETE FROM songs_ratings where song_id=:id').bindparams(**params))
         c.execute(text('DELETE FROM album_songs where song_id=:id').bindparams(**params))
+        # The song's cluster may be split when it's removed
+        duplicates = [x[1] for x in MusicDatabase.getSongDuplicates(byID)
+                      if x[1] != byID]
+        c.execute(text('DELETE FROM duplicate_clusters where song_id=:id').bindparams(**params))
+        c.execute(text('DELETE FROM similarities where song_id1=:id or song_id2=:id').bindparams(**params))
         c.execute(text('DELETE FROM songs where id=:id').bindparams(**params))
+        MusicDatabase.updateDuplicateClusters(duplicates)
         MusicDatabase.commit()
 
     @staticmethod
@@ -722,6 +797,53 @@ or name {like} '%%MusicBrainz/Track Id'"""))
         sql = ('UPDATE fingerprints SET fingerprint=:fingerprint '
                'WHERE song_id=:id')
         c.execute(text(sql).bindparams(**values))
+        cls.updateDecodedFingerprint(songID, fingerprint)
+
+    @staticmethod
+    def updateDecodedFingerprint(songID, fingerprint, decoded=None):
+        """Store the decoded frames of an acoustid fingerprint.
+
+        decoded can be the already decoded frames of fingerprint.
+        """
+        if config.config['immutable_database']:
+            print("Error: Can't update song decoded fingerprint: "
+                  "The database is configured as immutable")
+            return
+        c = MusicDatabase.getCursor()
+        c.execute(DecodedFingerprints.delete()
+                  .where(DecodedFingerprints.c.song_id == songID))
+        if decoded is None and fingerprint:
+            decoded = decodeFingerprint(fingerprint)
+        if decoded:
+            c.execute(DecodedFingerprints.insert()
+                      .values(song_id=songID, fingerprint=decoded))
+
+    @staticmethod
+    def songIDsWithoutDecodedFingerprints():
+        c = MusicDatabase.getCursor()
+        sel = (select(Fingerprints.c.song_id)
+               .where(Fingerprints.c.fingerprint.is_not(None),
+                      ~exists().where(DecodedFingerprints.c.song_id ==
+                                      Fingerprints.c.song_id))
+               .order_by(Fingerprints.c.song_id))
+        return [x[0] for x in c.execute(sel).fetchall()]
+
+    @staticmethod
+    def getEncodedFingerprints(songIDs):
+        """Return a dict with the acoustid fingerprints of songIDs."""
+        c = MusicDatabase.getCursor()
+        sel = (select(Fingerprints.c.song_id, Fingerprints.c.fingerprint)
+               .where(Fingerprints.c.song_id.in_(songIDs)))
+        return dict(c.execute(sel).fetchall())
+
+    @staticmethod
+    def getDecodedFingerprints(songIDs):
+        """Return a dict with the decoded fingerprints of songIDs."""
+        c = MusicDatabase.getCursor()
+        sel = (select(DecodedFingerprints.c.song_id,
+                      DecodedFingerprints.c.fingerprint)
+               .where(DecodedFingerprints.c.song_id.in_(songIDs)))
+        return dict(c.execute(sel).fetchall())
 
     @classmethod
     def songIDsWithoutFingerprints(cls):
@@ -741,6 +863,79 @@ or name {like} '%%MusicBrainz/Track Id'"""))
                 cls.mtime_cache_by_path[path] = mtime
                 cls.mtime_cache_by_id[id] = (mtime, path)
 
+    @classmethod
+    def updateMtimeCache(cls, paths=None):
+        '''Read again the mtimes of the songs at paths from the database.
+
+        If paths is None, the whole cache is read again when it's needed.'''
+        if paths is None or not cls.mtime_cache_by_path:
+            cls.mtime_cache_by_path = {}
+            cls.mtime_cache_by_id = {}
+            return
+        paths = [os.path.normpath(path) for path in paths]
+        for path in paths:
+            cls.mtime_cache_by_path.pop(path, None)
+        c = MusicDatabase.getCursor()
+        for i in range(0, len(paths), 500):
+            sel = (select(Songs.c.mtime, Songs.c.path, Songs.c.id)
+                   .where(Songs.c.path.in_(paths[i:i + 500])))
+            for mtime, path, id in c.execute(sel).fetchall():
+                mtime = float(mtime)
+                cls.mtime_cache_by_path[path] = mtime
+                cls.mtime_cache_by_id[id] = (mtime, path)
+
+    @classmethod
+    def getSongMtime(cls, path):
+        '''Return the mtime of the song at path or None if it's not in the
+        database'''
+        cls.prepareCache()
+        return cls.mtime_cache_by_path.get(os.path.normpath(path))
+
+    @staticmethod
+    def getDirectoryScans():
+        '''Return (mtime_ns, entry_count, scan_time) by directory path'''
+        c = MusicDatabase.getCursor()
+        result = c.execute(select(DirectoryScans.c.path,
+                                  DirectoryScans.c.mtime_ns,
+                                  DirectoryScans.c.entry_count,
+                                  DirectoryScans.c.scan_time))
+        return {path: (mtime_ns, entry_count, float(scan_time))
+                for path, mtime_ns, entry_count, scan_time in result}
+
+    @staticmethod
+    def updateDirectoryScans(scans, removedPaths=[]):
+        '''Store scans (a dict of (mtime_ns, entry_count, scan_time) by
+        directory path) and remove the state of removedPaths'''
+        if config.config['immutable_database']:
+            print("Error: Can't store directory scans: "
+                  "The database is configured as immutable")
+            return
+        c = MusicDatabase.getCursor()
+        paths = list(scans) + list(removedPaths)
+        for i in range(0, len(paths), 500):
+            c.execute(DirectoryScans.delete()
+                      .where(DirectoryScans.c.path.in_(paths[i:i + 500])))
+        rows = [{'path': path, 'mtime_ns': mtime_ns,
+                 'entry_count': entry_count, 'scan_time': scan_time}
+                for path, (mtime_ns, entry_count, scan_time)
+                in scans.items()]
+        for i in range(0, len(rows), 200):
+            c.execute(DirectoryScans.insert().values(rows[i:i + 200]))
+
+    @staticmethod
+    def addChecksumScrubs(command, stats):
+        """Store the (root, files, bytes, seconds) read from each device."""
+        if config.config['immutable_database']:
+            print("Error: Can't store checksum scrubs: "
+                  "The database is configured as immutable")
+            return
+        rows = [{'command': command, 'root': root, 'files': files,
+                 'bytes': size, 'seconds': seconds}
+                for root, files, size, seconds in stats]
+        if rows:
+            c = MusicDatabase.getCursor()
+            c.execute(ChecksumScrubs.insert().values(rows))
+
     @classmethod
     def isSongInDatabase(cls, path=None, songID=None, file_mtime=None):
         '''returns if a song is in the database.
@@ -775,7 +970,7 @@ or name {like} '%%MusicBrainz/Track Id'"""))
             arg = songID
         result = c.execute(sql, {'arg': arg})
 
-        return bool(result.rowcount)
+        return result.fetchone() is not None
 
     @staticmethod
     def getSongTags(songID):
@@ -1077,6 +1272,49 @@ or name {like} '%%MusicBrainz/Track Id'"""))
         c.execute(text(sql).bindparams(audio_sha256sum=audioSha256sum,
                                        id=songid))
 
+    @staticmethod
+    def addAudioStreamSha256sum(songid, audioStreamSha256sum):
+        if config.config['immutable_database']:
+            print("Error: Can't add audio stream SHA256: "
+                  "The database is configured as immutable")
+            return
+        c = MusicDatabase.getCursor()
+        sql = ('UPDATE checksums set '
+               'audio_stream_sha256sum=:audio_stream_sha256sum '
+               'where song_id=:id')
+        c.execute(text(sql).bindparams(
+            audio_stream_sha256sum=audioStreamSha256sum, id=songid))
+
+    @staticmethod
+    def addEmbeddedAudioMD5sum(songid, embeddedAudioMD5sum):
+        if config.config['immutable_database']:
+            print("Error: Can't add embedded audio MD5: "
+                  "The database is configured as immutable")
+            return
+        c = MusicDatabase.getCursor()
+        sql = ('UPDATE checksums set '
+               'embedded_audio_md5sum=:embedded_audio_md5sum '
+               'where song_id=:id')
+        c.execute(text(sql).bindparams(
+            embedded_audio_md5sum=embeddedAudioMD5sum, id=songid))
+
+    @staticmethod
+    def getAudioStreamSha256sum(path):
+        """Return (songID, audio stream sha256) of the song at path.
+
+        Returns (None, None) if the song is not in the database. The
+        checksum is None for songs imported with older versions.
+        """
+        c = MusicDatabase.getCursor()
+        sql = ('SELECT songs.id, checksums.audio_stream_sha256sum '
+               'FROM songs, checksums '
+               'WHERE songs.path = :path AND songs.id = checksums.song_id')
+        result = c.execute(text(sql).bindparams(
+            path=os.path.normpath(path))).fetchone()
+        if not result:
+            return None, None
+        return result[0], result[1]
+
     @staticmethod
     def addSongDecodeProperties(songid, properties):
         if config.config['immutable_database']:
@@ -1086,7 +1324,7 @@ or name {like} '%%MusicBrainz/Track Id'"""))
         c = MusicDatabase.getCursor()
 
         values = {'codec': CodecEnum.id_value(properties.codec),
-                  'format': FormatEnum.id_value(properties.format),
+                  'format': FormatEnum.id_value(properties.format_name),
                   'container_duration': properties.container_duration,
                   'decoded_duration': properties.decoded_duration,
                   'container_bitrate': properties.container_bitrate,
@@ -1191,6 +1429,7 @@ or name {like} '%%MusicBrainz/Track Id'"""))
             result = c.execute(text(sql).bindparams(match_offset=offset,
                                similarity=similarity,
                                id1=songid1, id2=songid2))
+        MusicDatabase.updateDuplicateClusters([songid1, songid2])
 
     @staticmethod
     def removeSongsSimilarity(songid1, songid2):
@@ -1205,6 +1444,7 @@ or name {like} '%%MusicBrainz/Track Id'"""))
         sql = ('DELETE FROM similarities WHERE '
                'song_id1=:id1 AND song_id2=:id2')
         c.execute(text(sql).bindparams(id1=songid1, id2=songid2))
+        MusicDatabase.updateDuplicateClusters([songid1, songid2])
 
     @staticmethod
     def getSimilarSongs(condition=None):
@@ -1221,6 +1461,141 @@ or name {like} '%%MusicBrainz/Track Id'"""))
             pairs.append((songid1, songid2, offset, similarity))
         return pairs
 
+    @staticmethod
+    def writeDuplicateClusters(clusters):
+        """Insert clusters (a dict of lists of song IDs by cluster ID)."""
+        if not clusters:
+            return
+        c = MusicDatabase.getCursor()
+        songIDs = [songID for songs in clusters.values() for songID in songs]
+        quality = {}
+        for i in range(0, len(songIDs), 500):
+            sel = (select(Properties.c.song_id, Properties.c.format,
+                          Properties.c.bits_per_sample,
+                          Properties.c.sample_rate, Properties.c.channels,
+                          Properties.c.bitrate)
+                   .where(Properties.c.song_id.in_(songIDs[i:i + 500])))
+            for songID, *properties in c.execute(sel).fetchall():
+                quality[songID] = audioQualityKey(*properties)
+
+        rows = []
+        for clusterID, songs in sorted(clusters.items()):
+            # The lowest song ID wins ties
+            best = max(songs, key=lambda x: (quality.get(x, ()), -x))
+            rows.extend({'song_id': songID, 'cluster_id': clusterID,
+                         'is_best': songID == best} for songID in songs)
+        for i in range(0, len(rows), 200):
+            c.execute(DuplicateClusters.insert().values(rows[i:i + 200]))
+
+    @staticmethod
+    def rebuildDuplicateClusters():
+        """Recalculate all duplicate clusters from the similarities table."""
+        if config.config['immutable_database']:
+            print("Error: Can't rebuild duplicate clusters: "
+                  "The database is configured as immutable")
+            return None
+        c = MusicDatabase.getCursor()
+        sel = (select(Similarities.c.song_id1, Similarities.c.song_id2)
+               .where(Similarities.c.similarity >=
+                      config.config['match_threshold']))
+        clusters = UnionFind()
+        for songID1, songID2 in c.execute(sel):
+            clusters.union(songID1, songID2)
+        clusters = clusters.groups()
+        c.execute(DuplicateClusters.delete())
+        MusicDatabase.writeDuplicateClusters(clusters)
+        return clusters
+
+    @staticmethod
+    def updateDuplicateClusters(songIDs):
+        """Update the duplicate clusters after similarities of songIDs changed.
+
+        The clusters of songIDs are rebuilt following the similarities above
+        match_threshold from them, so clusters are merged when a new
+        similarity connects them and split when the similarity that
+        connected two parts is removed or lowered.
+        """
+        if config.config['immutable_database']:
+            print("Error: Can't update duplicate clusters: "
+                  "The database is configured as immutable")
+            return
+        songIDs = sorted(set(songIDs))
+        if not songIDs:
+            return
+        c = MusicDatabase.getCursor()
+        # Keep the number of parameters of each statement below sqlite's
+        # limit (each batch is used twice in the similarities query)
+        step = 400
+
+        pending = set(songIDs)
+        for i in range(0, len(songIDs), step):
+            clusterIDs = (select(DuplicateClusters.c.cluster_id)
+                          .where(DuplicateClusters.c.song_id
+                                 .in_(songIDs[i:i + step])))
+            sel = (select(DuplicateClusters.c.song_id)
+                   .where(DuplicateClusters.c.cluster_id.in_(clusterIDs)))
+            pending.update(x[0] for x in c.execute(sel).fetchall())
+
+        clusters = UnionFind()
+        visited = set()
+        threshold = config.config['match_threshold']
+        while pending:
+            visited.update(pending)
+            pending = sorted(pending)
+            found = set()
+            for i in range(0, len(pending), step):
+                ids = pending[i:i + step]
+                sel = (select(Similarities.c.song_id1, Similarities.c.song_id2)
+                       .where(Similarities.c.similarity >= threshold,
+                              or_(Similarities.c.song_id1.in_(ids),
+                                  Similarities.c.song_id2.in_(ids))))
+                for songID1, songID2 in c.execute(sel).fetchall():
+                    clusters.union(songID1, songID2)
+                    found.add(songID1)
+                    found.add(songID2)
+            pending = found - visited
+
+        visited = sorted(visited)
+        for i in range(0, len(visited), step):
+            c.execute(DuplicateClusters.delete()
+                      .where(DuplicateClusters.c.song_id
+                             .in_(visited[i:i + step])))
+        MusicDatabase.writeDuplicateClusters(clusters.groups())
+
+    @staticmethod
+    def getDuplicateClusters():
+        """Return a list of (cluster_id, song_id, path, is_best) tuples.
+
+        The list is sorted by cluster and song ID.
+        """
+        c = MusicDatabase.getCursor()
+        sel = (select(DuplicateClusters.c.cluster_id,
+                      DuplicateClusters.c.song_id, Songs.c.path,
+                      DuplicateClusters.c.is_best)
+               .where(DuplicateClusters.c.song_id == Songs.c.id)
+               .order_by(DuplicateClusters.c.cluster_id,
+                         DuplicateClusters.c.song_id))
+        return [tuple(x) for x in c.execute(sel).fetchall()]
+
+    @staticmethod
+    def getSongDuplicates(songID):
+        """Return the (cluster_id, song_id, path, is_best) of songID's cluster.
+
+        The list includes songID itself and is empty if songID has no
+        duplicates.
+        """
+        c = MusicDatabase.getCursor()
+        clusterID = (select(DuplicateClusters.c.cluster_id)
+                     .where(DuplicateClusters.c.song_id == songID)
+                     .scalar_subquery())
+        sel = (select(DuplicateClusters.c.cluster_id,
+                      DuplicateClusters.c.song_id, Songs.c.path,
+                      DuplicateClusters.c.is_best)
+               .where(DuplicateClusters.c.cluster_id == clusterID,
+                      DuplicateClusters.c.song_id == Songs.c.id)
+               .order_by(DuplicateClusters.c.song_id))
+        return [tuple(x) for x in c.execute(sel).fetchall()]
+
     @staticmethod
     def getGenres(ids=[], paths=[], root=None):
         conditions = []
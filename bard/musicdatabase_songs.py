@@ -1,20 +1,24 @@
 from bard.musicdatabase import MusicDatabase
 from bard.song import Song
-from sqlalchemy import text
+from sqlalchemy import text, bindparam
 import os.path
 
 
+def musicStatement(where_clause='', tables=[], columns=''):
+    if 'songs' not in tables:
+        tables = ['songs'] + tables
+    return ('SELECT id, root, path, mtime, title, artist, album, '
+            'albumartist, track, date, genre, discnumber, '
+            'coverwidth, coverheight, covermd5%s FROM %s %s' %
+            (columns, ','.join(tables), where_clause))
+
+
 def getMusic(where_clause='', where_values=None, tables=[],
              order_by=None, limit=None, metadata=False):
     # print(where_clause)
     c = MusicDatabase.getCursor()
 
-    if 'songs' not in tables:
-        tables.insert(0, 'songs')
-    statement = ('SELECT id, root, path, mtime, title, artist, album, '
-                 'albumArtist, track, date, genre, discNumber, '
-                 'coverWidth, coverHeight, coverMD5 FROM %s %s' %
-                 (','.join(tables), where_clause))
+    statement = musicStatement(where_clause, tables)
     if order_by:
         statement += ' ORDER BY %s' % order_by
     if limit:
@@ -31,6 +35,70 @@ def getMusic(where_clause='', where_values=None, tables=[],
     return r
 
 
+def iterMusic(where_clause='', where_values=None, tables=[],
+              sort_key=None, batch_size=1000, metadata=False):
+    """Yield the songs getMusic would return without reading all at once.
+
+    Songs are read in batches of batch_size songs ordered by id (or by the
+    sort_key SQL expression and id). Each batch is read with a new query
+    that continues after the last song of the previous one, so memory
+    usage doesn't depend on the number of songs and the database can be
+    modified (and committed) while iterating. If metadata is True, the
+    tags and properties of each batch are read with updateSongsTags.
+    """
+    c = MusicDatabase.getCursor()
+    if sort_key:
+        statement = musicStatement(where_clause, tables,
+                                   ', %s AS sort_key' % sort_key)
+        order_by = 'sort_key, id'
+        keyset = ('WHERE sort_key > :last_key OR '
+                  '(sort_key = :last_key AND id > :last_id)')
+    else:
+        statement = musicStatement(where_clause, tables)
+        order_by = 'id'
+        keyset = 'WHERE id > :last_id'
+
+    values = dict(where_values or {})
+    condition = ''
+    while True:
+        sql = ('SELECT * FROM (%s) AS music %s ORDER BY %s LIMIT %d' %
+               (statement, condition, order_by, batch_size))
+        rows = c.execute(text(sql), values).fetchall()
+        songs = [Song(x) for x in rows]
+        if metadata and songs:
+            MusicDatabase.updateSongsTags(songs)
+        yield from songs
+        if len(rows) < batch_size:
+            return
+        last = rows[-1]._mapping
+        values['last_id'] = last['id']
+        if sort_key:
+            values['last_key'] = last['sort_key']
+        condition = keyset
+
+
+def iterMusicByIDs(songIDs, batch_size=1000, metadata=False):
+    """Yield the songs with the IDs in songIDs in the same order.
+
+    Songs are read in batches of batch_size songs. Songs removed from the
+    database before their batch is read are skipped. If metadata is True,
+    the tags and properties of each batch are read with updateSongsTags.
+    """
+    c = MusicDatabase.getCursor()
+    sql = text(musicStatement('WHERE id IN :ids')).bindparams(
+        bindparam('ids', expanding=True))
+    for i in range(0, len(songIDs), batch_size):
+        ids = songIDs[i:i + batch_size]
+        songs = {}
+        for x in c.execute(sql, {'ids': ids}).fetchall():
+            song = Song(x)
+            songs[song.id] = song
+        songs = [songs[songID] for songID in ids if songID in songs]
+        if metadata and songs:
+            MusicDatabase.updateSongsTags(songs)
+        yield from songs
+
+
 def getSongs(path=None, songID=None, query=None, metadata=False):  # noqa: C901
     where = ''
     values = None
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+import os
+import time
+
+
+class ScrubScheduler:
+    """Run a function on the files of songs in a pool of threads.
+
+    Songs are given in one iterator per root and roots are grouped by
+    their device. At most jobs_per_device files of each device are
+    processed at the same time, so a slow network filesystem doesn't use
+    all the threads while the files of a local disk are waiting. Each
+    device only reads queue_size songs ahead from the iterators of its
+    roots, so a device with many songs doesn't delay reading the songs of
+    the rest. No more files are started once max_seconds passed or
+    max_bytes were read, so a large collection can be checked over several
+    runs. The number of files and bytes read from each device are recorded
+    to show and store the throughput.
+    """
+
+    queue_size = 100
+
+    def __init__(self, jobs=1, jobs_per_device=1, max_seconds=None,
+                 max_bytes=None):
+        self.jobs = jobs
+        self.jobs_per_device = jobs_per_device
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        self.devices = {}
+        # (files, bytes, root) of each device
+        self.stats = {}
+        self.bytes = 0
+        self.start_time = None
+        self.end_time = None
+        self.stopped = False
+
+    def device(self, root):
+        try:
+            return self.devices[root]
+        except KeyError:
+            pass
+        try:
+            device = os.stat(root).st_dev
+        except OSError:
+            device = root
+        self.devices[root] = device
+        self.stats.setdefault(device, [0, 0, root])
+        return device
+
+    def budgetExhausted(self):
+        if (self.max_seconds is not None and
+                time.time() - self.start_time >= self.max_seconds):
+            return True
+        return self.max_bytes is not None and self.bytes >= self.max_bytes
+
+    @staticmethod
+    def work(function, path):
+        size = os.path.getsize(path)
+        return function(path), size
+
+    def run(self, songsByRoot, function):
+        """Yield (song, function(song.path()), exception) for songs.
+
+        songsByRoot is a dict with an iterator over the songs of each
+        root. Results are returned as files are processed. exception is
+        the exception raised processing the file, or None.
+        """
+        sources = {}
+        for root, songs in songsByRoot.items():
+            sources.setdefault(self.device(root), deque()).append(iter(songs))
+        queues = {device: deque() for device in sources}
+        active = {device: 0 for device in sources}
+        running = {}
+        self.start_time = time.time()
+        executor = ThreadPoolExecutor(self.jobs)
+        try:
+            while True:
+                for device, queue in queues.items():
+                    # Read songs from the roots of the device in turns
+                    roots = sources[device]
+                    while roots and len(queue) < self.queue_size:
+                        try:
+                            queue.append(next(roots[0]))
+                        except StopIteration:
+                            roots.popleft()
+                            continue
+                        roots.rotate(-1)
+
+                submitted = True
+                while (submitted and len(running) < self.jobs and
+                       not self.budgetExhausted()):
+                    submitted = False
+                    for device, queue in queues.items():
+                        if (not queue or len(running) >= self.jobs or
+                                active[device] >= self.jobs_per_device):
+                            continue
+                        song = queue.popleft()
+                        future = executor.submit(ScrubScheduler.work,
+                                                 function, song.path())
+                        running[future] = (song, device)
+                        active[device] += 1
+                        submitted = True
+                if not running:
+                    self.stopped = any(queues.values())
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    song, device = running.pop(future)
+                    active[device] -= 1
+                    try:
+                        result, size = future.result()
+                    except Exception as e:
+                        yield song, None, e
+                        continue
+                    self.bytes += size
+                    self.stats[device][0] += 1
+                    self.stats[device][1] += size
+                    yield song, result, None
+        finally:
+            executor.shutdown(cancel_futures=True)
+            self.end_time = time.time()
+
+    def statistics(self):
+        """Return the (root, files, bytes, seconds) read from each device."""
+        elapsed = self.end_time - self.start_time
+        return [(root, files, size, elapsed)
+                for files, size, root in self.stats.values()]
+
+    def printSummary(self):
+        for root, files, size, elapsed in self.statistics():
+            elapsed = max(elapsed, 0.001)
+            print('%s: %d files, %.1f MiB in %.1f seconds (%.1f MiB/s)' %
+                  (root, files, size / 2**20, elapsed,
+                   size / 2**20 / elapsed))
+        if self.stopped:
+            print('Stopped before checking all songs')
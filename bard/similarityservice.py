@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+"""Service that keeps the fingerprints in memory to find similar songs.
+
+The service listens on a unix socket (similarity_service_socket in the
+config file). Each request and response is a JSON object in a line:
+
+  {"command": "ping"}
+  {"command": "match", "fingerprint": [...], "duration": 200.0}
+  {"command": "match", "path": "/path/to/file.mp3"}
+      -> {"matches": [[song_id, offset, similarity], ...]}
+  {"command": "update", "added": [song_id, ...], "removed": [song_id, ...]}
+      -> {"songs": number_of_songs}
+
+Errors are returned as {"error": message}.
+"""
+
+from bard.musicdatabase import MusicDatabase
+from bard.fingerprint_store import refreshFingerprintStore
+from bard.song import Song
+import bard.config as config
+import chromaprint
+import socketserver
+import socket
+import json
+import os
+
+
+class SimilarityServiceClient:
+    """Send requests to the similarity service.
+
+    All methods return None if the service is not running or doesn't
+    answer in timeout seconds.
+    """
+
+    def __init__(self, path=None, timeout=60):
+        self.path = path or config.config['similarity_service_socket']
+        self.timeout = timeout
+
+    def request(self, request):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(self.timeout)
+                sock.connect(self.path)
+                sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+                with sock.makefile('rb') as f:
+                    line = f.readline()
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+        except OSError as e:
+            # It timed out or closed the connection while busy
+            print(f'Error communicating with the similarity service: {e}')
+            return None
+        if not line:
+            return None
+        response = json.loads(line)
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    def ping(self):
+        return self.request({'command': 'ping'}) is not None
+
+    def match(self, fingerprint, duration):
+        response = self.request({'command': 'match',
+                                 'fingerprint': fingerprint,
+                                 'duration': duration})
+        if response is None:
+            return None
+        return [tuple(x) for x in response['matches']]
+
+    def notifyUpdate(self, added=[], removed=[]):
+        return self.request({'command': 'update',
+                             'added': list(added),
+                             'removed': list(removed)})
+
+
+class SimilarityService:
+    def __init__(self, fpm, store, verbose=False):
+        self.fpm = fpm
+        self.store = store
+        self.verbose = verbose
+        self.fpm.setStore(store)
+        self.fpm.addSongsFromStore()
+
+    def match(self, request):
+        if 'path' in request:
+            song = Song(request['path'])
+            fingerprint = chromaprint.decode_fingerprint(
+                song.getAcoustidFingerprint())[0]
+            duration = song.durationWithoutSilences()
+        else:
+            fingerprint = request['fingerprint']
+            duration = request['duration']
+        return {'matches': self.fpm.compareFingerprint(fingerprint, duration)}
+
+    def update(self, request):
+        # End the current transaction to see the changes committed by
+        # other processes. The store is reloaded since other processes
+        # may have appended data to it.
+        MusicDatabase.getConnection().rollback()
+        refreshFingerprintStore(self.store)
+        durations = {songID: duration
+                     for songID, _, duration in self.store.entries()}
+
+        for songID in request.get('removed', []):
+            self.fpm.removeSong(songID)
+        for songID in request.get('added', []):
+            if songID in durations:
+                self.fpm.addSong(songID, None, durations[songID])
+            else:
+                self.fpm.removeSong(songID)
+        self.fpm.releaseOldMappings()
+        if self.verbose:
+            print(f'Updated {len(request.get("added", []))} songs and '
+                  f'removed {len(request.get("removed", []))} songs')
+        return {'songs': self.fpm.size()}
+
+    def handle(self, request):
+        command = request.get('command')
+        if command == 'ping':
+            return {'songs': self.fpm.size()}
+        if command == 'match':
+            return self.match(request)
+        if command == 'update':
+            return self.update(request)
+        return {'error': f'Unknown command: {command}'}
+
+
+class SimilarityRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.service.handle(json.loads(line))
+            except Exception as e:
+                response = {'error': f'{type(e).__name__}: {e}'}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+def runSimilarityService(fpm, store, verbose=False):
+    """Run the similarity service until it's interrupted.
+
+    fpm is an empty FingerprintManager configured to compare songs.
+    Requests are handled one at a time, so fpm is never used concurrently.
+    """
+    path = config.config['similarity_service_socket']
+    if SimilarityServiceClient(path).ping():
+        print(f'The similarity service is already running at {path}')
+        return False
+    if os.path.exists(path):
+        os.remove(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    service = SimilarityService(fpm, store, verbose=verbose)
+    with socketserver.UnixStreamServer(path,
+                                       SimilarityRequestHandler) as server:
+        os.chmod(path, 0o600)
+        server.service = service
+        print(f'Similarity service with {fpm.size()} songs listening at '
+              f'{path}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(path)
+    return True
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+"""Compute song similarities in shards that can run in parallel.
+
+Song similarities are calculated comparing each song with all songs with
+a lower song ID. In sharded mode, shard N of M only compares the songs
+whose ID modulo M is N - 1, so all shards have a similar amount of work.
+Shards can run in different processes or in different hosts sharing the
+shard directory.
+
+The shard directory contains:
+  * plan.json: the number of shards and the range of song IDs to process.
+    It's created by the first shard that runs so all shards process the
+    same songs even if new songs are added to the database meanwhile.
+  * shard-N-of-M.tsv: the similarities found by a shard, one per line.
+  * shard-N-of-M.checkpoint: the last song processed by a shard and the
+    size of its results file at that point, so it can be resumed.
+
+Once all shards are finished, the results are loaded into the database
+with mergeSimilarityShards.
+"""
+
+from bard.musicdatabase import MusicDatabase
+from bard.similaritywriter import SimilarityWriter
+import argparse
+import json
+import os
+import time
+
+checkpoint_interval = 60
+
+
+def parseShard(value):
+    """Parse a shard given as N/M (counting from 1) to (N - 1, M)."""
+    try:
+        shard, shards = (int(x) for x in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid shard: {value} (it should '
+                                         'be N/M)')
+    if shards < 1 or not 1 <= shard <= shards:
+        raise argparse.ArgumentTypeError(f'Invalid shard: {value} (N should '
+                                         'be between 1 and M)')
+    return shard - 1, shards
+
+
+def shardPath(shard_dir, shard, shards, suffix):
+    return os.path.join(shard_dir, f'shard-{shard + 1}-of-{shards}{suffix}')
+
+
+def writeJSON(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def readJSON(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def loadPlan(shard_dir, shards=None, from_song_id=None):
+    """Return the plan of the shard directory, creating it if needed."""
+    path = os.path.join(shard_dir, 'plan.json')
+    plan = readJSON(path)
+    if plan is None and shards is not None:
+        os.makedirs(shard_dir, exist_ok=True)
+        plan = {'shards': shards,
+                'from_song_id': from_song_id,
+                'to_song_id': MusicDatabase.lastSongID()}
+        try:
+            # Only the first shard to run creates the plan
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            return readJSON(path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(plan, f)
+    return plan
+
+
+def runSimilarityShard(fpm, store, shard_dir, shard, shards, from_song_id,
+                       verbose=False):
+    """Calculate the similarities of a shard and store them in shard_dir.
+
+    fpm is an empty FingerprintManager configured to compare songs which
+    uses store as fingerprint store.
+    """
+    plan = loadPlan(shard_dir, shards, from_song_id)
+    if plan['shards'] != shards:
+        print(f'Error: The shard directory {shard_dir} was created for '
+              f'{plan["shards"]} shards')
+        return False
+    from_song_id = plan['from_song_id']
+    to_song_id = plan['to_song_id']
+
+    results_path = shardPath(shard_dir, shard, shards, '.tsv')
+    checkpoint_path = shardPath(shard_dir, shard, shards, '.checkpoint')
+    checkpoint = (readJSON(checkpoint_path) or
+                  {'last_song_id': 0, 'size': 0, 'done': False})
+    if checkpoint['done']:
+        print(f'Shard {shard + 1}/{shards} is already finished')
+        return True
+    if checkpoint['last_song_id']:
+        print(f'Resuming shard {shard + 1}/{shards} after song '
+              f'{checkpoint["last_song_id"]}')
+
+    entries = sorted((songID, duration)
+                     for songID, _, duration in store.entries()
+                     if songID <= to_song_id)
+    fpm.setExpectedSize(len(entries))
+
+    # Discard results written after the last checkpoint
+    with open(results_path, 'a'):
+        pass
+    os.truncate(results_path, checkpoint['size'])
+
+    with open(results_path, 'a') as results:
+        def saveCheckpoint(done=False):
+            results.flush()
+            os.fsync(results.fileno())
+            checkpoint['size'] = results.tell()
+            checkpoint['done'] = done
+            writeJSON(checkpoint_path, checkpoint)
+
+        last_checkpoint = time.time()
+        for songID, duration in entries:
+            if (songID < from_song_id or
+                    songID <= checkpoint['last_song_id'] or
+                    songID % shards != shard):
+                fpm.addSong(songID, None, duration)
+                continue
+
+            result = fpm.addSongAndCompare(songID, None, duration)
+            for songID2, offset, similarity in result:
+                results.write(f'{songID2}\t{songID}\t{offset}\t'
+                              f'{similarity!r}\n')
+                if verbose:
+                    print('%d %d %d %f' % (songID2, songID, offset,
+                                           similarity))
+            checkpoint['last_song_id'] = songID
+
+            if time.time() - last_checkpoint >= checkpoint_interval:
+                saveCheckpoint()
+                last_checkpoint = time.time()
+                print(f'Shard {shard + 1}/{shards}: processed up to song '
+                      f'{songID} of {to_song_id}')
+
+        saveCheckpoint(done=True)
+    print(f'Shard {shard + 1}/{shards} finished')
+    return True
+
+
+def mergeSimilarityShards(shard_dir, verbose=False):
+    """Load the similarities calculated by all shards into the database."""
+    plan = loadPlan(shard_dir)
+    if plan is None:
+        print(f'Error: {shard_dir} is not a shard directory')
+        return False
+    shards = plan['shards']
+    checkpoints = [readJSON(shardPath(shard_dir, shard, shards,
+                                      '.checkpoint'))
+                   for shard in range(shards)]
+    unfinished = [str(shard + 1) for shard, checkpoint
+                  in enumerate(checkpoints)
+                  if not checkpoint or not checkpoint['done']]
+    if unfinished:
+        print(f'Error: Shards not finished yet: {", ".join(unfinished)}')
+        return False
+
+    similarityWriter = SimilarityWriter()
+    count = 0
+    for shard, checkpoint in enumerate(checkpoints):
+        with open(shardPath(shard_dir, shard, shards, '.tsv')) as results:
+            # Ignore anything written after the last checkpoint
+            for line in results.read(checkpoint['size']).splitlines():
+                songID1, songID2, offset, similarity = line.split('\t')
+                similarityWriter.add(int(songID1), int(songID2), int(offset),
+                                     float(similarity))
+                count += 1
+        if verbose:
+            print(f'Shard {shard + 1}/{shards} merged')
+    similarityWriter.flush()
+    print(f'{count} similarities merged from {shards} shards')
+    return True
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+from bard.musicdatabase import MusicDatabase
+from bard.db.core import Similarities
+import bard.config as config
+from sqlalchemy import tuple_
+import time
+
+
+class SimilarityWriter:
+    """Buffer song similarities and write them to the database in bulk.
+
+    Similarities are written with multi-row INSERT ... ON CONFLICT DO UPDATE
+    statements and removed similarities with a single DELETE when the
+    buffer has max_size changes or max_delay seconds passed since the last
+    flush. The duplicate clusters of the songs involved are updated and
+    changes are committed after each flush.
+    """
+
+    # Keep the number of parameters of each statement below sqlite's limit
+    rows_per_statement = 200
+
+    def __init__(self, max_size=1000, max_delay=5.0):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.similarities = {}
+        self.removed = set()
+        self.last_flush = time.time()
+
+    @staticmethod
+    def key(songid1, songid2):
+        return (songid1, songid2) if songid1 < songid2 else (songid2, songid1)
+
+    def add(self, songid1, songid2, offset, similarity):
+        if config.config['immutable_database']:
+            print("Error: Can't add song similarity: "
+                  "The database is configured as immutable")
+            return
+        if songid1 == songid2:
+            print("Error: A song shouldn't be compared with itself")
+            print(songid1, songid2, similarity, offset)
+            return
+        key = SimilarityWriter.key(songid1, songid2)
+        self.removed.discard(key)
+        self.similarities[key] = (offset, similarity)
+        self.flushIfNeeded()
+
+    def remove(self, songid1, songid2):
+        if config.config['immutable_database']:
+            print("Error: Can't remove song similarity: "
+                  "The database is configured as immutable")
+            return
+        key = SimilarityWriter.key(songid1, songid2)
+        self.similarities.pop(key, None)
+        self.removed.add(key)
+        self.flushIfNeeded()
+
+    def pending(self):
+        return len(self.similarities) + len(self.removed)
+
+    def flushIfNeeded(self):
+        if (self.pending() >= self.max_size or
+                time.time() - self.last_flush >= self.max_delay):
+            self.flush()
+
+    def insertStatement(self, rows):
+        if config.config['database'] == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        stmt = insert(Similarities).values(rows)
+        return stmt.on_conflict_do_update(
+            index_elements=[Similarities.c.song_id1, Similarities.c.song_id2],
+            set_={'match_offset': stmt.excluded.match_offset,
+                  'similarity': stmt.excluded.similarity})
+
+    def flush(self):
+        self.last_flush = time.time()
+        if not self.pending():
+            return
+        c = MusicDatabase.getCursor()
+        step = SimilarityWriter.rows_per_statement
+
+        removed = sorted(self.removed)
+        for i in range(0, len(removed), step):
+            keys = removed[i:i + step]
+            c.execute(Similarities.delete()
+                      .where(tuple_(Similarities.c.song_id1,
+                                    Similarities.c.song_id2).in_(keys)))
+
+        rows = [{'song_id1': songid1, 'song_id2': songid2,
+                 'match_offset': offset, 'similarity': similarity}
+                for (songid1, songid2), (offset, similarity)
+                in sorted(self.similarities.items())]
+        for i in range(0, len(rows), step):
+            c.execute(self.insertStatement(rows[i:i + step]))
+
+        songIDs = {songID for key in (*self.similarities, *self.removed)
+                   for songID in key}
+        MusicDatabase.updateDuplicateClusters(songIDs)
+
+        self.similarities = {}
+        self.removed = set()
+        MusicDatabase.commit()
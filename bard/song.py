@@ -2,18 +2,18 @@
 
 import bard.config as config
 from bard.utils import extractFrontCover, md5FromData, \
-    calculateFileSHA256, manualAudioCmp, \
+    calculateFileSHA256, calculateAudioStreamSHA256, manualAudioCmp, \
+    embeddedAudioMD5, \
     calculateSHA256_data, \
-    detect_silence_at_beginning_and_end, \
-    audioSegmentFromDataProperties, decodeAudio, DecodeMessageRecord
+    detect_silence_at_beginning_and_end_of_data, SilenceDetector, \
+    decodeAudio, decodeAudioChunks, DecodeMessageRecord, \
+    losslessFormats
 from bard.musicdatabase import MusicDatabase
 from bard.normalizetags import getTag
 from bard.ffprobemetadata import FFProbeMetadata
 from bard.terminalcolors import TerminalColors
 from bard.album import albumPath
 import bard.dynamicrange as dynamicrange
-from pydub import AudioSegment
-from pydub.exceptions import PydubException
 from sqlalchemy import text
 import sqlalchemy.engine.row
 from collections import namedtuple
@@ -21,6 +21,7 @@ import sqlite3
 import os
 import shutil
 import acoustid
+import hashlib
 import mutagen
 
 
@@ -29,6 +30,81 @@ CueTrack = namedtuple('CueTrack', ['idx',
                                    'title'])
 
 
+# The result of decoding and analyzing the audio of a song file. It doesn't
+# include the tags, which are cheap to read again, so it can be calculated in
+# a different process and sent back to the one adding songs to the database.
+SongAnalysis = namedtuple('SongAnalysis',
+                          ['audio_sha256sum', 'decode_properties', 'dr14',
+                           'db_peak', 'db_rms', 'silences', 'cover', 'mtime',
+                           'file_sha256sum', 'audio_stream_sha256sum',
+                           'fingerprint', 'raw_fingerprint', 'output'])
+
+
+def silenceLengths(silences):
+    """Return the seconds of silence at the start and end of a song.
+
+    silences is the list returned by detect_silence_at_beginning_and_end.
+    """
+    if not silences:
+        return None
+    silence1, silence2 = silences
+    return ((silence1[1] - silence1[0]) / 1000,
+            (silence2[1] - silence2[0]) / 1000)
+
+
+class AudioStreamAnalyzer:
+    """Analyze the audio of a song while it's being decoded.
+
+    It's used as consumer of decodeAudioChunks and calculates the audio
+    sha256sum, dynamic range and silences of each chunk as it's decoded, so
+    the whole decoded audio never has to be kept in memory. The fingerprint
+    is calculated by the decoder itself and received in setFingerprint.
+    """
+
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.drMeter = None
+        self.silenceDetector = None
+        self._fingerprint = None
+        self._rawFingerprint = None
+
+    def start(self, sample_format, bytes_per_sample, sample_rate, channels):
+        self.drMeter = dynamicrange.DynamicRangeMeter(
+            sample_format, bytes_per_sample, sample_rate, channels)
+        self.silenceDetector = SilenceDetector(
+            bytes_per_sample, sample_rate, channels,
+            min_silence_len=Song.min_silence_length,
+            silence_thresh=Song.silence_threshold)
+
+    def feed(self, data):
+        self.sha256.update(data)
+        self.drMeter.feed(data)
+        self.silenceDetector.feed(data)
+
+    def setFingerprint(self, fingerprint, raw_fingerprint):
+        self._fingerprint = fingerprint
+        self._rawFingerprint = raw_fingerprint
+
+    def audioSha256sum(self):
+        return self.sha256.hexdigest()
+
+    def dynamicRange(self):
+        """Return (dr14, db_peak, db_rms)."""
+        return self.drMeter.finish()
+
+    def silences(self):
+        return silenceLengths(self.silenceDetector.finish())
+
+    def fingerprint(self):
+        if self._fingerprint is None:
+            raise acoustid.FingerprintGenerationError(
+                'fingerprint calculation failed')
+        return self._fingerprint
+
+    def rawFingerprint(self):
+        return self._rawFingerprint
+
+
 class DifferentLengthException(Exception):
     pass
 
@@ -167,10 +243,17 @@ class Song:
     min_silence_length = 10
     ratings = None
 
-    def __init__(self, x, rootDir=None, data=None):
-        """Create a Song oject."""
+    def __init__(self, x, rootDir=None, data=None, analysis=None,
+                 metadata_only=False):
+        """Create a Song oject.
+
+        If analysis is a SongAnalysis of the file, it's used instead of
+        decoding the file again. If metadata_only is True, the audio isn't
+        decoded at all (see loadFile).
+        """
         self.tags = {}
         self.fingerprint = None
+        self.rawFingerprint = None
         self._decode_properties = None
         self.cuesheet = []
         if isinstance(x, sqlalchemy.engine.row.Row) and hasattr(x, '_mapping'):
@@ -197,7 +280,7 @@ class Song:
         else:
             self._path = os.path.normpath(x)
             self._description = self._path
-            self.loadFile(x)
+            self.loadFile(x, analysis=analysis, metadata_only=metadata_only)
 
     def hasID(self):
         try:
@@ -259,14 +342,18 @@ class Song:
 
     def calculateDR(self, audiodata=None, properties=None):
         if not audiodata or not properties:
-            audiodata, properties = decodeAudio(self.path())
-        r = dynamicrange.calculate(audiodata, properties)
+            r = dynamicrange.calculateFile(self.path())
+        else:
+            r = dynamicrange.calculate(audiodata, properties)
         (self.dr14, self.db_peak, self.db_rms) = r
         return r
 
-    def loadFile(self, filething):  # noqa: C901
-        fileinfo = filething if isinstance(filething, str) \
-            else 'file-like object'
+    def loadFile(self, filething, analysis=None, metadata_only=False):
+        """Load the metadata of filething and analyze its audio.
+
+        If metadata_only is True, the audio isn't analyzed and only the
+        tags, cover, mtime and file checksum are loaded.
+        """
         if hasattr(filething, 'seek'):
             filething.seek(0)
         try:
@@ -301,22 +388,62 @@ class Song:
             mutagen.wave.WAVE: 'wav',
             mutagen.dsf.DSF: 'dsf', }
         self._format = formattext[type(self.metadata)]
+        self._embeddedAudioMD5sum = embeddedAudioMD5(self.metadata)[0]
+
+        if metadata_only:
+            cover, self._mtime, self._fileSha256sum = \
+                Song.fileInfo(filething, self.metadata)
+            if cover:
+                (self._coverWidth, self._coverHeight,
+                 self._coverMD5) = cover
+        else:
+            self.loadAnalysis(filething, analysis)
 
-        audiodata, properties = decodeAudio(filething)
+        if self.metadata and getattr(self.metadata, 'cuesheet', None):
+            for track in self.metadata.cuesheet.tracks:
+                if (track.track_number == 255 or
+                        track.start_offset == self.metadata.info.total_samples):  # noqa: E501
+                    continue
+                timepos = (self.metadata.info.length * track.start_offset /
+                           self.metadata.info.total_samples)
 
-        self._audioSha256sum = calculateSHA256_data(audiodata)
+                try:
+                    title = self.metadata['SUBTRACKTITLES'][track.track_number - 1]  # noqa: E501
+                except (KeyError, IndexError):
+                    title = None
+                ct = CueTrack(track.track_number,
+                              track.start_offset,
+                              timepos,
+                              title)
+                self.cuesheet.append(ct)
 
-        self._decode_properties = properties
+        self.isValid = True
 
-        tmpsamplerate = properties.sample_rate
-        while len(audiodata) > 5*1024*1024*1024:
-            tmpsamplerate = tmpsamplerate // 2
-            print(f'Reducing sample rate to {tmpsamplerate}')
-            channels = min(2, properties.channels)
-            del properties
-            del audiodata
-            audiodata, properties = decodeAudio(filething, sample_rate=tmpsamplerate, sample_fmt='s16', channel_number=channels )
+    def loadAnalysis(self, filething, analysis=None):  # noqa: C901
+        """Set the audio properties of the song from analysis.
 
+        If analysis is None, filething is decoded and analyzed.
+        """
+        if analysis is None:
+            analysis = Song.analyzeFile(filething, self.metadata)
+        elif analysis.output:
+            print(analysis.output, end='')
+
+        self._audioSha256sum = analysis.audio_sha256sum
+        self._decode_properties = analysis.decode_properties
+        self.dr14 = analysis.dr14
+        self.db_peak = analysis.db_peak
+        self.db_rms = analysis.db_rms
+        if analysis.silences:
+            self._silenceAtStart, self._silenceAtEnd = analysis.silences
+        if analysis.cover:
+            (self._coverWidth, self._coverHeight,
+             self._coverMD5) = analysis.cover
+        self._mtime = analysis.mtime
+        self._fileSha256sum = analysis.file_sha256sum
+        self._audioStreamSha256sum = analysis.audio_stream_sha256sum
+        self.fingerprint = analysis.fingerprint
+        self.rawFingerprint = analysis.raw_fingerprint
 
         if self.metadata:
             if not getattr(self.metadata.info, 'bits_per_sample', None):
@@ -360,68 +487,70 @@ class Song:
             print('ffprobe check ' +
                   TerminalColors.Ok + 'OK' + TerminalColors.ENDC)
 
+    @staticmethod
+    def fileInfo(filething, metadata):
+        """Return the (cover, mtime, file_sha256sum) of filething.
 
-        (self.dr14, self.db_peak, self.db_rms) = self.calculateDR(audiodata,
-                                                                  properties)
-
-        try:
-            audio_segment = audioSegmentFromDataProperties(audiodata,
-                                                           properties)
-        except ValueError as exc:
-            print(f'Error processing {fileinfo}: {exc}')
-            raise
-
-        thr = Song.silence_threshold
-        minlen = Song.min_silence_length
-        silences = detect_silence_at_beginning_and_end(audio_segment,
-                                                       min_silence_len=minlen,
-                                                       silence_thresh=thr)
-        del audio_segment
-        if silences:
-            silence1, silence2 = silences
-            self._silenceAtStart = (silence1[1] - silence1[0]) / 1000
-            self._silenceAtEnd = (silence2[1] - silence2[0]) / 1000
-
-        if self.metadata:
+        cover is a (width, height, md5) tuple or None.
+        """
+        fileinfo = filething if isinstance(filething, str) \
+            else 'file-like object'
+        cover = None
+        if metadata:
             try:
-                image = extractFrontCover(self.metadata)
+                image = extractFrontCover(metadata)
             except OSError:
                 print('Error extracting image from %s' % fileinfo)
                 raise
-
             if image:
                 (image, imagedata) = image
-                self._coverWidth = image.width
-                self._coverHeight = image.height
-                self._coverMD5 = md5FromData(imagedata)
-
+                cover = (image.width, image.height, md5FromData(imagedata))
         try:
-            self._mtime = os.path.getmtime(filething)
+            mtime = os.path.getmtime(filething)
         except TypeError:
-            self._mtime = None
-        self._fileSha256sum = calculateFileSHA256(filething)
+            mtime = None
+        fileSha256sum = calculateFileSHA256(filething)
+        return cover, mtime, fileSha256sum
 
-        self.fingerprint = self.getAcoustidFingerprint_data(audiodata,
-                                                            properties)
-        if self.metadata and getattr(self.metadata, 'cuesheet', None):
-            for track in self.metadata.cuesheet.tracks:
-                if (track.track_number == 255 or
-                        track.start_offset == self.metadata.info.total_samples):  # noqa: E501
-                    continue
-                timepos = (self.metadata.info.length * track.start_offset /
-                           self.metadata.info.total_samples)
+    @staticmethod
+    def analyzeFile(filething, metadata):
+        """Decode and analyze the audio of filething.
 
-                try:
-                    title = self.metadata['SUBTRACKTITLES'][track.track_number - 1]  # noqa: E501
-                except (KeyError, IndexError):
-                    title = None
-                ct = CueTrack(track.track_number,
-                              track.start_offset,
-                              timepos,
-                              title)
-                self.cuesheet.append(ct)
+        metadata is the mutagen object of the file, which is used to
+        extract the cover. Returns a SongAnalysis.
+        """
+        fileinfo = filething if isinstance(filething, str) \
+            else 'file-like object'
+        analyzer = AudioStreamAnalyzer()
+        # By default the whole song is fingerprinted (not just the first 2
+        # minutes like acoustid.fingerprint does) so the fingerprints are
+        # the same as the ones calculated by previous versions.
+        decode_properties = decodeAudioChunks(
+            filething, analyzer,
+            fingerprint_length=config.config['fingerprint_max_length'])
+        if analyzer.drMeter is None:
+            print(f'Error processing {fileinfo}: no audio was decoded')
+            raise ValueError('No audio was decoded')
 
-        self.isValid = True
+        audioSha256sum = analyzer.audioSha256sum()
+
+        dr14, db_peak, db_rms = analyzer.dynamicRange()
+
+        try:
+            silences = analyzer.silences()
+        except ValueError as exc:
+            print(f'Error processing {fileinfo}: {exc}')
+            raise
+
+        cover, mtime, fileSha256sum = Song.fileInfo(filething, metadata)
+        audioStreamSha256sum = calculateAudioStreamSHA256(filething)
+
+        fingerprint = analyzer.fingerprint()
+
+        return SongAnalysis(audioSha256sum, decode_properties, dr14, db_peak,
+                            db_rms, silences, cover, mtime, fileSha256sum,
+                            audioStreamSha256sum, fingerprint,
+                            analyzer.rawFingerprint(), '')
 
     def moveFrom(self, prevSong):
         """Move prevSong to the location and values of self."""
@@ -480,7 +609,7 @@ class Song:
 
     def isLossless(self):
         self.loadMetadataInfo()
-        return self._format in ['flac', 'wv', 'ape', 'mpc']
+        return self._format in losslessFormats
 
     def audioCmp(self, other, forceSimilar=False,  # noqa: C901,
                  interactive=True, useColors=None,
@@ -811,6 +940,34 @@ class Song:
                 return self._fileSha256sum
             return ''
 
+    def audioStreamSha256sum(self):
+        try:
+            return self._audioStreamSha256sum
+        except AttributeError:
+            c = MusicDatabase.getCursor()
+            sql = ('SELECT audio_stream_sha256sum FROM checksums '
+                   'where song_id = :id')
+            result = c.execute(text(sql).bindparams(id=self.id))
+            sha = result.fetchone()
+            if sha:
+                self._audioStreamSha256sum = sha[0]
+                return self._audioStreamSha256sum
+            return None
+
+    def embeddedAudioMD5sum(self):
+        try:
+            return self._embeddedAudioMD5sum
+        except AttributeError:
+            c = MusicDatabase.getCursor()
+            sql = ('SELECT embedded_audio_md5sum FROM checksums '
+                   'where song_id = :id')
+            result = c.execute(text(sql).bindparams(id=self.id))
+            md5 = result.fetchone()
+            if md5:
+                self._embeddedAudioMD5sum = md5[0]
+                return self._embeddedAudioMD5sum
+            return None
+
     def imageSize(self):
         try:
             if not self._coverWidth:
@@ -839,22 +996,33 @@ class Song:
             Song.ratings = Ratings()
         return Song.ratings.setSongUserRating(user_id, self.id, rating)
 
+    @staticmethod
+    def detectSilences(audiodata, properties, threshold=None,
+                       min_length=None):
+        """Return the seconds of silence at the start and end of audiodata.
+
+        audiodata and properties are the values returned by decodeAudio.
+        Returns None if the audio is shorter than min_length.
+        """
+        thr = threshold or Song.silence_threshold
+        minlen = min_length or Song.min_silence_length
+        silences = detect_silence_at_beginning_and_end_of_data(
+            audiodata, properties.decoded_bytes_per_sample,
+            properties.sample_rate, properties.channels,
+            min_silence_len=minlen, silence_thresh=thr)
+        return silenceLengths(silences)
+
     def calculateSilences(self, threshold=None, min_length=None):
+        audiodata, properties = decodeAudio(self.path())
+        self._audioSha256sum = calculateSHA256_data(audiodata)
         try:
-            audio_segment = AudioSegment.from_file(self.path())
-        except PydubException as exc:
+            silences = Song.detectSilences(audiodata, properties,
+                                           threshold, min_length)
+        except ValueError as exc:
             print('Error processing:', self.path(), ':', exc)
             raise
-        self._audioSha256sum = calculateSHA256_data(audio_segment.raw_data)
-        thr = threshold or Song.silence_threshold
-        minlen = min_length or Song.min_silence_length
-        silences = detect_silence_at_beginning_and_end(audio_segment,
-                                                       min_silence_len=minlen,
-                                                       silence_thresh=thr)
         if silences:
-            silence1, silence2 = silences
-            self._silenceAtStart = (silence1[1] - silence1[0]) / 1000
-            self._silenceAtEnd = (silence2[1] - silence2[0]) / 1000
+            self._silenceAtStart, self._silenceAtEnd = silences
 
     def calculateCompleteness(self):
         value = 100
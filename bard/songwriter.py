@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+from bard.musicdatabase import MusicDatabase
+
+
+class SongWriter:
+    """Buffer analyzed songs and add them to the database in batches.
+
+    When max_size songs are pending they're written with
+    MusicDatabase.addSongs, which uses one statement per table for the
+    whole batch, and changes are committed. The IDs of the songs written
+    are appended to songIDs by the status they were added with.
+    """
+
+    def __init__(self, max_size=100):
+        self.max_size = max_size
+        self.songs = []
+        self.statuses = []
+        self.paths = set()
+        self.songIDs = {'new': [], 'updated': [], 'renamed': []}
+
+    def add(self, song, status):
+        if song.path() in self.paths:
+            # The same path can't be inserted twice in a batch
+            self.flush()
+        self.songs.append(song)
+        self.paths.add(song.path())
+        self.statuses.append(status)
+        if len(self.songs) >= self.max_size:
+            self.flush()
+
+    def flush(self):
+        if not self.songs:
+            return
+        MusicDatabase.addSongs(self.songs)
+        for song, status in zip(self.songs, self.statuses):
+            self.songIDs[status].append(song.id)
+        self.songs = []
+        self.statuses = []
+        self.paths = set()
+        MusicDatabase.commit()
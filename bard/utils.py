@@ -5,6 +5,7 @@ import time
 import re
 import hashlib
 import math
+import numpy
 from pydub import AudioSegment
 import mutagen
 import mutagen.mp3
@@ -23,9 +24,12 @@ from bard import bard_audiofile
 from pydub.utils import db_to_float
 import itertools
 import io
+import struct
 
 ImageDataTuple = namedtuple('ImageDataTuple', ['image', 'data'])
 
+losslessFormats = ['flac', 'wv', 'ape', 'mpc']
+
 DecodedAudioPropertiesTuple = namedtuple('DecodedAudioPropertiesTuple',
                                          ['codec', 'format_name',
                                           'container_duration',
@@ -141,6 +145,251 @@ def detect_silence_at_beginning_and_end(audio_segment, min_silence_len=1000,
     return [[0, song_start], [song_end, seg_len]]
 
 
+def _samplesForRMS(data, sample_width, start, end):
+    """Return the samples from start to end as pydub uses them in rms.
+
+    pydub converts 24 bit audio to 32 bit (with a padding byte as least
+    significant byte) when creating the AudioSegment.
+    """
+    if end <= start:
+        return numpy.zeros(0, dtype=numpy.int64)
+    if sample_width == 3:
+        raw = numpy.frombuffer(data, dtype=numpy.uint8,
+                               count=(end - start) * 3, offset=start * 3)
+        raw = raw.reshape(-1, 3).astype(numpy.int64)
+        values = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        values -= (values >> 23) << 24
+        return values * 256 + numpy.where(values < 0, 255, 0)
+
+    dtype = {1: '<i1', 2: '<i2', 4: '<i4'}[sample_width]
+    values = numpy.frombuffer(data, dtype=dtype, count=end - start,
+                              offset=start * sample_width)
+    return values.astype(numpy.int64)
+
+
+def _audioopRMS(samples, sample_count):
+    """Return audioop's rms of samples padded with silence to sample_count.
+
+    The squares are added sequentially in double precision like audioop
+    does, so the result is the same even when the sum can't be exact.
+    """
+    if not sample_count:
+        return 0
+    sum_squares = 0.0
+    if len(samples):
+        sum_squares = numpy.cumsum(samples.astype(numpy.float64) ** 2)[-1]
+    return int(math.sqrt(sum_squares / sample_count))
+
+
+def _loudWindows(data, sample_width, channels, frame_count,
+                 starts, ends, silence_thresh):
+    """Return which windows [starts[i], ends[i]) have rms > silence_thresh.
+
+    starts and ends are frame positions. Frames after frame_count are
+    considered silence, as pydub does when slicing past the end of the
+    audio. The rms is calculated from cumulative sums of the squared
+    samples, which are exact (squares of 32 bit samples are split in two
+    int64 arrays so they don't overflow).
+    """
+    first = min(int(starts[0]), frame_count)
+    last = min(int(ends[-1]), frame_count)
+    samples = _samplesForRMS(data, sample_width, first * channels,
+                             last * channels)
+    squares = samples * samples
+    window_starts = (numpy.minimum(starts, frame_count) - first) * channels
+    window_ends = (numpy.minimum(ends, frame_count) - first) * channels
+    if sample_width <= 2:
+        sums = numpy.zeros(len(squares) + 1, dtype=numpy.int64)
+        numpy.cumsum(squares, out=sums[1:])
+        sum_squares = (sums[window_ends] - sums[window_starts]) * 1.0
+    else:
+        high = numpy.zeros(len(squares) + 1, dtype=numpy.int64)
+        low = numpy.zeros(len(squares) + 1, dtype=numpy.int64)
+        numpy.cumsum(squares >> 31, out=high[1:])
+        numpy.cumsum(squares & 0x7fffffff, out=low[1:])
+        sum_squares = ((high[window_ends] - high[window_starts]) * 2.0 ** 31 +
+                       (low[window_ends] - low[window_starts]))
+    sample_counts = numpy.where(starts < frame_count,
+                                (ends - starts) * channels, 0)
+
+    mean_squares = numpy.divide(sum_squares, sample_counts,
+                                out=numpy.zeros(len(starts)),
+                                where=sample_counts > 0)
+    rms = numpy.sqrt(mean_squares)
+    loud = numpy.floor(rms) > silence_thresh
+
+    # audioop adds the squares in double precision, which is exact for 8
+    # and 16 bit samples. Otherwise, the windows whose rms is too close to
+    # the threshold are calculated again the same way audioop does.
+    if sample_width > 2 or sample_counts.max() > 2 ** 23:
+        threshold = math.floor(silence_thresh) + 1
+        for i in numpy.flatnonzero(abs(rms - threshold) <=
+                                   threshold * 1e-6):
+            window = samples[window_starts[i]:window_ends[i]]
+            loud[i] = _audioopRMS(window, sample_counts[i]) > silence_thresh
+    return loud
+
+
+def _growingBlocks(max_block):
+    """Yield block sizes starting with 256 windows up to max_block."""
+    size = 256
+    while True:
+        yield min(size, max_block)
+        size *= 2
+
+
+class SilenceDetector:
+    """Detect silences at the start and end of audio fed in chunks.
+
+    finish() returns the same as detect_silence_at_beginning_and_end does
+    for an AudioSegment with all the data fed. The rms of many windows is
+    calculated at once using numpy, in blocks which grow from the start
+    until the first loud window is found and from the end of each chunk
+    until the last loud window in it is found. Only the audio of windows
+    which weren't checked yet is kept.
+    """
+
+    def __init__(self, sample_width, frame_rate, channels,
+                 min_silence_len=1000, silence_thresh=-16, seek_step=1):
+        if sample_width not in (1, 2, 3, 4):
+            raise ValueError(f'Unsupported sample width: {sample_width}')
+        self.sample_width = sample_width
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.min_silence_len = min_silence_len
+        self.seek_step = seek_step
+
+        max_possible_amplitude = 2 ** (8 * (4 if sample_width == 3
+                                            else sample_width)) / 2
+        self.silence_thresh = (db_to_float(silence_thresh) *
+                               max_possible_amplitude)
+
+        self._frame_width = sample_width * channels
+        self._frames_per_ms = frame_rate / 1000.0
+        # Keep the samples read for each block of windows around 4M
+        samples_per_ms = max(1, math.ceil(self._frames_per_ms * channels))
+        self._max_block = max(16, (2 ** 22 // samples_per_ms) // seek_step)
+
+        self._data = b''  # Audio from the start of the next window
+        self._data_frame = 0  # Position of the first frame in _data
+        self._length = 0
+        self._next_start = 0
+        self._first_loud = None
+        self._last_loud = None
+
+    def feed(self, data):
+        if self._data:
+            self._data = bytes(self._data) + bytes(data)
+        else:
+            self._data = data
+        self._length += len(data)
+
+        # The length of the audio in ms is rounded when finishing, so only
+        # windows ending 1 ms before the current end are surely included.
+        frames = self._length // self._frame_width
+        last_start = int(frames / self._frames_per_ms) - \
+            self.min_silence_len - 1
+        self._checkWindows(numpy.arange(self._next_start, last_start + 1,
+                                        self.seek_step), frames)
+
+    def finish(self):
+        if self._length % self._frame_width:
+            raise ValueError("data length must be a multiple of "
+                             "'(sample_width * channels)'")
+        frames = self._length // self._frame_width
+        seg_len = round(1000 * (float(frames) / self.frame_rate))
+
+        # you can't have a silent portion of a sound that is longer than
+        # the sound
+        if seg_len < self.min_silence_len:
+            return []
+
+        last_slice_start = seg_len - self.min_silence_len
+        slice_starts = numpy.arange(self._next_start, last_slice_start + 1,
+                                    self.seek_step)
+        if last_slice_start % self.seek_step:
+            slice_starts = numpy.append(slice_starts, last_slice_start)
+        self._checkWindows(slice_starts, frames)
+        self._data = b''
+
+        if self._first_loud is None:
+            return [[0, 0], [seg_len, seg_len]]
+
+        if self._first_loud == 0:
+            song_start = 0
+        else:
+            song_start = self._first_loud + self.min_silence_len
+        return [[0, song_start], [self._last_loud, seg_len]]
+
+    def _checkWindows(self, slice_starts, frames):
+        """Check the windows starting at slice_starts (in ms).
+
+        frames is the number of frames fed until now.
+        """
+        if not len(slice_starts):
+            return
+        starts = (slice_starts * self._frames_per_ms).astype(numpy.int64)
+        ends = ((slice_starts + self.min_silence_len) *
+                self._frames_per_ms).astype(numpy.int64)
+
+        def loudWindows(a, b):
+            return numpy.flatnonzero(_loudWindows(
+                self._data, self.sample_width, self.channels,
+                frames - self._data_frame, starts[a:b] - self._data_frame,
+                ends[a:b] - self._data_frame, self.silence_thresh))
+
+        a = 0
+        if self._first_loud is None:
+            for size in _growingBlocks(self._max_block):
+                if a >= len(slice_starts):
+                    break
+                loud = loudWindows(a, a + size)
+                if len(loud):
+                    self._first_loud = int(slice_starts[a + loud[0]])
+                    self._last_loud = int(slice_starts[a + loud[-1]])
+                a += size
+                if self._first_loud is not None:
+                    break
+
+        b = len(slice_starts)
+        for size in _growingBlocks(self._max_block):
+            if b <= a:
+                break
+            loud = loudWindows(max(a, b - size), b)
+            if len(loud):
+                self._last_loud = int(slice_starts[max(a, b - size) +
+                                                   loud[-1]])
+                break
+            b -= size
+
+        # Drop the audio which is not needed by the next windows (which
+        # may include a last window not aligned to seek_step)
+        self._next_start = int(slice_starts[-1]) + self.seek_step
+        next_frame = min(int((slice_starts[-1] + 1) * self._frames_per_ms),
+                         frames)
+        offset = (next_frame - self._data_frame) * self._frame_width
+        self._data = bytes(memoryview(self._data)[offset:])
+        self._data_frame = next_frame
+
+
+def detect_silence_at_beginning_and_end_of_data(data, sample_width,
+                                                frame_rate, channels,
+                                                min_silence_len=1000,
+                                                silence_thresh=-16,
+                                                seek_step=1):
+    """Detect silences in decoded audio data without using an AudioSegment.
+
+    Returns the same as detect_silence_at_beginning_and_end does for an
+    AudioSegment with the same data and format.
+    """
+    detector = SilenceDetector(sample_width, frame_rate, channels,
+                               min_silence_len=min_silence_len,
+                               silence_thresh=silence_thresh,
+                               seek_step=seek_step)
+    detector.feed(data)
+    return detector.finish()
+
+
 def fingerprint_AudioSegment(audio_segment, maxlength=120000):
     """Fingerprint audio data given a pydub AudioSegment object.
 
@@ -167,6 +416,61 @@ def fingerprint_AudioSegment(audio_segment, maxlength=120000):
                                                      "failed")
 
 
+def decodeFingerprint(fingerprint):
+    """Decode an acoustid fingerprint to its raw frames.
+
+    Returns the frames as little endian 32 bit values (as stored in the
+    decoded_fingerprints table) or None if it can't be decoded.
+    """
+    if isinstance(fingerprint, memoryview):
+        fingerprint = fingerprint.tobytes()
+    frames = chromaprint.decode_fingerprint(fingerprint)[0]
+    if not frames:
+        return None
+    return struct.pack(f'<{len(frames)}I',
+                       *(frame & 0xffffffff for frame in frames))
+
+
+def audioQualityKey(format, bits_per_sample, sample_rate, channels, bitrate):
+    """Return a key to sort songs from worse to better audio quality.
+
+    Lossless songs are always better than lossy ones, like in Song.audioCmp.
+    """
+    return (format in losslessFormats, bits_per_sample or 0,
+            sample_rate or 0, channels or 0, bitrate or 0)
+
+
+class UnionFind:
+    """Disjoint sets of song IDs in which each set is named by its lowest ID."""
+
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, x):
+        self.parent.setdefault(x, x)
+        while self.parent[x] != x:
+            # Path halving
+            self.parent[x] = self.parent[self.parent[x]]
+            x = self.parent[x]
+        return x
+
+    def union(self, x, y):
+        x = self.find(x)
+        y = self.find(y)
+        if x < y:
+            self.parent[y] = x
+        elif y < x:
+            self.parent[x] = y
+
+    def groups(self, min_size=2):
+        """Return a dict with the sorted members of each set by its name."""
+        groups = {}
+        for x in self.parent:
+            groups.setdefault(self.find(x), []).append(x)
+        return {root: sorted(members) for root, members in groups.items()
+                if len(members) >= min_size}
+
+
 def printSongsInfo(song1, song2,
                    useColors=(TerminalColors.First, TerminalColors.Second)):
     song1.calculateCompleteness()
@@ -518,6 +822,54 @@ def calculateFileSHA256(filething):
     return sha256
 
 
+def calculateAudioStreamSHA256(filething):
+    """Return the sha256 of the encoded audio stream of filething.
+
+    The audio packets are read without decoding them, so this is much
+    faster than calculating the sha256 of the decoded audio. The checksum
+    doesn't change when only the tags or covers of the file are modified.
+    Returns None if the file can't be read.
+    """
+    if hasattr(filething, 'seek'):
+        filething.seek(0)
+        return bard_audiofile.audio_stream_checksum(data=filething.read())
+    return bard_audiofile.audio_stream_checksum(path=filething)
+
+
+def embeddedAudioMD5(metadata):
+    """Return (md5, bits_per_sample) of the audio checksum stored in a file.
+
+    Only FLAC files store a checksum of their audio (the MD5 signature of
+    the STREAMINFO block). Returns (None, 0) for other files or if the
+    encoder didn't set it.
+    """
+    if (isinstance(metadata, mutagen.flac.FLAC) and
+            metadata.info.md5_signature):
+        return ('%032x' % metadata.info.md5_signature,
+                metadata.info.bits_per_sample)
+    return None, 0
+
+
+def calculateAudioChecksums(filething, md5_bits_per_sample=0):
+    """Decode filething and return the checksums of its audio.
+
+    Returns a dict with the sha256 of the decoded audio (as in
+    calculateSHA256_data(decodeAudio(filething)[0])), the number of samples
+    and, if md5_bits_per_sample is not 0, the md5 of the samples calculated
+    like the MD5 signature of FLAC files with that many bits per sample
+    (or None if the decoded sample format is not an integer one).
+    The audio is never kept in memory and it's decoded without holding
+    the GIL, so several files can be checked in parallel using threads.
+    Returns None if the file can't be decoded.
+    """
+    if hasattr(filething, 'seek'):
+        filething.seek(0)
+        return bard_audiofile.audio_checksums(
+            data=filething.read(), md5_bits_per_sample=md5_bits_per_sample)
+    return bard_audiofile.audio_checksums(
+        path=filething, md5_bits_per_sample=md5_bits_per_sample)
+
+
 def calculateSHA256(filelike):
     hash_sha256 = hashlib.sha256()
     for chunk in iter(lambda: filelike.read(4096 * 1024), b""):
@@ -550,12 +902,20 @@ def DecodedAudioPropertiesTupleFromDict(properties):
 
 
 def decodeAudio(filething, **kwargs):
+    """Decode filething and return (data, properties).
+
+    data is a bard_audiofile.DecodedAudio object which gives access to the
+    decoded audio through the buffer protocol (it can be used with hashlib,
+    numpy.frombuffer, memoryview, etc.) without copying it to a bytes object.
+    """
     if hasattr(filething, 'seek'):
         filething.seek(0)
         filecontents = filething.read()
-        data, properties = bard_audiofile.decode(data=filecontents, **kwargs)
+        data, properties = bard_audiofile.decode(data=filecontents,
+                                                 as_buffer=True, **kwargs)
     else:
-        data, properties = bard_audiofile.decode(path=filething, **kwargs)
+        data, properties = bard_audiofile.decode(path=filething,
+                                                 as_buffer=True, **kwargs)
 
     if config.config['enable_internal_checks']:
         files_pydub_cant_decode_correctly = \
@@ -563,7 +923,7 @@ def decodeAudio(filething, **kwargs):
         if hasattr(filething, 'seek'):
             filething.seek(0)
         audio_segment = AudioSegment.from_file(filething)
-        if (audio_segment.raw_data != data and
+        if (memoryview(data) != audio_segment.raw_data and
                 filething not in files_pydub_cant_decode_correctly):
             with open('/tmp/decoded-song-pydub.raw', 'wb') as f:
                 f.write(audio_segment.raw_data)
@@ -576,7 +936,76 @@ def decodeAudio(filething, **kwargs):
     return data, DecodedAudioPropertiesTupleFromDict(properties)
 
 
+def decodeAudioChunks(filething, consumer, chunk_size=1024 * 1024,
+                      fingerprint_length=None, **kwargs):
+    """Decode filething passing the audio to consumer in chunks.
+
+    consumer.start(sample_format, bytes_per_sample, sample_rate, channels) is
+    called before the first chunk and consumer.feed(data) with each chunk of
+    around chunk_size bytes, so the decoded audio is never kept in memory
+    at once. Returns the properties of the decoded audio.
+
+    If fingerprint_length is not None, the decoder also calculates the
+    chromaprint fingerprint of the first fingerprint_length seconds (or the
+    whole audio if it's 0) and consumer.setFingerprint(fingerprint,
+    raw_fingerprint) is called after decoding with the encoded fingerprint
+    and its little endian 32 bit frames (both None if it failed).
+    """
+    target = consumer
+    if config.config['enable_internal_checks']:
+        consumer = _SHA256Consumer(consumer)
+
+    if hasattr(filething, 'seek'):
+        filething.seek(0)
+        filecontents = filething.read()
+        properties = bard_audiofile.decode_chunks(
+            consumer, data=filecontents, chunk_size=chunk_size,
+            fingerprint_length=fingerprint_length, **kwargs)
+        del filecontents
+    else:
+        properties = bard_audiofile.decode_chunks(
+            consumer, path=filething, chunk_size=chunk_size,
+            fingerprint_length=fingerprint_length, **kwargs)
+
+    if fingerprint_length is not None:
+        target.setFingerprint(properties.pop('fingerprint'),
+                              properties.pop('raw_fingerprint'))
+
+    if config.config['enable_internal_checks']:
+        files_pydub_cant_decode_correctly = \
+            config.config['files_pydub_cant_decode_correctly']
+        if hasattr(filething, 'seek'):
+            filething.seek(0)
+        audio_segment = AudioSegment.from_file(filething)
+        if (calculateSHA256_data(audio_segment.raw_data) !=
+                consumer.sha256.hexdigest() and
+                filething not in files_pydub_cant_decode_correctly):
+            raise Exception('DECODED AUDIO IS DIFFERENT BETWEEN '
+                            'BARD_AUDIOFILE AND PYDUB')
+        print('bard_audiofile/pydub decode check ' +
+              TerminalColors.Ok + 'OK' + TerminalColors.ENDC)
+    return DecodedAudioPropertiesTupleFromDict(properties)
+
+
+class _SHA256Consumer:
+    """Pass decoded chunks to another consumer calculating their sha256."""
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.sha256 = hashlib.sha256()
+
+    def start(self, *args):
+        self.consumer.start(*args)
+
+    def feed(self, data):
+        self.sha256.update(data)
+        self.consumer.feed(data)
+
+
 def audioSegmentFromDataProperties(data, properties):
+    # AudioSegment concatenates its data with + so it needs a bytes object
+    if not isinstance(data, bytes):
+        data = bytes(data)
     return AudioSegment(data=data,
                         sample_width=properties.decoded_bytes_per_sample,
                         frame_rate=properties.sample_rate,
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+"""Watch the music directories for changes with inotify.
+
+LibraryWatcher adds an inotify watch to every directory below the roots
+and collects the directories in which files are written, added, removed or
+renamed. A directory is only returned once no event was received for it in
+debounce seconds, so the files of an album being saved by a tagger are
+processed together. inotify is used through ctypes, so this only works on
+Linux.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    """Minimal wrapper of the inotify functions of libc."""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def addWatch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def removeWatch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        """Return the events received in timeout seconds.
+
+        Each event is a (wd, mask, cookie, name) tuple.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LibraryWatcher:
+    """Collect the directories changed below some root directories."""
+
+    def __init__(self, roots, excludeDirectories=[], debounce=5):
+        self.inotify = Inotify()
+        self.roots = [os.path.normpath(root) for root in roots]
+        self.excludeDirectories = excludeDirectories
+        self.debounce = debounce
+        self.watches = {}
+        # Time of the last event of each changed directory
+        self.pending = {}
+        self.overflowed = False
+        self.watchRoots()
+
+    def watchRoots(self):
+        for root in self.roots:
+            self.watchTree(root)
+
+    def watchTree(self, path):
+        """Watch path and all its subdirectories.
+
+        Returns the list of directories watched.
+        """
+        directories = []
+        for dirpath, dirnames, _ in os.walk(path, followlinks=True):
+            dirnames[:] = [name for name in dirnames
+                           if name not in self.excludeDirectories]
+            try:
+                wd = self.inotify.addWatch(dirpath, WATCH_MASK)
+            except OSError as e:
+                if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                    # It was removed while walking the tree
+                    continue
+                if e.errno == errno.ENOSPC:
+                    print(f"Error: Can't watch {dirpath}. Increase the "
+                          "fs.inotify.max_user_watches sysctl setting")
+                    dirnames[:] = []
+                    continue
+                raise
+            self.watches[wd] = dirpath
+            directories.append(dirpath)
+        return directories
+
+    def unwatchTree(self, path):
+        for wd, directory in list(self.watches.items()):
+            if directory == path or directory.startswith(path + '/'):
+                self.inotify.removeWatch(wd)
+                del self.watches[wd]
+
+    def readEvents(self, timeout):
+        """Wait up to timeout seconds for events and collect them.
+
+        Directories in which files changed are added to self.pending.
+        A removed or moved directory is added too, so the songs below it
+        are checked. If the kernel event queue overflows, events were lost
+        and self.overflowed is set.
+        """
+        events = self.inotify.read(timeout)
+        now = time.monotonic()
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                continue
+
+            if not mask & IN_ISDIR:
+                self.pending[directory] = now
+                continue
+
+            path = os.path.join(directory, name)
+            if name in self.excludeDirectories:
+                continue
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                for subdirectory in self.watchTree(path):
+                    self.pending[subdirectory] = now
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.unwatchTree(path)
+                self.pending[path] = now
+
+    def takeReadyDirectories(self):
+        """Return the pending directories without events in a while.
+
+        The directories returned are removed from self.pending.
+        """
+        now = time.monotonic()
+        ready = sorted(directory
+                       for directory, lastEvent in self.pending.items()
+                       if now - lastEvent >= self.debounce)
+        for directory in ready:
+            del self.pending[directory]
+        return ready
+
+    def close(self):
+        self.inotify.close()
@@ -28,7 +28,8 @@ bard_audiofile = Extension('bard.bard_audiofile',
                            include_dirs=['/usr/include/boost',
                                          '/usr/include/ffmpeg'],
                            libraries=[BOOST_PYTHON_LIB, 'avcodec',
-                                      'avformat', 'avutil', 'swresample'],
+                                      'avformat', 'avutil', 'swresample',
+                                      'chromaprint'],
                            sources=['bard/audiofile/audiofile.cpp',
                                     'bard/audiofile/bufferaviocontext.cpp',
                                     'bard/audiofile/bufferdecodeoutput.cpp',
@@ -37,7 +38,9 @@ bard_audiofile = Extension('bard.bard_audiofile',
                                     'bard/audiofile/referencedata.cpp',
                                     'bard/audiofile/pyaudiofile.cpp',
                                     'bard/audiofile/encoder.cpp',
-                                    'bard/audiofile/log.cpp'],
+                                    'bard/audiofile/log.cpp',
+                                    'bard/audiofile/fingerprinter.cpp',
+                                    'bard/audiofile/hashdecodeoutput.cpp'],
                            extra_compile_args=extra_compile_args)
 setup(
     name="bard",
@@ -72,7 +75,6 @@ setup(
         "Jinja2",
         "bcrypt",
         "paramiko",
-        "DR14-T.meter",
         "importlib_resources; python_version < '3.7'"
     ],
     data_files=[('share/doc/packages/bard/',